@@ -1,2 +1,4 @@
 from .action_container import ActionContainer, shared_segment_params
-from .amp_adjuster import AmpAdjuster2D
\ No newline at end of file
+from .amp_adjuster import AmpAdjuster2D
+from .sequence_compiler import compress_looped_segments, calculate_segments
+from .move_tones import can_batch_move_tones, calculate_move_tones
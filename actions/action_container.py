@@ -1,6 +1,7 @@
 import logging
 import sys
 import inspect
+import hashlib
 import numpy as np
 from copy import copy, deepcopy
 from scipy.interpolate import interp1d
@@ -92,6 +93,9 @@ class ActionContainer():
     sync : bool
         Boolean used by the `MainWindow` class to track whether this action
         is used for synchronisation between the AWG and Dexter.
+    data_hash : str or None
+        Cached hash of the `data` array returned by `get_data_hash`. This is 
+        reset to None whenever the data is recalculated.
     amp_adjuster : AmpAdjuster2D
         The AmpAdjuster for this action_container. This is a shared object 
         between all ActionContainers of the same channel. It converts the 
@@ -135,6 +139,7 @@ class ActionContainer():
         self.needs_to_transfer = True
         self.rearr = False
         self.sync = False
+        self.data_hash = None
         
     def get_action_params(self):
         """Returns a complete `action_params` dict that could be used to 
@@ -406,6 +411,7 @@ class ActionContainer():
         self.duration_ms = num_samples*time_step*1e3
         self.time = np.linspace(0,self.duration_ms*1e-3,num_samples+1)
         self.data = np.empty_like(self.time)
+        self.data_hash = None
         self.needs_to_calculate = True
 
     def calculate(self):
@@ -440,9 +446,25 @@ class ActionContainer():
                 
                 self.end_phase.append(phase_data[-1]%360)
             self.data = self.data[1:]
+            self.data_hash = None
             self.needs_to_calculate = False
             self.needs_to_transfer = True
     
+    def get_data_hash(self):
+        """Returns a hash of the calculated data. This is used by the `AWG` 
+        class to identify data that is already stored on the card. The hash is
+        cached so the data is only hashed once each time it is calculated.
+        
+        Returns
+        -------
+        str
+            The hex digest of the data bytes.
+
+        """
+        if self.data_hash is None:
+            self.data_hash = hashlib.blake2b(np.ascontiguousarray(self.data).data,digest_size=16).hexdigest()
+        return self.data_hash
+    
     def set_start_phase(self,phase=None):
         """Set the start phases to use when calculating the segment. Extra 
         phases will be discarded and new phases will be added if needed.
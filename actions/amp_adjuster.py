@@ -1,10 +1,13 @@
 import logging
+import os
 import numpy as np
 import time
 import json
 from collections import OrderedDict
 from scipy.interpolate import interp1d, RectBivariateSpline
 
+calibration_cache = {} # calibrations shared between all AmpAdjusters in this process, see load_calibration
+
 class AmpAdjuster2D():
     """Class to read in and process the calibration files for the amp_adjust 
     functionality of the AWG.
@@ -108,7 +111,19 @@ class AmpAdjuster2D():
         power : np.array
             Powers to use when creating the 2D amp adjuster spline. Not
             used with the .awgde file format.
+        
+        Calibrations are cached in the module-level `calibration_cache` 
+        so that AmpAdjusters for different cards or channels using the same 
+        file only load it once. The cache is keyed by the file modification 
+        time so an updated file is reloaded.
         """
+        cache_key = (os.path.abspath(filename),os.path.getmtime(filename),
+                     tuple(fs),tuple(power))
+        try:
+            return calibration_cache[cache_key]
+        except KeyError:
+            pass
+        
         if not filename.rsplit('.',1)[-1] == 'awgde': # old file format so construct the AmpAdjuster1d objects
             with open(filename) as json_file:
                 calFile = json.load(json_file)
@@ -139,7 +154,7 @@ class AmpAdjuster2D():
                     mv[i] = ampAdjuster1d(fs, p)
                 except Exception as e: print('Warning: could not create power calibration for %s\n'%p+str(e))
                 
-            return RectBivariateSpline(power, fs, mv)
+            calibration = RectBivariateSpline(power, fs, mv)
 
         else: # new .awgde format, see Labbook 22/02/2023 for more info
             with open(filename) as json_file:
@@ -157,7 +172,10 @@ class AmpAdjuster2D():
                 
             optical_powers = [float(x) for x in optical_powers]
 
-            return RectBivariateSpline(optical_powers, fs, voltages)
+            calibration = RectBivariateSpline(optical_powers, fs, voltages)
+        
+        calibration_cache[cache_key] = calibration
+        return calibration
 
     
     def adjuster(self,freqs_MHz,optical_powers):
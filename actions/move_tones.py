@@ -0,0 +1,106 @@
+"""Batched calculation of the single tone movements used for rearrangement.
+
+Every movement of a `RearrangementHandler` is the same action with a
+different start frequency, end frequency and start phase. For the sweep
+functions in `batched_freq_functions` the frequency profile is affine in
+the endpoints:
+
+    f(t) = f_start + (f_end - f_start)*s(t)
+
+where s(t) is the profile of a sweep from 0 to 1 MHz. The phase integral is
+then also affine, so s(t), its integral and the amplitude profile are only
+calculated once and every movement tone is generated from them by
+broadcasting. Movements are processed in batches of rows so that the float
+arrays stay a manageable size, optionally in several worker threads (numpy
+releases the GIL for the large array operations).
+
+"""
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+batched_freq_functions = ['sweep','min_jerk','sweep_with_waits']
+move_batch_samples = 2**20 # float samples (summed over the movements) calculated at a time
+
+def can_batch_move_tones(action):
+    """Returns whether the movements made from `action` (using the first 
+    tone of its parameters) can be calculated with `calculate_move_tones`."""
+    return action.freq_function_name in batched_freq_functions
+
+def calculate_move_tones(action,movements,out,conversion,workers=1):
+    """Calculates the single tone movement data of an action for many
+    endpoints and start phases and writes it into `out` as int16.
+
+    The result is the same as setting the parameters of `action` and
+    calling `ActionContainer.calculate` for each movement (up to floating
+    point rounding in the phase integral), including dropping the first
+    sample of each movement.
+
+    Parameters
+    ----------
+    action : ActionContainer
+        A single tone action that is used as the template for the
+        movements. Its start frequency, end frequency and start phase are
+        ignored. `can_batch_move_tones` must be True for this action.
+    movements : list of tuple
+        The (start_freq_MHz, end_freq_MHz, start_phase) of each movement,
+        with the phase in degrees.
+    out : numpy.ndarray of int16
+        Array of shape (len(movements), samples) to write the data into.
+        This may be a strided view, e.g. one channel of multiplexed rows. 
+        If there are more samples than in the action, the tone is held at 
+        the end frequency (and amplitude) for the extra samples.
+    conversion : float
+        The factor to convert the data from mV to the int16 values, i.e.
+        2**15/max_output_mV. Values are truncated towards zero.
+    workers : int
+        The number of threads to calculate batches in. The default is 1.
+
+    Returns
+    -------
+    None.
+
+    """
+    tone_freq_params = action.transpose_params(action.freq_params)[0]
+    tone_amp_params = action.transpose_params(action.amp_params)[0]
+    tone_freq_params['start_freq_MHz'] = 0
+    tone_freq_params['end_freq_MHz'] = 1
+    sweep_profile = action.freq_function(**tone_freq_params)
+    amp_profile = np.asarray(action.amp_function(**tone_amp_params),dtype=float)
+    hold_samples = out.shape[1]+1-action.time.size
+    if hold_samples > 0:
+        sweep_profile = np.concatenate([sweep_profile,np.ones(hold_samples)])
+        amp_profile = np.concatenate([amp_profile,np.full(hold_samples,amp_profile[-1])])
+
+    # same integration as ActionContainer.calculate_phase
+    phase_per_MHz = 360*1e6*(action.time[1]-action.time[0])
+    static_phase = phase_per_MHz*np.arange(sweep_profile.size)
+    sweep_phase = phase_per_MHz*np.cumsum(sweep_profile)
+    sweep_phase -= sweep_phase[0]
+
+    movements = np.asarray(movements,dtype=float).reshape(-1,3)
+    batch_rows = max(1,move_batch_samples//sweep_profile.size)
+
+    def calculate_batch(row_start):
+        batch = movements[row_start:row_start+batch_rows]
+        start_freqs_MHz = batch[:,:1]
+        sweep_widths_MHz = batch[:,1:2]-start_freqs_MHz
+        freq_data = start_freqs_MHz + sweep_widths_MHz*sweep_profile
+        phase_data = batch[:,2:3] + start_freqs_MHz*static_phase + sweep_widths_MHz*sweep_phase
+        amp_data_mV = np.reshape(action.amp_adjuster.adjuster(freq_data.ravel(),np.broadcast_to(amp_profile,freq_data.shape).ravel()),
+                                 freq_data.shape)
+        if action.amp_comp_filename is not None:
+            amp_data_mV = np.array([action.apply_amp_compensation(row) for row in amp_data_mV])
+        np.multiply(phase_data,2*np.pi/360,out=phase_data)
+        np.sin(phase_data,out=phase_data)
+        np.multiply(phase_data,amp_data_mV*conversion,out=phase_data)
+        np.copyto(out[row_start:row_start+batch.shape[0]],phase_data[:,1:],casting='unsafe') # truncates towards zero like np.int16()
+
+    logging.debug('Calculating {} movement tones in batches of {}.'.format(len(movements),batch_rows))
+    row_starts = range(0,len(movements),batch_rows)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(calculate_batch,row_starts)) # list() so that any exceptions are raised
+    else:
+        for row_start in row_starts:
+            calculate_batch(row_start)
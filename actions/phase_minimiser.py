@@ -1,6 +1,8 @@
 import numpy as np
 from scipy.optimize import minimize
 
+phase_cache = {} # optimised phases shared between all actions (and cards) in this process, see phase_minimise
+
 def multisine(phases_deg, freqs_MHz, amps, time_us=np.linspace(0,1,1000)):
     return np.sum([amps[i]*np.sin(2*np.pi*time_us*freqs_MHz[i]+ phases_deg[i]*np.pi/180) for i in range(len(phases_deg))],axis=0)
    
@@ -43,6 +45,10 @@ def phase_minimise(freqs_MHz=[85,87,89], amps=[1]*3):
     
     The phases are returned such that the first phase is always zero.
     
+    Results are cached in the module-level `phase_cache` because the 
+    numerical optimisation is slow and the same tones are often optimised 
+    for many segments.
+    
     Parameters
     ----------
     freqs_MHz : list of float
@@ -58,6 +64,11 @@ def phase_minimise(freqs_MHz=[85,87,89], amps=[1]*3):
     """
     # if len(amps) != len(freqs_MHz):
     #     amps = [1]*len(freqs_MHz)
+    cache_key = (tuple(np.ravel(freqs_MHz).tolist()),tuple(np.ravel(amps).tolist()))
+    try:
+        return list(phase_cache[cache_key])
+    except KeyError:
+        pass
     # start by optimizing them all
     result = minimize(crest, phase_adjust(len(freqs_MHz)), args=(freqs_MHz, amps))
     phases_deg = result.x
@@ -65,6 +76,7 @@ def phase_minimise(freqs_MHz=[85,87,89], amps=[1]*3):
         result = minimize(crest_index, phases_deg[i], args=(phases_deg,i,freqs_MHz,amps))
         phases_deg[i] = result.x
     phases_deg = (phases_deg-phases_deg[0])%360
+    phase_cache[cache_key] = list(phases_deg)
     return list(phases_deg)    
 
 if __name__ == '__main__':
@@ -0,0 +1,298 @@
+"""Compiler passes that rewrite the segments and steps from the `MainWindow`
+before they are calculated and loaded onto the card.
+
+`calculate_segments` calculates the segments in order (passing the end phase
+of each segment on to the next) and deduplicates identical segments: a
+segment whose actions have the same parameters (including start phases) as
+an earlier segment is replaced by the earlier segment's actions, so it is
+only calculated once. `AWG.load_all` stores logical segments with the same
+data in a single physical segment, so it is also only transferred once.
+
+`compress_looped_segments` replaces long static (or periodic) segments with
+the shortest segment that repeats seamlessly, played with more loops. A
+static tone at f MHz repeats after any whole number of cycles, i.e. after
+N samples when f*N/sample_rate is an integer. The shortest such N that is
+common to every tone (and amplitude modulation) of every channel, and that
+is a multiple of segment_step_samples, is found exactly from the rational
+representation of the frequencies.
+
+"""
+import logging
+import math
+import numpy as np
+from fractions import Fraction
+
+from .action_container import ActionContainer
+
+max_step_loops = 2**20-2 # largest number of loops accepted for a step by AWG._set_step and AWG._encode_steps (which reject SPCSEQ_LOOPMASK)
+default_max_period_samples = 2**20 # longest loop period that is worth compressing to
+compressible_freq_functions = ['static']
+compressible_amp_functions = ['static','modulate','empty']
+phase_key_decimals = 2 # start phases (in degrees) are rounded to this many decimals when deduplicating, as phases carried between segments pick up integration errors
+
+def get_cycles_per_sample(freq_Hz,sample_rate_Hz):
+    """Returns the exact number of cycles per sample of a frequency as a
+    Fraction. The frequency is converted from its decimal representation so
+    that e.g. 100.1 is treated as exactly 100.1 rather than the nearest
+    float."""
+    return Fraction(repr(float(freq_Hz)))/Fraction(int(sample_rate_Hz))
+
+def get_loop_period_samples(freqs_Hz,card_settings,max_period_samples=default_max_period_samples):
+    """Finds the shortest segment that contains a whole number of cycles of
+    every frequency.
+
+    Parameters
+    ----------
+    freqs_Hz : list of float
+        The frequencies (tones and amplitude modulations) that must be
+        periodic in the segment.
+    card_settings : dict
+        The card settings. 'sample_rate_Hz', 'segment_step_samples' and
+        'segment_min_samples' are used.
+    max_period_samples : int
+        The longest period that will be returned. The default is
+        `default_max_period_samples`.
+
+    Returns
+    -------
+    int or None
+        The number of samples in the period, or None if there is no period
+        shorter than `max_period_samples`.
+
+    """
+    step_samples = int(card_settings['segment_step_samples'])
+    min_samples = int(card_settings['segment_min_samples'])
+    period_samples = step_samples
+    for freq_Hz in freqs_Hz:
+        denominator = get_cycles_per_sample(freq_Hz,card_settings['sample_rate_Hz']).denominator
+        period_samples = period_samples*denominator//math.gcd(period_samples,denominator)
+        if period_samples > max_period_samples:
+            return None
+    period_samples *= -(-min_samples//period_samples) # smallest multiple that is a valid segment length
+    if period_samples > max_period_samples:
+        return None
+    return period_samples
+
+def get_periodic_freqs_Hz(action):
+    """Returns the frequencies that have to be periodic for an action to
+    loop seamlessly, or None if the action cannot be looped."""
+    if ((action.freq_function_name not in compressible_freq_functions) or
+        (action.amp_function_name not in compressible_amp_functions) or
+        (action.amp_comp_filename is not None) or # compensation is stretched over the whole action
+        action.rearr):
+        return None
+    freqs_Hz = [freq_MHz*1e6 for freq_MHz in action.freq_params['start_freq_MHz']]
+    if action.amp_function_name == 'modulate':
+        freqs_Hz += [mod_freq_kHz*1e3 for mod_freq_kHz in action.amp_params['mod_freq_kHz']]
+    return freqs_Hz
+
+def compress_looped_segments(segments,steps,card_settings,exclude_segments=[],
+                             max_period_samples=default_max_period_samples,allow_duration_change=False):
+    """Replaces long static segments with a short segment that is looped.
+
+    A segment is compressed if every action in it is static in frequency and
+    static (or amplitude modulated) in amplitude, and a period that is at
+    least 4 times shorter can be found. The new segment is one period long
+    and every step that uses it has its `number_of_loops` multiplied so that
+    the total length is unchanged.
+
+    The segments and steps passed in are not modified; the compressed
+    actions are new `ActionContainer` objects that have not been calculated.
+
+    Parameters
+    ----------
+    segments : list of list of ActionContainer
+        The segments from the `MainWindow`.
+    steps : list of dict
+        The steps from the `MainWindow`.
+    card_settings : dict
+        The card settings from the `MainWindow`.
+    exclude_segments : list of int
+        Indices of segments that must not be compressed, e.g. segments used
+        for rearrangement. The default is [].
+    max_period_samples : int
+        The longest period to compress a segment to. The default is
+        `default_max_period_samples`.
+    allow_duration_change : bool
+        If False, segments are only compressed if their length is an exact
+        multiple of the period, so the output is identical to the
+        uncompressed segment. If True, the number of loops is rounded, which
+        changes the length of the segment by less than one period and
+        changes the phase that the following segment continues from. The
+        default is False.
+
+    Returns
+    -------
+    segments : list of list of ActionContainer
+        The segments with the compressed segments replaced.
+    steps : list of dict
+        Copies of the steps with the number of loops updated.
+    compressed : dict of int : tuple
+        The compressed segments, keyed by segment index, with values of
+        (period_samples, loops_per_segment).
+
+    """
+    new_segments = list(segments)
+    new_steps = [dict(step) for step in steps]
+    compressed = {}
+    for segment_index,segment in enumerate(segments):
+        if segment_index in exclude_segments:
+            continue
+        freqs_Hz = []
+        for action in segment:
+            action_freqs_Hz = get_periodic_freqs_Hz(action)
+            if action_freqs_Hz is None:
+                break
+            freqs_Hz += action_freqs_Hz
+        else:
+            num_samples = segment[0].time.size - 1
+            period_samples = get_loop_period_samples(freqs_Hz,card_settings,min(max_period_samples,num_samples//4))
+            if period_samples is None:
+                continue
+            if num_samples % period_samples:
+                if not allow_duration_change:
+                    logging.debug('Not compressing segment {}: {} samples is not a multiple '
+                                  'of the {} sample period.'.format(segment_index,num_samples,period_samples))
+                    continue
+                logging.warning('Compressing segment {} changes its length from {} to {} '
+                                'samples.'.format(segment_index,num_samples,
+                                                  round(num_samples/period_samples)*period_samples))
+            loops = round(num_samples/period_samples)
+            segment_steps = [step for step in new_steps if step['segment'] == segment_index]
+            if any(step['number_of_loops']*loops > max_step_loops for step in segment_steps):
+                logging.debug('Not compressing segment {}: too many loops.'.format(segment_index))
+                continue
+
+            new_segment = []
+            for action in segment:
+                action_params = action.get_action_params()
+                action_params['duration_ms'] = period_samples/card_settings['sample_rate_Hz']*1e3
+                action_params['amp_comp_filename'] = action.amp_comp_filename
+                new_action = ActionContainer(action_params,card_settings,action.amp_adjuster)
+                new_action.sync = action.sync
+                new_segment.append(new_action)
+            new_segments[segment_index] = new_segment
+            for step in segment_steps:
+                step['number_of_loops'] *= loops
+            compressed[segment_index] = (period_samples,loops)
+            logging.info('Compressed segment {} from {} samples to a {} sample period '
+                         'looped {} times.'.format(segment_index,num_samples,period_samples,loops))
+    return new_segments, new_steps, compressed
+
+def get_action_key(action):
+    """Returns a key identifying the data an action will calculate. Actions
+    with equal keys calculate identical data.
+
+    The key includes the start phases (rounded to `phase_key_decimals`
+    degrees), so for actions that continue the phase of the previous segment
+    it should only be taken after `ActionContainer.set_start_phase` has been
+    called.
+
+    Parameters
+    ----------
+    action : ActionContainer
+        The action to identify.
+
+    Returns
+    -------
+    tuple
+        The hashable key.
+
+    """
+    def freeze(params):
+        frozen = []
+        for key,value in params.items():
+            value = np.ravel(value)
+            if key == 'start_phase':
+                value = np.round(np.mod(value.astype(float),360),phase_key_decimals) % 360
+            frozen.append((key,tuple(value.tolist())))
+        return tuple(sorted(frozen))
+    return (action.freq_function_name,action.amp_function_name,action.time.size,
+            action.duration_ms,freeze(action.freq_params),freeze(action.amp_params),
+            action.amp_comp_filename,id(action.amp_adjuster))
+
+def share_action_data(action,canonical_action):
+    """Gives an action the calculated data of an identical action (see 
+    `get_action_key`) instead of calculating it. The data array is shared 
+    rather than copied.
+
+    Parameters
+    ----------
+    action : ActionContainer
+        The duplicate action.
+    canonical_action : ActionContainer
+        The calculated action with the same key.
+
+    Returns
+    -------
+    None.
+
+    """
+    action.data = canonical_action.data
+    action.data_hash = canonical_action.data_hash
+    action.end_phase = list(canonical_action.end_phase)
+    action.needs_to_calculate = False
+
+def calculate_segments(segments,exclude_segments=[],dedupe=True):
+    """Calculates the segments in order, setting the start phase of each
+    action from the end phase of the same channel in the previous segment.
+    Identical segments are only calculated once.
+
+    Parameters
+    ----------
+    segments : list of list of ActionContainer
+        The segments to calculate.
+    exclude_segments : list of int
+        Indices of segments that must not be deduplicated, e.g. segments 
+        used for rearrangement. Rearrangement actions are never 
+        deduplicated. The default is [].
+    dedupe : bool
+        Whether to deduplicate identical segments. The default is True.
+
+    Returns
+    -------
+    list of list of ActionContainer
+        The segments with duplicates replaced by the actions of the first
+        identical segment. The list has the same length and order as
+        `segments` so the logical segment indices and steps are unchanged.
+        The input list is not modified, but the actions of duplicate 
+        segments are given the data of the identical segment (see 
+        `share_action_data`) so they are no longer flagged as needing to 
+        be calculated.
+
+    """
+    compiled = []
+    canonical_segments = {}
+    for segment_index, segment in enumerate(segments):
+        for action_index, action in enumerate(segment):
+            if action.needs_to_calculate:
+                if segment_index == 0:
+                    action.set_start_phase(None)
+                else:
+                    action.set_start_phase(compiled[segment_index-1][action_index].end_phase)
+        
+        if (not dedupe) or (segment_index in exclude_segments) or any(action.rearr for action in segment):
+            key = None
+        else:
+            key = tuple(get_action_key(action) for action in segment)
+        if key in canonical_segments:
+            logging.debug('Segment {} is identical to an earlier segment so will not '
+                          'be calculated.'.format(segment_index))
+            canonical_segment = canonical_segments[key]
+            for action, canonical_action in zip(segment,canonical_segment):
+                if action is not canonical_action:
+                    share_action_data(action,canonical_action)
+            compiled.append(canonical_segment)
+            continue
+        
+        for action_index, action in enumerate(segment):
+            if action.needs_to_calculate:
+                logging.info('Calculating segment {}, channel {}.'.format(segment_index,action_index))
+                action.calculate()
+        compiled.append(segment)
+        if key is not None:
+            canonical_segments[key] = segment
+    num_duplicates = len(segments) - len(set(id(segment) for segment in compiled))
+    if num_duplicates:
+        logging.info('{} of {} segments were duplicates of other segments.'.format(num_duplicates,len(segments)))
+    return compiled
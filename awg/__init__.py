@@ -1 +1,6 @@
-from .awg_class import AWG
\ No newline at end of file
+from .awg_class import AWG
+from .memory_planner import plan_card_memory, log_memory_plan
+from .multi_card import MultiCardController
+from .fifo_streamer import FIFOStreamer, ToneChunkGenerator
+from .card_monitor import CardMonitor
+from .sequence_bundle import save_bundle, load_bundle
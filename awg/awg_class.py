@@ -1,16 +1,32 @@
 import logging
 logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.DEBUG)
 
+import os
+import time
+import threading
 import numpy as np
 import ctypes
 
 from copy import copy
 
-from .pyspcm import *
+def _use_simulated_card():
+    """Returns whether the AWG_SIMULATE environment variable asks for the 
+    simulated card (see spcm_sim). Unset, empty or 0 uses the driver."""
+    value = os.environ.get('AWG_SIMULATE','').strip()
+    try:
+        return int(value) > 0
+    except ValueError:
+        return bool(value)
+
+if _use_simulated_card():
+    from .spcm_sim import * # simulated card for use without the hardware, see spcm_sim
+else:
+    from .pyspcm import *
 from .spcm_tools import *
+from .memory_planner import get_segment_capacity_samples, max_card_steps
 
-import os
-main_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+page_size_bytes = 4096 # DMA staging buffers are aligned to (and sized in multiples of) one page
+quantisation_chunk_samples = 2**16 # samples converted to int16 at a time so the float scratch buffer stays in cache
 
 class AWG():
     """Defines the AWG wrapper class for handling interfacing with the AWG.
@@ -21,7 +37,7 @@ class AWG():
     hCard : LP_c_ulonglong
         The AWG card which is directly communicated with using the register 
         tables as outlined in the M4i.66xx-x8/M4i.66xx-x4 manual p. 61.
-    active_channels : {1,2}
+    active_channels : {1,2,4}
         The number of active channels on the AWG. This is specified at object 
         creation.
     sample_rate_Hz : int
@@ -33,6 +49,8 @@ class AWG():
     number_of_segments : int
         The number of segments the AWG memory has been divided into. This must 
         be a power of 2.
+    card_index : int
+        The index of the card to open, i.e. the card at /dev/spcm<card_index>.
         
     lNumChannels : ctypes.c_long
         The number of active channels that the AWG card reports. The actual
@@ -40,6 +58,53 @@ class AWG():
     lBytesPerSample : ctypes.c_long
         The number of bytes each sample takes. Expect this to be 2. The actual 
         number is accessed with self.lBytesPerSample.value
+    staging_buffers : dict of int : numpy.ndarray of int16
+        Persistent page-aligned buffers that data is DMA'd to the card from,
+        keyed by the staging slot. These are allocated once and only
+        reallocated if a larger segment is requested, so data can be
+        quantised, multiplexed and summed straight into DMA memory using the
+        views returned by `get_staging_buffer`.
+    upload_timings : list of dict
+        The time taken to prepare and transfer each segment in the last call 
+        of `load_all`. Each dict has the keys 'segment', 'samples', 
+        'prepare_s', 'transfer_s' and 'wait_s', where 'wait_s' is the time 
+        spent blocked waiting for the DMA to finish after the next segment 
+        had been prepared.
+    quantisation_stats : dict of int : dict
+        The statistics returned by `quantise_segment_data` for the last data 
+        uploaded to each segment, keyed by the logical segment index. These 
+        can be used to check whether any segment was rescaled or clipped.
+    segment_hashes : list of tuple or None
+        The key (see `get_segment_key`) of the data stored in each physical 
+        segment of the card, or None if the contents are unknown. This is 
+        used to skip transferring data that is already on the card.
+    segment_map : dict of int : int
+        Maps the logical segment indices used by the `MainWindow` onto the 
+        physical segments of the card that they are stored in.
+    step_shadow : numpy.ndarray of int64
+        Copy of the values written to the SPC_SEQMODE_STEPMEM0 + i registers 
+        of the card so that only steps that change need to be written. 
+        Entries are -1 when the value on the card is unknown.
+    register_shadow : dict of int : int
+        The last value written to registers that are set with 
+        `_set_register`, so that writes of unchanged values can be skipped. 
+        Registers that apply to the segment selected by 
+        SPC_SEQMODE_WRITESEGMENT are keyed by (register, segment).
+    transfer_contexts : dict of tuple : tuple
+        Cached ctypes arguments for DMA transfers keyed by the buffer 
+        address and number of samples (see `_get_transfer_context`).
+    retired_segments : dict of int : int
+        Physical segments that were re-pointed away from in a hitless update 
+        whilst the card might still be playing them, mapped to the step that 
+        was playing at the time. These are not overwritten until the card 
+        is on a different step.
+    monitor : CardMonitor or None
+        The background monitor polling the card status, if one has been 
+        started (see `card_monitor.CardMonitor`).
+    driver_lock : threading.RLock
+        Held whilst making driver calls that can happen at the same time as 
+        the `monitor` reading the card status: the DMA transfers, writing 
+        steps and reading the current step and status.
         
     Methods
     -------
@@ -66,6 +131,10 @@ class AWG():
         Deletes the connection to the AWG card and then calls init to make a 
         new connection after reinitialisation.
     
+    get_staging_buffer
+        Returns an int16 view of a persistent page-aligned DMA staging buffer
+        that segment data can be written into directly.
+    
     _set_segment
         Internal method for sending preprepared data to the card to save in 
         a certain segment.
@@ -76,7 +145,7 @@ class AWG():
         
     """
     
-    def __init__(self,active_channels=1,sample_rate_Hz=int(625e6),max_output_mV=100,number_of_segments=16,**kwargs):
+    def __init__(self,active_channels=1,sample_rate_Hz=int(625e6),max_output_mV=100,number_of_segments=16,card_index=0,**kwargs):
         """Create the class and set basic attributes. Kwargs are those 
         expected by the controller card_settings dict.
         
@@ -96,6 +165,9 @@ class AWG():
         number_of_segments : int
             The number of segments to divide the card memory into for 
             sequence replay mode. This number must be a power of 2.
+        card_index : int
+            The index of the card to open when more than one card is 
+            installed in the PC. The default is 0.
         
         """
         
@@ -103,13 +175,18 @@ class AWG():
         self.sample_rate_Hz = int(sample_rate_Hz)
         self.max_output_mV = int(max_output_mV)
         self.number_of_segments = int(number_of_segments)
+        self.card_index = int(card_index)
+        self.upload_timings = []
+        self.quantisation_stats = {}
+        self.monitor = None
+        self.driver_lock = threading.RLock()
         
         self.init()
     
     def init(self):        
-        self.hCard = spcm_hOpen(create_string_buffer(b'/dev/spcm0'))
+        self.hCard = spcm_hOpen(create_string_buffer('/dev/spcm{}'.format(self.card_index).encode()))
         if self.hCard == None:
-            logging.error("No AWG card found")
+            logging.error("No AWG card found at index {}".format(self.card_index))
         
         #spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_CARD_RESET)
         
@@ -149,7 +226,9 @@ class AWG():
         spcm_dwSetParam_i32(self.hCard, SPC_CARDMODE, SPC_REP_STD_SEQUENCE)
         
         # Enable the correct number of channels
-        if self.active_channels == 2:
+        if self.active_channels == 4:
+            llChEnable = int64(CHANNEL0|CHANNEL1|CHANNEL2|CHANNEL3)
+        elif self.active_channels == 2:
             llChEnable = int64(CHANNEL0|CHANNEL1)
         else:
             llChEnable = int64(CHANNEL0)
@@ -213,6 +292,23 @@ class AWG():
         # Set the start step to zero
         spcm_dwSetParam_i32(self.hCard, SPC_SEQMODE_STARTSTEP, 0)
         
+        # Staging buffers are (re)allocated lazily. The continuous buffer 
+        # belongs to this card handle so is looked up again on every init.
+        self.staging_buffers = {}
+        self.pvContBuf = c_void_p()
+        self.qwContBufLen = uint64(0)
+        spcm_dwGetContBuf_i64(self.hCard, SPCM_BUF_DATA, byref(self.pvContBuf), byref(self.qwContBufLen))
+        logging.debug('continuous buffer length {} bytes'.format(self.qwContBufLen.value))
+        
+        # Nothing is known about the card memory after it is (re)initialised.
+        self.segment_hashes = [None]*self.number_of_segments
+        self.segment_map = {}
+        self.step_shadow = np.full(max_card_steps,-1,dtype=np.int64)
+        self.retired_segments = {}
+        self.register_shadow = {}
+        self.transfer_contexts = {}
+        self.dwNotifySize = uint32(0)
+        
     def start(self,timeout = 10000):
         """Starts the AWG card. Unlike in the previous AWG code, errors in 
         steps and segments are not checked when performing this check. This 
@@ -292,22 +388,29 @@ class AWG():
         None.
         
         """
+        if self.monitor is not None:
+            self.monitor.stop()
         spcm_vClose(self.hCard)
         
     def reinit(self):
         """Stops the card, disconnects, and reinitialises the card. The card 
-        is not started yet so that segments/steps can be reloaded.
+        is not started yet so that segments/steps can be reloaded. If a 
+        `CardMonitor` was running it is restarted once the card has been 
+        reinitialised, keeping its callbacks and history.
 
         Returns
         -------
         None.
 
         """
+        monitor = self.monitor if (self.monitor is not None) and self.monitor.is_alive() else None
         self.stop()
         self.close()
         self.init()
+        if (monitor is not None) and (self.hCard is not None):
+            monitor.start()
         
-    def load_all(self,segments,steps):
+    def load_all(self,segments,steps,restart=False,hitless=True):
         """Loads all segment and step data onto the card and then starts it 
         to prepare for playback.
         
@@ -315,10 +418,28 @@ class AWG():
         sent. If have already been calculated and are eady for transfer, this 
         will not slow down the data transfer because they will not recalculate.
         
+        The segments in the `MainWindow` are logical segments which are mapped 
+        onto physical segments of the card memory (see `segment_map`). A 
+        segment is only transferred if its data is not already stored in a 
+        physical segment according to `segment_hashes`, so segments that have 
+        only been reordered are not transferred again; only the step table is 
+        rewritten to point at the physical segments they are stored in. 
+        Rearrangement segments are always transferred because their data is 
+        changed during runtime.
+        
         Once an action has been trasferred the flag needs_to_transfer in the 
-        ActionContainer will be marked as False. This will mean that the data 
-        is not tranferred again unless the is flag is reset to True, such as 
-        when the action is recalculated.
+        ActionContainer will be marked as False.
+        
+        Only steps that differ from `step_shadow` are written to the card. If 
+        the card is running and the step it is currently playing has not 
+        changed (other than being re-pointed to a new physical segment in a 
+        hitless update), the steps are updated without stopping the card. 
+        Otherwise the card is (re)started from step 0.
+        
+        A step that is re-pointed whilst the card is playing it takes effect 
+        the next time the card reads that step from the sequence memory, so 
+        the old physical segment is kept in `retired_segments` and not 
+        overwritten until the card has moved on to another step.
 
         Parameters
         ----------
@@ -331,63 +452,407 @@ class AWG():
             The list of dicts from the MainWindow class that defines the steps.
             Steps are loaded sequentially, apart from the last step which is 
             set to return to the first step after playback.
+        restart : bool
+            If True the card is always restarted from step 0 after the data 
+            is loaded, even if it could have kept playing. The default is 
+            False.
+        hitless : bool
+            If True and the card is running, new data for the segment that is 
+            currently playing is written into a spare physical segment and 
+            the steps are re-pointed to it without stopping the card. The 
+            card is only stopped if there is no spare segment. If False, the 
+            card is stopped to overwrite the playing segment. The default is 
+            True.
 
         Returns
         -------
         None.
 
         """
-        current_step, current_segment = self.get_current_step_segment()
-        
-        
+        segment_capacity_samples = get_segment_capacity_samples(self.get_memory_samples(),self.number_of_segments,self.lNumChannels.value)
         for segment_index,segment in enumerate(segments):
-            segment_data = []
-            if (any([action.needs_to_transfer for action in segment]) | 
-                any([action.rearr for action in segment])):
-                if segment_index == current_segment:
-                    logging.warning('The currently playing segment {} '
-                                    'needs to transfer. The card will '
-                                    'be stopped to transfer this '
-                                    'data.'.format(current_segment))
-                    self.stop()
-                for action in segment:
-                    segment_data.append(action.data)
-                segment_data = self.multiplex(segment_data)
-                self._set_segment(segment_index,segment_data)
-                for action in segment:
-                    action.needs_to_transfer = False
-            else:
+            if max([action.data.size for action in segment]) > segment_capacity_samples:
+                logging.error('Segment {} is longer than the {} samples that '
+                              'fit in each of the {} segments of the card memory. '
+                              'Cancelling data transfer. Use the card memory '
+                              'planner to choose a valid number_of_segments.'
+                              ''.format(segment_index,segment_capacity_samples,self.number_of_segments))
+                return
+        
+        segment_keys = [self.get_segment_key(segment) for segment in segments]
+        transfer_indices, current_segment, running = self._plan_segment_upload(segment_keys,hitless)
+        for segment_index in range(len(segments)):
+            if (segment_index not in transfer_indices) and (segment_index in self.segment_map):
                 logging.info('Skipped transferring segment {} to card because '
-                             'all actions reported that they are already '
-                             'transferred.'.format(segment_index))
+                             'its data is already stored in physical segment '
+                             '{}.'.format(segment_index,self.segment_map[segment_index]))
+                for action in segments[segment_index]:
+                    action.needs_to_transfer = False
+        
+        def prepare(segment_index,slot):
+            channel_data = [action.data for action in segments[segment_index]]
+            staging_buffer = self.get_staging_buffer(sum(data.size for data in channel_data),slot=slot)
+            return self.prepare_segment_data(channel_data,out=staging_buffer,segment_index=segment_index)
+        self._upload_segments(transfer_indices,prepare,segment_keys,segments,running,current_segment)
+        self._update_steps(steps,current_segment,restart,hitless)
+    
+    def load_compiled(self,segment_data,segment_keys,steps,restart=False,hitless=True):
+        """Loads precalculated int16 segment data and steps onto the card, 
+        such as the payloads of a compiled sequence bundle (see 
+        `sequence_bundle`). This behaves like `load_all` but no actions are 
+        calculated or quantised.
+
+        Parameters
+        ----------
+        segment_data : list of numpy.ndarray of int16
+            The multiplexed data of each logical segment. These can be 
+            memory-mapped arrays; each is read once when it is copied into a 
+            staging buffer.
+        segment_keys : list of tuple or None
+            The key of each segment, as returned by `get_segment_key` for 
+            the actions the data was calculated from. Segments whose key is 
+            already stored on the card are not transferred.
+        steps : list of dicts
+            The steps, as for `load_all`.
+        restart : bool
+            See `load_all`. The default is False.
+        hitless : bool
+            See `load_all`. The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        segment_capacity_samples = get_segment_capacity_samples(self.get_memory_samples(),self.number_of_segments,self.lNumChannels.value)
+        for segment_index,data in enumerate(segment_data):
+            if data.size//self.lNumChannels.value > segment_capacity_samples:
+                logging.error('Compiled segment {} is longer than the {} samples '
+                              'that fit in each of the {} segments of the card '
+                              'memory. Cancelling data transfer.'.format(segment_index,segment_capacity_samples,self.number_of_segments))
+                return
+        segment_keys = [None if key is None else tuple(key) for key in segment_keys]
+        transfer_indices, current_segment, running = self._plan_segment_upload(segment_keys,hitless)
+        
+        def prepare(segment_index,slot):
+            data = segment_data[segment_index]
+            staging_buffer = self.get_staging_buffer(data.size,slot=slot)
+            np.copyto(staging_buffer,data)
+            return staging_buffer
+        self._upload_segments(transfer_indices,prepare,segment_keys,None,running,current_segment)
+        self._update_steps(steps,current_segment,restart,hitless)
+    
+    def _plan_segment_upload(self,segment_keys,hitless):
+        """Reads the playback state of the card and maps the logical segments 
+        onto physical segments for `load_all` and `load_compiled`.
+
+        Returns
+        -------
+        transfer_indices : list of int
+            The logical segments that need to be transferred.
+        current_segment : int
+            The physical segment the card was playing.
+        running : bool
+            Whether the card was running.
+
+        """
+        current_step, current_segment, running = self.get_playback_state(max_age_s=0) # always read the card, an old monitor sample could miss the card moving onto a segment that is then overwritten
+        
+        # Segments that the card might still be playing are not overwritten 
+        # in a hitless update. Segments retired by an earlier update are 
+        # released once the card has moved on from the step that used them.
+        self.retired_segments = {physical_segment:step_index for physical_segment,step_index 
+                                 in self.retired_segments.items() if step_index == current_step}
+        if hitless and running:
+            avoid_segments = {current_segment} | set(self.retired_segments)
+        else:
+            avoid_segments = set()
+        
+        transfer_indices = self._update_segment_map(segment_keys,avoid_segments)
+        return transfer_indices, current_segment, running
+    
+    def _upload_segments(self,transfer_indices,prepare,segment_keys,segments,running,current_segment):
+        """Transfers segments to the card in a pipeline: segment k+1 is 
+        prepared in the other staging slot whilst the DMA for segment k is 
+        in flight.
+
+        Parameters
+        ----------
+        transfer_indices : list of int
+            The logical segments to transfer.
+        prepare : callable
+            Called as prepare(segment_index, slot) to write the int16 data 
+            of a segment into the staging buffer of that slot. It returns 
+            the staged data.
+        segment_keys : list of tuple or None
+            The key of every logical segment.
+        segments : list of list of ActionContainer or None
+            The actions of every logical segment, which are marked as 
+            transferred. None if there are no actions.
+        running : bool
+            Whether the card was running when the upload was planned.
+        current_segment : int
+            The physical segment the card was playing.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.upload_timings = []
+        in_flight = None
+        t_upload = time.perf_counter()
+        for k,segment_index in enumerate(transfer_indices):
+            physical_segment = self.segment_map[segment_index]
+            t_start = time.perf_counter()
+            segment_data = prepare(segment_index,k%2)
+            timings = {'segment':segment_index, 'physical_segment':physical_segment, 
+                       'samples':segment_data.size, 'prepare_s':time.perf_counter()-t_start}
             
-        for step_index,step in enumerate(steps):
-            if step_index == len(steps)-1:
-                next_step_index = 0
-            else:
-                next_step_index = step_index + 1
-            self._set_step(step_index,**step,next_step_index=next_step_index)
+            if in_flight is not None:
+                self._finish_pipelined_transfer(*in_flight)
             
-        self.start()
+            if running and ((physical_segment == current_segment) or (physical_segment in self.retired_segments)):
+                logging.warning('The physical segment {} that the card might '
+                                'be playing needs to transfer. The card will '
+                                'be stopped to transfer this '
+                                'data.'.format(physical_segment))
+                self.stop()
+            timings['transfer_start'] = time.perf_counter()
+            self._start_transfer(physical_segment,segment_data)
+            segment = [] if segments is None else segments[segment_index]
+            in_flight = (segment,segment_keys[segment_index],timings)
+        if in_flight is not None:
+            self._finish_pipelined_transfer(*in_flight)
+        
+        if self.upload_timings:
+            logging.info('Uploaded {} segments in {:.3f} s ({:.3f} s '
+                         'preparing, {:.3f} s waiting for DMA).'.format(
+                             len(self.upload_timings),
+                             time.perf_counter()-t_upload,
+                             sum(t['prepare_s'] for t in self.upload_timings),
+                             sum(t['wait_s'] for t in self.upload_timings)))
+    
+    def _update_steps(self,steps,current_segment,restart,hitless):
+        """Writes the steps that have changed to the card, pointing them at 
+        the physical segments in `segment_map`, and (re)starts the card if 
+        needed (see `load_all`).
+
+        Returns
+        -------
+        None.
+
+        """
+        next_step_indices = list(range(1,len(steps))) + [0]
+        physical_steps = [{**step,'segment':self.get_physical_segment(step['segment'])} for step in steps]
+        step_values, valid = self._encode_steps(physical_steps,next_step_indices)
+        
+        # The card can keep playing if the step it is currently on is not 
+        # changed, or in a hitless update if that step is only re-pointed to 
+        # new data. Steps are only written if they differ from the shadow.
+        current_step, _ = self.get_current_step_segment(physical=True)
+        changed_steps = self._get_changed_steps(step_values,valid)
+        if (restart or (not self.is_running()) or 
+            ((current_step in changed_steps) and not (hitless and self._is_repointed(current_step,step_values)))):
+            self._write_steps(step_values,changed_steps)
+            self.retired_segments = {}
+            self.start()
+        else:
+            self._write_steps(step_values,changed_steps)
+            if current_segment not in self.segment_map.values():
+                self.retired_segments[current_segment] = current_step
+            logging.info('Updated {} steps without stopping the card.'.format(len(changed_steps)))
+    
+    def get_segment_key(self,segment):
+        """Returns a key identifying the data that a segment would write to 
+        the card. Segments with the same key have identical card data.
+
+        Parameters
+        ----------
+        segment : list of ActionContainer
+            The actions in the segment, one for each channel.
+
+        Returns
+        -------
+        tuple or None
+            The key of the segment. None is returned for rearrangement 
+            segments because their data is changed during runtime.
+
+        """
+        if any([action.rearr for action in segment]):
+            return None
+        return (self.lNumChannels.value,self.max_output_mV,
+                *[action.get_data_hash() for action in segment])
+    
+    def _update_segment_map(self,segment_keys,avoid_segments=set()):
+        """Maps the logical segments onto physical segments of the card, 
+        reusing physical segments that already contain the same data.
+        
+        Logical segments with the same key share a physical segment, so 
+        duplicate segments are only stored and transferred once. Logical 
+        segments whose data is not on the card are placed in the physical 
+        segment of the same index if it is not needed by another segment, 
+        otherwise in the first free physical segment.
+
+        Parameters
+        ----------
+        segment_keys : list of tuple or None
+            The keys returned by `get_segment_key` for every logical segment.
+        avoid_segments : set of int
+            Physical segments that should not be overwritten, such as the 
+            segment the card is currently playing. These are only used if 
+            there is no other free physical segment. The default is set().
+
+        Returns
+        -------
+        list of int
+            The indices of the logical segments that need to be transferred 
+            to their physical segments. Logical segments that do not fit on 
+            the card are left out of `segment_map`.
+
+        """
+        self.segment_map = {}
+        for segment_index,key in enumerate(segment_keys):
+            if key is None:
+                continue
+            try:
+                self.segment_map[segment_index] = self.segment_hashes.index(key)
+            except ValueError:
+                continue
+        
+        transfer_indices = []
+        transferred_keys = {} # key : logical segment transferred in this update
+        for segment_index,key in enumerate(segment_keys):
+            if segment_index in self.segment_map:
+                continue
+            if key in transferred_keys:
+                self.segment_map[segment_index] = self.segment_map[transferred_keys[key]]
+                continue
+            used_segments = set(self.segment_map.values())
+            unused_segments = set(range(self.number_of_segments)) - used_segments
+            free_segments = unused_segments - set(avoid_segments)
+            if segment_index in free_segments:
+                physical_segment = segment_index
+            elif free_segments:
+                physical_segment = min(free_segments)
+            elif unused_segments:
+                physical_segment = min(unused_segments)
+            else:
+                logging.error('{} distinct segments were requested but the card '
+                              'memory is only divided into {} segments. Segment '
+                              '{} and later new segments will not be '
+                              'transferred.'.format(len(set(segment_keys)),self.number_of_segments,segment_index))
+                break
+            self.segment_map[segment_index] = physical_segment
+            transfer_indices.append(segment_index)
+            if key is not None:
+                transferred_keys[key] = segment_index
+        
+        # Data in physical segments that are not used can be kept in case it 
+        # is needed again, but segments about to be overwritten are forgotten 
+        # now in case the transfer fails.
+        for segment_index in transfer_indices:
+            self.segment_hashes[self.segment_map[segment_index]] = None
+        return transfer_indices
+    
+    def get_physical_segment(self,segment_index):
+        """Returns the physical card segment that a logical segment from the 
+        `MainWindow` is stored in.
+
+        Parameters
+        ----------
+        segment_index : int
+            The index of the logical segment.
+
+        Returns
+        -------
+        int
+            The index of the physical segment. If the logical segment has not 
+            been loaded yet, the same index is returned.
+
+        """
+        return self.segment_map.get(segment_index,segment_index)
         
-    def get_current_step_segment(self):
+    def get_current_step_segment(self,physical=False):
         """Returns the current step and segment that the AWG card is on.
         
+        Parameters
+        ----------
+        physical : bool
+            If True the physical segment index on the card is returned, 
+            otherwise the index of the (first) logical segment stored in it is 
+            returned. The default is False.
+        
         Returns
         -------
         int
             The index of the current step being replayed by the card.
+        int
+            The index of the segment being replayed by the card.
 
         """
         current_step = int64(0)
-        spcm_dwGetParam_i64(self.hCard, SPC_SEQMODE_STATUS, byref(current_step))
-
         step_data = int64(0)
-        spcm_dwGetParam_i64(self.hCard,SPC_SEQMODE_STEPMEM0 + current_step.value, byref(step_data))
-        current_segment = int('1'*4,2) & step_data.value
+        with self.driver_lock:
+            spcm_dwGetParam_i64(self.hCard, SPC_SEQMODE_STATUS, byref(current_step))
+            spcm_dwGetParam_i64(self.hCard,SPC_SEQMODE_STEPMEM0 + current_step.value, byref(step_data))
+        current_segment = SPCSEQ_SEGMENTMASK & step_data.value
+        
+        if not physical:
+            for segment_index,physical_segment in self.segment_map.items():
+                if physical_segment == current_segment:
+                    current_segment = segment_index
+                    break
         
         return current_step.value, current_segment
     
+    def get_playback_state(self,max_age_s=None):
+        """Returns the current step, physical segment and running state of 
+        the card. If a `CardMonitor` is running and its latest sample is 
+        recent enough this is returned without accessing the card, 
+        otherwise the registers are read. Use `max_age_s=0` when the result
+        decides which segments are safe to overwrite.
+
+        Parameters
+        ----------
+        max_age_s : float or None
+            The oldest monitor sample that can be used. If None, samples up 
+            to two poll intervals old are used. The default is None.
+
+        Returns
+        -------
+        int
+            The index of the current step being replayed by the card.
+        int
+            The index of the physical segment being replayed by the card.
+        bool
+            Whether the card is running.
+
+        """
+        monitor = self.monitor
+        if (monitor is not None) and monitor.is_alive():
+            state = monitor.state
+            if max_age_s is None:
+                max_age_s = 2*monitor.poll_interval_s
+            if (state is not None) and (time.perf_counter() - state['timestamp'] <= max_age_s):
+                return state['step'], state['segment'], state['running']
+        current_step, current_segment = self.get_current_step_segment(physical=True)
+        return current_step, current_segment, self.is_running()
+    
+    def get_memory_samples(self):
+        """Returns the total sample memory installed on the card, which is 
+        shared between the segments and active channels.
+        
+        Returns
+        -------
+        int
+            The number of samples that can be stored on the card.
+
+        """
+        llMemSize = int64(0)
+        spcm_dwGetParam_i64(self.hCard, SPC_PCIMEMSIZE, byref(llMemSize))
+        return llMemSize.value//self.lBytesPerSample.value
+    
     def get_min_segment_size(self):
         """Returns the minimum segment size available for this card.
         
@@ -407,14 +872,23 @@ class AWG():
         else:
             raise ValueError(f'Number of active channels should be 1, 2, or 4 but is {active_channels}.')
             
-    def multiplex(self,arrays):
+    def multiplex(self,arrays,out=None):
         """Converts a list of np.ndarrays in the form of [a,a,,...], 
         [b,b,,...] into a multiplexed sequence [a,b,a,b,...].
         
+        Each channel is copied straight into a strided view of the output 
+        (see `get_channel_views`) so no intermediate array is created.
+        
         Parameters
         ----------
         arrays : list of np.ndarrays
-            The arrays to multiplex together.
+            The arrays to multiplex together. These must all be the same 
+            length.
+        out : np.ndarray or None
+            The array to write the multiplexed data into, for example a view 
+            returned by `get_staging_buffer`. Data is cast to the dtype of 
+            `out`. If None, a new array with the dtype of the first array is 
+            allocated. The default is None.
         
         Returns
         -------
@@ -422,19 +896,43 @@ class AWG():
             The multiplexed arrays.
             
         """
-        # logging.debug('Multiplexing data.')
-        # l = len(arrays)
-        # c = np.empty((len(arrays[0]) * l,), dtype=arrays[0].dtype)
-        # for x in range(l):
-        #     c[x::l] = arrays[x]
-        # return c
-        return np.ravel(arrays,'F')
+        if out is None:
+            out = np.empty(sum(array.size for array in arrays),dtype=arrays[0].dtype)
+        for channel_view,array in zip(self.get_channel_views(out,len(arrays)),arrays):
+            np.copyto(channel_view,array,casting='unsafe')
+        return out
+    
+    def get_channel_views(self,segment_data,num_channels=None):
+        """Returns strided views of each channel in multiplexed data. Writing 
+        into a view writes the interleaved samples of that channel in place.
+
+        Parameters
+        ----------
+        segment_data : np.ndarray
+            The multiplexed data, e.g. a view returned by 
+            `get_staging_buffer`.
+        num_channels : int or None
+            The number of interleaved channels. If None, the number of active 
+            channels of the card is used. The default is None.
+
+        Returns
+        -------
+        list of np.ndarray
+            The view of each channel.
+
+        """
+        if num_channels is None:
+            num_channels = self.lNumChannels.value
+        return [segment_data[channel::num_channels] for channel in range(num_channels)]
         
     def _set_segment(self,segment_index,segment_data):
         """
         This method is responsible for sending the data to the card to be 
         played. Data will be converted to the required signed integer format.
         
+        The int16 data is written straight into a DMA staging buffer so that 
+        no further copy is needed before the transfer.
+        
         Parameters
         ----------
         segment_index : int
@@ -452,21 +950,35 @@ class AWG():
         """
 
         logging.debug('Preparing and transferring segment {}.'.format(segment_index))
-        segment_data = self.prepare_segment_data(segment_data)
+        staging_buffer = self.get_staging_buffer(segment_data.size)
+        segment_data = self.prepare_segment_data(segment_data,out=staging_buffer,segment_index=segment_index)
         self.transfer_segment_data(segment_index,segment_data)
 
-    def prepare_segment_data(self,segment_data):
+    def prepare_segment_data(self,segment_data,out=None,segment_index=None):
         """Prepares the segment data to be transferred to the card. 
         This function convert the amplitudes in mV to the int16 format 
-        required by the card. Data is assumed to already have been 
-        multiplexed if required.
+        required by the card. Data can either be already multiplexed or a 
+        list of the data for each channel, which is multiplexed as it is 
+        converted.
+        
+        This is a wrapper around `quantise_segment_data` using the 
+        'rescale' policy that logs a warning if any of the data had to be 
+        rescaled.
 
         Parameters
         ----------
-        segment_data : numpy.ndarray of float
-            The data to write in the segment. This should already be 
-            multiplexed if using more than one channel. The data should be 
+        segment_data : numpy.ndarray of float or list of numpy.ndarray
+            The data to write in the segment, either already multiplexed or 
+            as a list with the data for each channel. The data should be 
             floats with the value of the data in mV.
+        out : numpy.ndarray of int16 or None
+            The array to write the int16 data into, typically a view 
+            returned by `get_staging_buffer`. If None, a new array is 
+            allocated. The default is None.
+        segment_index : int or None
+            If not None, the statistics returned by `quantise_segment_data` 
+            are saved in `quantisation_stats` under this segment index. The 
+            default is None.
 
         Returns
         -------
@@ -475,17 +987,213 @@ class AWG():
             format and capped at the amplitude limit of the AWG if 
             needed.
         """
-        segment_data /= self.max_output_mV
+        out, stats = self.quantise_segment_data(segment_data,out=out,overrange='rescale')
+        if segment_index is not None:
+            self.quantisation_stats[segment_index] = stats
+        if stats['overrange_samples']:
+            logging.warning('{} samples were larger than the '
+                            'maximum amplitude of +/-{} mV (peak {:.1f} mV). '
+                            'This data has been rescaled to stay within the '
+                            'bounds.'.format(stats['overrange_samples'],
+                                             self.max_output_mV,stats['peak_mV']))
+        return out
+    
+    def quantise_segment_data(self,segment_data,out=None,overrange='rescale'):
+        """Converts segment data in mV to the int16 format required by the 
+        card and checks it is within the amplitude limit of the card.
+        
+        The data is processed in cache-sized chunks: each chunk is scaled, 
+        range checked, clipped and converted to int16 in one pass without 
+        allocating any arrays the size of the segment. If a list of channel 
+        data is given, each channel is written directly into its strided 
+        view of `out` so the data is multiplexed without an extra copy. The 
+        input data is not modified. If data is over range and the 'rescale' policy is 
+        used a second pass is needed, because the peak of the whole segment 
+        must be known before it can be rescaled.
+        
+        Values are converted by truncating towards zero. Data at exactly the 
+        maximum amplitude is mapped to the largest int16 value rather than 
+        overflowing.
+
+        Parameters
+        ----------
+        segment_data : numpy.ndarray of float or list of numpy.ndarray
+            The data to convert, either already multiplexed or as a list 
+            with the data for each channel (which must all be the same 
+            length). The data should be floats with the value of the data in 
+            mV.
+        out : numpy.ndarray of int16 or None
+            The array to write the int16 data into, typically a view 
+            returned by `get_staging_buffer`. If None, a new array is 
+            allocated. The default is None.
+        overrange : {'rescale','clip'}
+            What to do if some data is larger than the maximum amplitude of 
+            the card. 'rescale' scales the whole segment so that the peak is 
+            at the maximum amplitude whereas 'clip' only clips the samples 
+            that are over range. The default is 'rescale'.
+
+        Returns
+        -------
+        out : numpy.ndarray of int16
+            The converted data.
+        stats : dict
+            Statistics about the conversion with the keys
+            'samples' : the number of samples converted,
+            'overrange_samples' : the number of samples that were larger 
+            than the maximum amplitude,
+            'peak_mV' : the largest absolute value of the input data, 
+            'scale' : the factor the data was rescaled by (1 unless the 
+            data was rescaled).
+
+        """
+        if overrange not in ['rescale','clip']:
+            raise ValueError("overrange must be 'rescale' or 'clip' but is '{}'.".format(overrange))
+        
+        if isinstance(segment_data,(list,tuple)):
+            channel_data = [np.ravel(data) for data in segment_data]
+        else:
+            channel_data = [np.ravel(segment_data)]
+        num_samples = sum(data.size for data in channel_data)
+        if out is None:
+            out = np.empty(num_samples,dtype=np.int16)
+        channel_outs = self.get_channel_views(out,len(channel_data))
+        
+        full_scale = 2**15
+        conversion = full_scale/self.max_output_mV
+        peak = 0
+        overrange_samples = 0
+        for data,channel_out in zip(channel_data,channel_outs):
+            channel_peak, channel_overrange_samples = self._quantise_chunks(data,channel_out,conversion)
+            peak = max(peak,channel_peak)
+            overrange_samples += channel_overrange_samples
+        peak_mV = peak/conversion
+        
+        scale = 1
+        if overrange_samples and (overrange == 'rescale'):
+            scale = self.max_output_mV/peak_mV
+            for data,channel_out in zip(channel_data,channel_outs):
+                self._quantise_chunks(data,channel_out,conversion*scale)
+        
+        stats = {'samples' : num_samples,
+                 'overrange_samples' : overrange_samples,
+                 'peak_mV' : peak_mV,
+                 'scale' : scale}
+        return out, stats
+    
+    def _quantise_chunks(self,segment_data,out,conversion):
+        """Scales 1D data by `conversion`, clips it to the int16 range and 
+        writes it into `out` (which may be a strided channel view), one chunk 
+        at a time.
+        
+        Returns
+        -------
+        peak : float
+            The largest absolute value of the scaled data before clipping.
+        overrange_samples : int
+            The number of scaled samples outside of +/-2**15.
+
+        """
+        full_scale = 2**15
+        scratch = np.empty(min(quantisation_chunk_samples,segment_data.size),dtype=np.float64)
+        peak = 0
+        overrange_samples = 0
+        for chunk_start in range(0,segment_data.size,quantisation_chunk_samples):
+            chunk = segment_data[chunk_start:chunk_start+quantisation_chunk_samples]
+            scaled = scratch[:chunk.size]
+            np.multiply(chunk,conversion,out=scaled)
+            chunk_max = scaled.max()
+            chunk_min = scaled.min()
+            peak = max(peak,chunk_max,-chunk_min)
+            if (chunk_max > full_scale) or (chunk_min < -full_scale):
+                overrange_samples += int(np.count_nonzero(np.abs(scaled) > full_scale))
+            np.clip(scaled,-full_scale,full_scale-1,out=scaled)
+            np.copyto(out[chunk_start:chunk_start+chunk.size],scaled,casting='unsafe') # truncates towards zero like np.int16()
+        return float(peak), overrange_samples
+
+    def get_staging_buffer(self,num_samples,slot=0):
+        """Returns an int16 view of a persistent page-aligned staging buffer 
+        that can be DMA'd to the card without any further copy. Data should 
+        be written into the returned array in place (e.g. with the `out` 
+        kwarg of numpy functions).
         
-        if any(segment_data > 1) or any(segment_data < -1):
-            logging.warning('Some of the data was larger than the '
-                            'maximum amplitude of +/-{} mV. This data '
-                            'has been rescaled to stay within the '
-                            'bounds.'.format(self.max_output_mV))
-            # segment_data = segment_data.clip(max=1, min=-1)
-            segment_data /= max(segment_data)
-        segment_data = np.int16(segment_data*2**15)
-        return segment_data
+        The buffer for a slot is only reallocated when a larger buffer than 
+        has previously been requested is needed. This invalidates views of 
+        that slot that were returned previously.
+
+        Parameters
+        ----------
+        num_samples : int
+            The number of int16 samples (summed over all channels) required.
+        slot : int
+            The staging slot to use. Different slots are independent 
+            buffers so that one can be filled whilst another is being 
+            transferred. The default is 0.
+
+        Returns
+        -------
+        numpy.ndarray of int16
+            A view of the first `num_samples` samples of the staging buffer.
+
+        """
+        num_samples = int(num_samples)
+        try:
+            buffer = self.staging_buffers[slot]
+        except KeyError:
+            buffer = None
+        if (buffer is None) or (buffer.size < num_samples):
+            buffer = self._allocate_staging_buffer(num_samples,slot)
+            self.staging_buffers[slot] = buffer
+        return buffer[:num_samples]
+
+    def _allocate_staging_buffer(self,num_samples,slot):
+        """Allocates a page-aligned buffer for a staging slot. Slot 0 uses 
+        the continuous buffer reserved by the driver if this is large 
+        enough, otherwise the memory is allocated by this program.
+
+        Parameters
+        ----------
+        num_samples : int
+            The minimum number of int16 samples the buffer must hold.
+        slot : int
+            The staging slot the buffer is for.
+
+        Returns
+        -------
+        numpy.ndarray of int16
+            The complete buffer, which will be at least `num_samples` long.
+
+        """
+        qwBufferSize = -(-num_samples*self.lBytesPerSample.value//page_size_bytes)*page_size_bytes # round up to a whole page
+        
+        if (slot == 0) and (self.qwContBufLen.value >= qwBufferSize):
+            logging.debug('Using continuous buffer for staging slot {}.'.format(slot))
+            pnBuffer = cast(self.pvContBuf, ptr16)
+            return np.ctypeslib.as_array(pnBuffer,shape=(self.qwContBufLen.value//self.lBytesPerSample.value,))
+        
+        logging.debug('Allocating {} byte staging buffer for slot {}.'.format(qwBufferSize,slot))
+        pvBuffer = pvAllocMemPageAligned(qwBufferSize)
+        return np.frombuffer(pvBuffer,dtype=np.int16) # the array keeps a reference to pvBuffer so the memory stays allocated
+
+    def is_staged(self,segment_data):
+        """Returns whether an array can be DMA'd to the card directly 
+        without first being copied into a staging buffer. This is the case 
+        for contiguous int16 data that starts on a page boundary, such as 
+        views returned by `get_staging_buffer`.
+        
+        Parameters
+        ----------
+        segment_data : numpy.ndarray
+            The array to check.
+
+        Returns
+        -------
+        bool
+            Whether the array can be used as a DMA buffer.
+
+        """
+        return ((segment_data.dtype == np.int16) and 
+                (segment_data.flags['C_CONTIGUOUS']) and
+                (segment_data.ctypes.data % page_size_bytes == 0))
 
     def transfer_segment_data(self,segment_index,segment_data):
         """Transfers the preprepared segment data to the card. This is 
@@ -495,10 +1203,16 @@ class AWG():
         and it should already be in multiplexed int16 format. As few
         checks as possible are performed before data is transferred.
         
+        If the data is already in a staging buffer (see `is_staged`) it is 
+        transferred to the card directly, otherwise it is first copied into 
+        the slot 0 staging buffer.
+        
         Parameters
         ----------
         segment_index : int
-            The index of the segment to write the data to.
+            The index of the physical segment to write the data to. Use 
+            `get_physical_segment` to find the physical segment that a 
+            logical segment from the `MainWindow` is stored in.
             
         segment_data : numpy.ndarray of int16
             The data to write in the segment. This should already be 
@@ -509,54 +1223,190 @@ class AWG():
         -------
         None.
         """
-        dwSegmentLenSample = len(segment_data)
+        self.segment_hashes[segment_index] = None # data from outside load_all is not registered
+        dwError = self._start_transfer(segment_index,segment_data,wait=True)
+        if dwError != ERR_OK:
+            logging.error('Failed to transfer data to card for segment {}'.format(segment_index))
         
-        # Set the segment number to edit and the segment size
-        spcm_dwSetParam_i32(self.hCard, SPC_SEQMODE_WRITESEGMENT, segment_index)
-        spcm_dwSetParam_i32 (self.hCard, SPC_SEQMODE_SEGMENTSIZE,  int(dwSegmentLenSample/self.lNumChannels.value))
-            
-        # Write data to board (main) sample memory (manual p. 78). Most of the following code comes from the old AWG code.
-        qwBufferSize = uint64(dwSegmentLenSample * self.lBytesPerSample.value)
+    def _start_transfer(self,segment_index,segment_data,wait=False):
+        """Starts the DMA of int16 segment data to the card without waiting 
+        for it to finish. `_wait_transfer` must be called before another 
+        transfer is started, and the buffer must not be modified until then.
         
-        # We try to use continuous memory if available and big enough
-        pvBuffer = c_void_p() ## creates a void pointer -to be changed later.
-        qwContBufLen = uint64(0)
+        If the data is not already in a staging buffer (see `is_staged`) it 
+        is first copied into the slot 0 staging buffer.
         
+        The ctypes arguments for the transfer are cached in a transfer 
+        context (see `_get_transfer_context`) and the segment registers are 
+        only written if they have changed, so repeated transfers of the same 
+        buffer to the same segment (such as rearrangement uploads) only make 
+        the driver calls that define and start the DMA.
+
+        Parameters
+        ----------
+        segment_index : int
+            The index of the segment to write the data to.
+        segment_data : numpy.ndarray of int16
+            The multiplexed int16 data to write in the segment.
+        wait : bool
+            If True, the card waits for the DMA to finish in the same driver 
+            call that starts it and `_wait_transfer` does not need to be 
+            called. The default is False.
+
+        Returns
+        -------
+        dwError : int
+            The error code returned by the card when starting the DMA.
+
         """
-        The important part here is that we use byref(pvBuffer), meaning that
-        you send to the card the POINTER to the POINTER of pvBuffer. So even
-        if the memory spot of pvBuffer changes, that should not be an issue.
-        """
+        if not self.is_staged(segment_data):
+            staging_buffer = self.get_staging_buffer(segment_data.size)
+            np.copyto(staging_buffer,segment_data,casting='unsafe')
+            segment_data = staging_buffer
         
-        spcm_dwGetContBuf_i64 (self.hCard, SPCM_BUF_DATA, byref(pvBuffer), byref(qwContBufLen)) #assigns the pvBuffer the address of the memory block and qwContBufLen the size of the memory.
-        if qwContBufLen.value >= qwBufferSize.value:
-            logging.debug("Using continuous buffer")
-        else:
-            """
-            You can use the following line to understand what is happening in pvBuffer after pvAllocMempageAligned.
-            list(map(ord,pvBuffer.raw.decode('utf-8')))
-            Effectively what you do is to allocate the memory needed (as a multiple of 4kB) and initialised it.
-            """
-            pvBuffer = pvAllocMemPageAligned(qwBufferSize.value) 
-            
-            # logging.debug("Using buffer allocated by user program")
+        lSegmentSize, pvBuffer, qwBufferSize = self._get_transfer_context(segment_data.ctypes.data,segment_data.size)
         
-        # Takes the void pointer to a int16 POINTER type.
-        # This only changes the way that the program reads that memory spot.
-        pnBuffer = cast(pvBuffer, ptr16)
-
-        lib = ctypes.cdll.LoadLibrary(main_directory+r"\awg\memCopier\bin\Debug\memCopier.dll")
-        lib.memCopier(pvBuffer,np.ctypeslib.as_ctypes(segment_data),int(dwSegmentLenSample))
+        with self.driver_lock:
+            # Set the segment number to edit and the segment size
+            self._set_register(SPC_SEQMODE_WRITESEGMENT, segment_index)
+            self._set_register(SPC_SEQMODE_SEGMENTSIZE, lSegmentSize, 
+                               shadow_key=(SPC_SEQMODE_SEGMENTSIZE,segment_index)) # the size is stored separately for each segment
+                
+            # Write data to board (main) sample memory (manual p. 78).
+            spcm_dwDefTransfer_i64(self.hCard, SPCM_BUF_DATA, SPCM_DIR_PCTOCARD, self.dwNotifySize, pvBuffer, 0, qwBufferSize)
+            if wait:
+                dwError = spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_DATA_STARTDMA | M2CMD_DATA_WAITDMA)
+            else:
+                dwError = spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_DATA_STARTDMA)
         
-        dwNotifySize = uint32(0)
-        spcm_dwDefTransfer_i64(self.hCard, SPCM_BUF_DATA, SPCM_DIR_PCTOCARD, dwNotifySize, pvBuffer, 0, qwBufferSize)
-        dwError = spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_DATA_STARTDMA | M2CMD_DATA_WAITDMA)
+        if dwError != ERR_OK:
+            logging.error('Failed to start transfer of data to card for segment {}'.format(segment_index))
+        return dwError
+    
+    def _get_transfer_context(self,address,num_samples):
+        """Returns the arguments needed to DMA a buffer to the card, creating 
+        and caching the ctypes objects the first time a buffer is used.
+
+        Parameters
+        ----------
+        address : int
+            The address of the first sample of the buffer.
+        num_samples : int
+            The number of int16 samples (summed over all channels) to transfer.
+
+        Returns
+        -------
+        lSegmentSize : int
+            The segment size (samples per channel) to set on the card.
+        pvBuffer : ctypes.c_void_p
+            Pointer to the buffer.
+        qwBufferSize : ctypes.c_uint64
+            The number of bytes to transfer.
+
+        """
+        key = (address,num_samples)
+        try:
+            return self.transfer_contexts[key]
+        except KeyError:
+            pass
+        if len(self.transfer_contexts) >= 256: # buffers are reused so this is only reached if many temporary buffers are transferred
+            self.transfer_contexts = {}
+        context = (int(num_samples//self.lNumChannels.value),
+                   c_void_p(address),
+                   uint64(num_samples * self.lBytesPerSample.value))
+        self.transfer_contexts[key] = context
+        return context
+    
+    def _set_register(self,lReg,value,shadow_key=None):
+        """Writes a value to a card register unless the value last written 
+        to that register (stored in `register_shadow`) is the same. This 
+        must only be used for registers that are not changed by the card 
+        itself, and not for commands.
+
+        Parameters
+        ----------
+        lReg : int
+            The register to write to.
+        value : int
+            The value to write.
+        shadow_key : hashable or None
+            The key to store the value under in `register_shadow`. This must 
+            be given for registers whose value depends on another register, 
+            e.g. SPC_SEQMODE_SEGMENTSIZE applies to the segment selected by 
+            SPC_SEQMODE_WRITESEGMENT. If None (the default), `lReg` is used.
 
+        Returns
+        -------
+        dwError : int
+            The error code returned by the card, or ERR_OK if the write was 
+            skipped.
+
+        """
+        if shadow_key is None:
+            shadow_key = lReg
+        if self.register_shadow.get(shadow_key) == value:
+            return ERR_OK
+        dwError = spcm_dwSetParam_i64(self.hCard, lReg, int64(value))
+        if dwError == ERR_OK:
+            self.register_shadow[shadow_key] = value
+        else:
+            self.register_shadow.pop(shadow_key,None)
+        return dwError
+    
+    def _wait_transfer(self,segment_index):
+        """Blocks until the DMA started by `_start_transfer` has finished.
+
+        Parameters
+        ----------
+        segment_index : int
+            The index of the segment being transferred. Only used for logging.
+
+        Returns
+        -------
+        dwError : int
+            The error code returned by the card when waiting for the DMA.
+
+        """
+        with self.driver_lock:
+            dwError = spcm_dwSetParam_i32(self.hCard, SPC_M2CMD, M2CMD_DATA_WAITDMA)
+        
         if dwError != ERR_OK:
             logging.error('Failed to transfer data to card for segment {}'.format(segment_index))
         else:
-            logging.debug('{} samples transferred to segment {}.'.format(dwSegmentLenSample,segment_index))
-            # print(segment_data)
+            logging.debug('Finished transfer to segment {}.'.format(segment_index))
+        return dwError
+    
+    def _finish_pipelined_transfer(self,segment,segment_key,timings):
+        """Waits for a transfer started by the `load_all` pipeline, then 
+        marks the actions as transferred, registers the data in 
+        `segment_hashes` and records the timings.
+
+        Parameters
+        ----------
+        segment : list of ActionContainer
+            The actions of the segment being transferred.
+        segment_key : tuple or None
+            The key of the segment returned by `get_segment_key`.
+        timings : dict
+            The timings of this segment recorded so far. The 'transfer_s' 
+            and 'wait_s' keys are added and the dict is appended to 
+            `upload_timings`.
+
+        Returns
+        -------
+        None.
+
+        """
+        t_wait = time.perf_counter()
+        dwError = self._wait_transfer(timings['physical_segment'])
+        t_end = time.perf_counter()
+        timings['wait_s'] = t_end - t_wait
+        timings['transfer_s'] = t_end - timings.pop('transfer_start')
+        self.upload_timings.append(timings)
+        if dwError == ERR_OK:
+            self.segment_hashes[timings['physical_segment']] = segment_key
+        for action in segment:
+            action.needs_to_transfer = False
         
     def _set_step(self,step_index,segment,number_of_loops,after_step,next_step_index,**kwargs):
         """
@@ -586,8 +1436,8 @@ class AWG():
 
         """
         
-        max_steps = 4096
-        if step_index > max_steps:
+        max_steps = max_card_steps
+        if step_index >= max_steps:
             logging.error('Requested step_index {} is larger than the maximum '
                           'number of steps ({}). Cancelling step '
                           'modification.'.format(step_index,max_steps))
@@ -608,7 +1458,7 @@ class AWG():
                           ''.format(step_index,max_loops))
             return
         
-        if next_step_index > max_steps:
+        if next_step_index >= max_steps:
             logging.error('Step {} is invalid. '
                           'Requested next_step_index {} is larger than the  '
                           'maximum number of steps ({}). Cancelling step '
@@ -628,8 +1478,95 @@ class AWG():
             
         logging.debug('Setting step {} to segment {}.'.format(step_index,segment))
         
-        llvals=int64((llCondition<<32) | (number_of_loops<<32) | (next_step_index<<16) | segment)
-        spcm_dwSetParam_i64(self.hCard,SPC_SEQMODE_STEPMEM0 + step_index,llvals)
+        llvals = (llCondition<<32) | (number_of_loops<<32) | (next_step_index<<16) | segment
+        if self.step_shadow[step_index] != llvals:
+            with self.driver_lock:
+                spcm_dwSetParam_i64(self.hCard,SPC_SEQMODE_STEPMEM0 + step_index,int64(llvals))
+                self.step_shadow[step_index] = llvals
+    
+    def _encode_steps(self,steps,next_step_indices):
+        """Validates a list of steps and converts them to the values to write 
+        to the step memory of the card. This is the vectorised equivalent of 
+        the checks in `_set_step`.
+
+        Parameters
+        ----------
+        steps : list of dict
+            The steps to encode, with the keys 'segment' (physical segment 
+            index), 'number_of_loops' and 'after_step'.
+        next_step_indices : list of int
+            The next step to play after each step.
+
+        Returns
+        -------
+        step_values : numpy.ndarray of int64
+            The value to write to SPC_SEQMODE_STEPMEM0 + i for each step.
+        valid : numpy.ndarray of bool
+            Whether each step is valid. Invalid steps are logged and should 
+            not be written to the card.
+
+        """
+        conditions = {'loop_until_trigger':SPCSEQ_ENDLOOPONTRIG,
+                      'continue':SPCSEQ_ENDLOOPALWAYS}
+        max_loops = 1048575
+        
+        segments = np.array([step['segment'] for step in steps],dtype=np.int64)
+        loops = np.array([step['number_of_loops'] for step in steps],dtype=np.int64)
+        llConditions = np.array([conditions.get(step['after_step'],-1) for step in steps],dtype=np.int64)
+        next_step_indices = np.array(next_step_indices,dtype=np.int64)
+        
+        valid = ((segments >= 0) & (segments < self.number_of_segments) &
+                 (loops > 0) & (loops < max_loops) & (llConditions >= 0) &
+                 (next_step_indices < max_card_steps) &
+                 (np.arange(len(steps)) < max_card_steps))
+        for step_index in np.flatnonzero(~valid):
+            logging.error('Step {} is invalid (segment {}, number_of_loops {}, '
+                          "after_step '{}', next_step_index {}). Cancelling "
+                          'step modification.'.format(step_index,segments[step_index],
+                                                      loops[step_index],steps[step_index]['after_step'],
+                                                      next_step_indices[step_index]))
+        
+        step_values = (llConditions<<32) | (loops<<32) | (next_step_indices<<16) | segments
+        return step_values, valid
+    
+    def _get_changed_steps(self,step_values,valid):
+        """Returns the indices of the valid steps whose values differ from 
+        those stored in `step_shadow`."""
+        num_steps = min(len(step_values),max_card_steps)
+        changed = valid[:num_steps] & (step_values[:num_steps] != self.step_shadow[:num_steps])
+        return set(np.flatnonzero(changed).tolist())
+    
+    def _is_repointed(self,step_index,step_values):
+        """Returns whether the only change to a step compared to 
+        `step_shadow` is the segment it plays."""
+        if step_index >= len(step_values):
+            return False
+        return ((int(step_values[step_index]) & ~SPCSEQ_SEGMENTMASK) == 
+                (int(self.step_shadow[step_index]) & ~SPCSEQ_SEGMENTMASK))
+    
+    def _write_steps(self,step_values,changed_steps):
+        """Writes the steps with indices in `changed_steps` to the card and 
+        updates `step_shadow`."""
+        with self.driver_lock:
+            for step_index in sorted(changed_steps):
+                spcm_dwSetParam_i64(self.hCard,SPC_SEQMODE_STEPMEM0 + step_index,int64(int(step_values[step_index])))
+                self.step_shadow[step_index] = step_values[step_index]
+        logging.debug('Wrote {} changed steps to the card.'.format(len(changed_steps)))
+    
+    def is_running(self):
+        """Returns whether the card is currently replaying data.
+        
+        Returns
+        -------
+        bool
+            False if the card reports that it is ready (stopped), otherwise 
+            True.
+
+        """
+        status = int32(0)
+        with self.driver_lock:
+            spcm_dwGetParam_i32(self.hCard, SPC_M2STATUS, byref(status))
+        return not (status.value & M2STAT_CARD_READY)
     
 if __name__ == '__main__':
     awg = AWG(sample_rate_Hz = 1000e6,max_output_mV=300)
\ No newline at end of file
@@ -0,0 +1,197 @@
+"""Background monitoring of the step the AWG card is playing.
+
+`CardMonitor` polls SPC_SEQMODE_STATUS and SPC_M2STATUS in a thread at a
+fixed rate, records every change of step in a ring buffer and calls any
+registered callbacks. Whilst a monitor is running, `AWG.get_playback_state`
+returns its latest sample instead of reading the registers, so `load_all` can
+plan which segments are safe to overwrite without a blocking register round
+trip.
+
+"""
+import logging
+import time
+import threading
+from collections import deque
+
+from .awg_class import *
+
+default_poll_rate_Hz = 1000 # register samples per second
+default_history_length = 1024 # step transitions kept in the ring buffer
+
+class CardMonitor():
+    """Polls the card status in a background thread.
+
+    The segment of each step is looked up in `AWG.step_shadow` rather than
+    read from the card, so each sample only needs two register reads. The
+    registers are read whilst holding `AWG.driver_lock` so that a sample is
+    never taken in the middle of a transfer or step write. The
+    monitor is stopped when the AWG is closed, and restarted if the AWG is
+    reinitialised with `AWG.reinit` (e.g. after FIFO streaming).
+
+    Attributes
+    ----------
+    awg : AWG
+        The AWG being monitored.
+    poll_interval_s : float
+        The time between samples.
+    history : collections.deque of tuple
+        Ring buffer of the last step transitions as (timestamp, step,
+        segment) tuples, where the timestamp is from `time.perf_counter` and
+        the segment is the physical segment.
+    state : dict or None
+        The latest sample, with the keys 'timestamp', 'step', 'segment'
+        (physical), 'status' (the value of SPC_M2STATUS) and 'running'.
+        None until the first sample has been taken.
+    callbacks : list of callable
+        Functions called from the monitor thread whenever the step or the
+        running state changes. They are passed the new `state` dict.
+
+    Methods
+    -------
+    start
+        Starts the monitor thread.
+    stop
+        Stops the monitor thread.
+    add_callback
+        Registers a function to call when the card changes step.
+
+    """
+
+    def __init__(self,awg,poll_rate_Hz=default_poll_rate_Hz,history_length=default_history_length):
+        self.awg = awg
+        self.poll_interval_s = 1/poll_rate_Hz
+        self.history = deque(maxlen=history_length)
+        self.state = None
+        self.callbacks = []
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts polling the card and attaches the monitor to the AWG so
+        that `AWG.get_playback_state` uses it.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.is_alive():
+            return
+        self._stop_event.clear()
+        self.sample()
+        self._thread = threading.Thread(target=self._run,name='AWG{}Monitor'.format(self.awg.card_index),daemon=True)
+        self._thread.start()
+        self.awg.monitor = self
+        logging.info('Started monitoring AWG card {} at {:.0f} Hz.'.format(self.awg.card_index,1/self.poll_interval_s))
+
+    def stop(self):
+        """Stops polling the card and detaches the monitor from the AWG.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.awg.monitor is self:
+            self.awg.monitor = None
+        self._stop_event.set()
+        if (self._thread is not None) and (self._thread is not threading.current_thread()):
+            self._thread.join()
+        self._thread = None
+
+    def is_alive(self):
+        """Returns whether the monitor thread is running."""
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def add_callback(self,callback):
+        """Registers a function to call whenever the step or running state
+        of the card changes.
+
+        Parameters
+        ----------
+        callback : callable
+            Called as callback(state) from the monitor thread, where state
+            is the dict described in `state`. Callbacks should return
+            quickly because the card is not polled whilst they run.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.callbacks.append(callback)
+
+    def remove_callback(self,callback):
+        """Removes a function registered with `add_callback`."""
+        self.callbacks.remove(callback)
+
+    def sample(self):
+        """Reads the card status once, records a transition if the step has
+        changed and calls the callbacks.
+
+        Returns
+        -------
+        dict
+            The new `state`.
+
+        """
+        hCard = self.awg.hCard
+        lStep = int64(0)
+        lStatus = int32(0)
+        with self.awg.driver_lock: # the main thread may be transferring data or writing steps
+            spcm_dwGetParam_i64(hCard, SPC_SEQMODE_STATUS, byref(lStep))
+            spcm_dwGetParam_i32(hCard, SPC_M2STATUS, byref(lStatus))
+            timestamp = time.perf_counter()
+            step = lStep.value
+            step_value = int(self.awg.step_shadow[step]) if 0 <= step < self.awg.step_shadow.size else -1
+            if step_value < 0: # step not written by this program so read it from the card
+                step_data = int64(0)
+                spcm_dwGetParam_i64(hCard, SPC_SEQMODE_STEPMEM0 + step, byref(step_data))
+                step_value = step_data.value
+        state = {'timestamp' : timestamp,
+                 'step' : step,
+                 'segment' : step_value & SPCSEQ_SEGMENTMASK,
+                 'status' : lStatus.value,
+                 'running' : not (lStatus.value & M2STAT_CARD_READY)}
+
+        previous = self.state
+        self.state = state
+        if ((previous is None) or (previous['step'] != state['step']) or
+            (previous['segment'] != state['segment']) or (previous['running'] != state['running'])):
+            self.history.append((timestamp,state['step'],state['segment']))
+            for callback in list(self.callbacks):
+                try:
+                    callback(state)
+                except Exception:
+                    logging.exception('AWG card monitor callback {} failed.'.format(callback))
+        return state
+
+    def get_transitions(self,since=None):
+        """Returns the recorded step transitions.
+
+        Parameters
+        ----------
+        since : float or None
+            If not None, only transitions with a timestamp after this
+            `time.perf_counter` value are returned. The default is None.
+
+        Returns
+        -------
+        list of tuple
+            The (timestamp, step, segment) transitions, oldest first.
+
+        """
+        history = list(self.history)
+        if since is None:
+            return history
+        return [transition for transition in history if transition[0] > since]
+
+    def _run(self):
+        while not self._stop_event.wait(self.poll_interval_s):
+            try:
+                self.sample()
+            except Exception:
+                logging.exception('AWG card monitor failed to read the card status. Stopping the monitor.')
+                if self.awg.monitor is self:
+                    self.awg.monitor = None
+                break
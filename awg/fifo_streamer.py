@@ -0,0 +1,303 @@
+"""Streams data that is generated on the fly to the AWG card in FIFO replay
+mode, for sequences that are too large to store in the card memory.
+
+In FIFO mode (SPC_REP_FIFO_SINGLE) the card replays data from a ring buffer
+in host memory. The card reports how much of the buffer is free with
+SPC_DATA_AVAIL_USER_LEN and where it starts with SPC_DATA_AVAIL_USER_POS. The
+user fills that part of the buffer and hands it back to the card by writing
+the number of bytes to SPC_DATA_AVAIL_CARD_LEN. The card only reports free
+space in blocks of the notify size, so the notify size sets the latency and
+the overhead per chunk. If the buffer empties before it is refilled the
+card stops with an underrun, which is reported as M2STAT_DATA_OVERRUN in the
+status and as an ERR_FIFO* error from M2CMD_DATA_WAITDMA.
+
+Streaming takes the card out of sequence replay mode, so the AWG is
+reinitialised when `FIFOStreamer.stream` returns to put it back in sequence
+mode. Any segments and steps need to be loaded again afterwards.
+
+"""
+import logging
+import time
+import threading
+import numpy as np
+
+from .awg_class import *
+
+default_buffer_bytes = 2**26 # 64 MB ring buffer (~50 ms of one channel at 625 MS/s)
+default_notify_bytes = 2**20 # 1 MB per chunk; must divide the buffer size and be a multiple of 4096
+
+class ToneChunkGenerator():
+    """Generates phase-continuous static tones in chunks for a `FIFOStreamer`.
+
+    Attributes
+    ----------
+    freqs_MHz : list of numpy.ndarray
+        The frequencies of the tones on each channel.
+    amps_mV : list of numpy.ndarray
+        The amplitudes of the tones on each channel.
+    phases_rad : list of numpy.ndarray
+        The starting phases of the tones on each channel.
+    sample_rate_Hz : float
+        The sample rate of the card.
+    conversion : float
+        The factor that converts mV into int16 card values.
+    clipped_samples : int
+        The number of samples that have been clipped to the int16 range.
+
+    """
+
+    def __init__(self,freqs_MHz,amps_mV,sample_rate_Hz,max_output_mV,phases_rad=None):
+        """
+        Parameters
+        ----------
+        freqs_MHz : list of list of float
+            The tone frequencies for each channel.
+        amps_mV : list of list of float
+            The tone amplitudes for each channel.
+        sample_rate_Hz : float
+            The sample rate of the card.
+        max_output_mV : float
+            The maximum output of the card, as `AWG.max_output_mV`.
+        phases_rad : list of list of float or None
+            The starting phase of each tone. If None, all phases are 0. The
+            default is None.
+
+        """
+        self.freqs_MHz = [np.asarray(freqs,dtype=float) for freqs in freqs_MHz]
+        self.amps_mV = [np.asarray(amps,dtype=float) for amps in amps_mV]
+        if phases_rad is None:
+            self.phases_rad = [np.zeros_like(freqs) for freqs in self.freqs_MHz]
+        else:
+            self.phases_rad = [np.asarray(phases,dtype=float) for phases in phases_rad]
+        self.sample_rate_Hz = sample_rate_Hz
+        self.conversion = 2**15/max_output_mV
+        self.clipped_samples = 0
+        self._scratch = np.empty(0,dtype=np.float32)
+        self._ramp = np.empty(0,dtype=np.float64)
+        self._phase = np.empty(0,dtype=np.float64)
+
+    def __call__(self,out,first_sample):
+        """Writes the next chunk of data into the ring buffer.
+
+        Parameters
+        ----------
+        out : numpy.ndarray of int16
+            View of the ring buffer with shape (samples, channels) to write
+            the data into.
+        first_sample : int
+            The index of the first sample of the chunk since the start of the
+            stream, used to keep the phase continuous between chunks.
+
+        Returns
+        -------
+        None.
+
+        """
+        num_samples = out.shape[0]
+        if self._ramp.size < num_samples:
+            self._ramp = np.arange(num_samples,dtype=np.float64)
+            self._phase = np.empty(num_samples,dtype=np.float64)
+            self._scratch = np.empty(num_samples,dtype=np.float32)
+        ramp = self._ramp[:num_samples]
+        phase = self._phase[:num_samples]
+        scratch = self._scratch[:num_samples]
+        for channel in range(out.shape[1]):
+            scratch.fill(0)
+            for freq,amp,start_phase in zip(self.freqs_MHz[channel],self.amps_mV[channel],self.phases_rad[channel]):
+                cycles_per_sample = freq*1e6/self.sample_rate_Hz
+                np.multiply(ramp,2*np.pi*cycles_per_sample,out=phase)
+                phase += 2*np.pi*((cycles_per_sample*first_sample) % 1) + start_phase
+                np.sin(phase,out=phase)
+                phase *= amp*self.conversion
+                scratch += phase
+            self.clipped_samples += int(np.count_nonzero((scratch > 32767) | (scratch < -32768)))
+            np.clip(scratch,-32768,32767,out=scratch)
+            np.copyto(out[:,channel],scratch,casting='unsafe')
+
+class FIFOStreamer():
+    """Streams data to the AWG card in FIFO replay mode. The data is
+    calculated chunk by chunk by a generator function whilst the card is
+    playing, so the length of the output is not limited by the card memory.
+
+    Attributes
+    ----------
+    awg : AWG
+        The AWG that is streamed to.
+    generate : callable
+        Called as generate(out, first_sample) to fill each chunk, where out
+        is an int16 view of the ring buffer with shape (samples, channels)
+        and first_sample is the index of the first sample of the chunk. See
+        `ToneChunkGenerator`.
+    buffer_bytes : int
+        The size of the ring buffer.
+    notify_bytes : int
+        The size of the chunks the ring buffer is filled in.
+    stats : dict
+        Statistics of the last stream with the keys 'samples' (per channel),
+        'duration_s', 'generate_s' (time spent in the generator),
+        'throughput_MSps' (samples per channel streamed per second),
+        'generate_MSps' (samples per channel generated per second of
+        generator time, i.e. per core), 'min_fill_promille' (the emptiest
+        the ring buffer got), 'chunks' and 'underruns'. 'throughput_MSps'
+        does not count the data used to prefill the buffer.
+
+    Methods
+    -------
+    stream
+        Fills the buffer, starts the card and keeps the buffer filled until
+        the requested length has been streamed or `stop` is called.
+    stop
+        Asks a stream running in another thread to finish.
+
+    """
+
+    def __init__(self,awg,generate,buffer_bytes=default_buffer_bytes,notify_bytes=default_notify_bytes):
+        self.awg = awg
+        self.generate = generate
+        self.notify_bytes = int(notify_bytes)
+        self.buffer_bytes = int(buffer_bytes//self.notify_bytes*self.notify_bytes)
+        if (self.notify_bytes % page_size_bytes) or (self.buffer_bytes == 0):
+            raise ValueError('The notify size ({} bytes) must be a multiple of {} bytes '
+                             'and no larger than the buffer ({} bytes).'.format(notify_bytes,page_size_bytes,buffer_bytes))
+        self.stats = {}
+        self._stop_event = threading.Event()
+        self._pvBuffer = None
+        self._buffer = None
+
+    def _setup(self):
+        """Puts the card into FIFO replay mode and defines the ring buffer
+        transfer."""
+        hCard = self.awg.hCard
+        self.awg.stop()
+        spcm_dwSetParam_i32(hCard, SPC_M2CMD, M2CMD_DATA_STOPDMA)
+        spcm_dwSetParam_i32(hCard, SPC_CARDMODE, SPC_REP_FIFO_SINGLE)
+        spcm_dwSetParam_i64(hCard, SPC_LOOPS, 0) # replay until stopped
+        spcm_dwSetParam_i64(hCard, SPC_SEGMENTSIZE, self.notify_bytes//self.awg.lBytesPerSample.value//self.awg.lNumChannels.value)
+        if self._pvBuffer is None:
+            self._pvBuffer = pvAllocMemPageAligned(self.buffer_bytes)
+            self._buffer = np.frombuffer(self._pvBuffer,dtype=np.int16)
+        spcm_dwDefTransfer_i64(hCard, SPCM_BUF_DATA, SPCM_DIR_PCTOCARD, uint32(self.notify_bytes),
+                               self._pvBuffer, uint64(0), uint64(self.buffer_bytes))
+
+    def _fill(self,position_bytes,num_bytes,first_sample):
+        """Generates num_bytes of data into the ring buffer starting at
+        position_bytes and returns the number of samples per channel."""
+        channels = self.awg.lNumChannels.value
+        out = self._buffer[position_bytes//2:(position_bytes+num_bytes)//2].reshape(-1,channels)
+        start = time.perf_counter()
+        self.generate(out,first_sample)
+        self.stats['generate_s'] += time.perf_counter() - start
+        return out.shape[0]
+
+    def stream(self,duration_s=None,timeout=10000):
+        """Streams data from the generator to the card. This blocks until
+        `duration_s` of data has been generated, `stop` is called from 
+        another thread, or the card runs out of data. The card is then 
+        stopped (without playing out the data left in the buffer) and the 
+        AWG is reinitialised in sequence replay mode.
+
+        Parameters
+        ----------
+        duration_s : float or None
+            The length of output to stream. If None, streaming continues
+            until `stop` is called. The default is None.
+        timeout : int
+            The timeout, in ms, for waiting for the card to free a chunk of
+            the buffer. The default is 10000.
+
+        Returns
+        -------
+        dict
+            The statistics of the stream (see `stats`).
+
+        """
+        hCard = self.awg.hCard
+        self._stop_event.clear()
+        self._setup()
+        if duration_s is None:
+            total_samples = None
+        else:
+            total_samples = int(duration_s*self.awg.sample_rate_Hz)
+        self.stats = {'samples':0,'duration_s':0,'generate_s':0,'throughput_MSps':0,'generate_MSps':0,
+                      'min_fill_promille':1000,'chunks':0,'underruns':0}
+
+        # Prefill the whole buffer before the card is started.
+        prefill_samples = self._fill(0,self.buffer_bytes,0)
+        self.stats['samples'] = prefill_samples
+        spcm_dwSetParam_i64(hCard, SPC_DATA_AVAIL_CARD_LEN, self.buffer_bytes)
+        spcm_dwSetParam_i32(hCard, SPC_TIMEOUT, int(timeout))
+        dwError = spcm_dwSetParam_i32(hCard, SPC_M2CMD, M2CMD_DATA_STARTDMA | M2CMD_DATA_WAITDMA)
+        if dwError != ERR_OK:
+            logging.error('FIFO streaming failed to start the DMA (error {}).'.format(dwError))
+            self._finish()
+            return self.stats
+        start = time.perf_counter()
+        spcm_dwSetParam_i32(hCard, SPC_M2CMD, M2CMD_CARD_START | M2CMD_CARD_ENABLETRIGGER | M2CMD_CARD_FORCETRIGGER)
+        logging.info('FIFO streaming started with a {} MB buffer and {} kB '
+                     'chunks.'.format(self.buffer_bytes/1e6,self.notify_bytes/1e3))
+
+        lAvailUser = int64(0)
+        lPCPos = int64(0)
+        lFillSize = int32(0)
+        lStatus = int32(0)
+        while not self._stop_event.is_set():
+            if (total_samples is not None) and (self.stats['samples'] >= total_samples):
+                break
+            with self.awg.driver_lock:
+                spcm_dwGetParam_i32(hCard, SPC_M2STATUS, byref(lStatus))
+            if lStatus.value & M2STAT_DATA_OVERRUN:
+                self.stats['underruns'] += 1
+                logging.error('FIFO streaming underrun after {} samples.'.format(self.stats['samples']))
+                break
+            with self.awg.driver_lock:
+                spcm_dwGetParam_i64(hCard, SPC_DATA_AVAIL_USER_LEN, byref(lAvailUser))
+                spcm_dwGetParam_i64(hCard, SPC_DATA_AVAIL_USER_POS, byref(lPCPos))
+                spcm_dwGetParam_i32(hCard, SPC_FILLSIZEPROMILLE, byref(lFillSize))
+            self.stats['min_fill_promille'] = min(self.stats['min_fill_promille'],lFillSize.value)
+            if lAvailUser.value >= self.notify_bytes:
+                # do not write past the end of the ring buffer in one go
+                num_bytes = min(lAvailUser.value,self.buffer_bytes-lPCPos.value)
+                num_bytes -= num_bytes % self.notify_bytes
+                self.stats['samples'] += self._fill(lPCPos.value,num_bytes,self.stats['samples'])
+                self.stats['chunks'] += 1
+                with self.awg.driver_lock:
+                    spcm_dwSetParam_i64(hCard, SPC_DATA_AVAIL_CARD_LEN, num_bytes)
+            with self.awg.driver_lock:
+                dwError = spcm_dwSetParam_i32(hCard, SPC_M2CMD, M2CMD_DATA_WAITDMA)
+            if dwError in [ERR_FIFOBUFOVERRUN, ERR_FIFOHWOVERRUN, ERR_FIFOFINISHED]:
+                self.stats['underruns'] += 1
+                logging.error('FIFO streaming underrun after {} samples '
+                              '(error {}).'.format(self.stats['samples'],dwError))
+                break
+            elif dwError == ERR_TIMEOUT:
+                logging.error('Timeout whilst waiting for the card to free the FIFO buffer.')
+                break
+
+        duration_s = time.perf_counter() - start
+        self._finish()
+        self.stats['duration_s'] = duration_s
+        self.stats['throughput_MSps'] = (self.stats['samples']-prefill_samples)/duration_s/1e6 if duration_s else 0
+        self.stats['generate_MSps'] = self.stats['samples']/self.stats['generate_s']/1e6 if self.stats['generate_s'] else 0
+        logging.info('FIFO streamed {} samples per channel in {:.3f} s ({:.1f} MS/s, '
+                     'generator {:.1f} MS/s per core, minimum fill {} promille, '
+                     '{} underruns).'.format(self.stats['samples'],duration_s,self.stats['throughput_MSps'],
+                                             self.stats['generate_MSps'],self.stats['min_fill_promille'],
+                                             self.stats['underruns']))
+        return self.stats
+
+    def _finish(self):
+        """Stops the card and the DMA and returns the AWG to sequence replay
+        mode."""
+        spcm_dwSetParam_i32(self.awg.hCard, SPC_M2CMD, M2CMD_CARD_STOP | M2CMD_DATA_STOPDMA)
+        self.awg.reinit()
+
+    def stop(self):
+        """Asks a call of `stream` running in another thread to stop 
+        streaming. `stream` then stops the card and returns.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._stop_event.set()
@@ -0,0 +1,208 @@
+"""Estimates the card memory, compute time and upload time needed for a set
+of segments and steps without needing an AWG card to be connected.
+
+The M4i.66xx cards divide their sample memory equally between the
+SPC_SEQMODE_MAXSEGMENTS segments in sequence replay mode, and this memory is
+shared between the active channels. This means that every segment,
+including the longest, must fit in memory_samples/number_of_segments/channels
+samples. `plan_card_memory` checks this before any data is transferred.
+
+"""
+import logging
+import json
+
+default_memory_samples = 2**30 # 2 GB of 16 bit samples (M4i.66xx standard memory)
+max_card_segments = 2**16 # largest SPC_SEQMODE_MAXSEGMENTS partition allowed by the card
+max_card_steps = 4096 # number of steps that can be stored in the sequence memory
+default_compute_rate_Sps = 4e7 # approximate tone samples calculated per second by ActionContainer.calculate
+default_dma_rate_Bps = 2.8e9 # approximate sustained PCIe x8 Gen2 DMA rate
+
+def get_segment_capacity_samples(memory_samples,number_of_segments,active_channels):
+    """Returns the largest segment (in samples per channel) that can be
+    stored on the card.
+
+    Parameters
+    ----------
+    memory_samples : int
+        The total sample memory of the card.
+    number_of_segments : int
+        The number of segments the memory is divided into.
+    active_channels : int
+        The number of active channels sharing the memory.
+
+    Returns
+    -------
+    int
+        The maximum number of samples per channel in a single segment.
+
+    """
+    return int(memory_samples//number_of_segments//active_channels)
+
+def plan_card_memory(segments,steps,card_settings,rrs=[],memory_samples=None,
+                     compute_rate_Sps=default_compute_rate_Sps,dma_rate_Bps=default_dma_rate_Bps,
+                     spare_segments=0):
+    """Plans how the card memory should be divided to store the segments.
+    This is a dry run: no data is calculated and the card is not accessed.
+
+    Segment lengths are taken from the `time` arrays of the ActionContainers,
+    which are known before the data is calculated.
+
+    Parameters
+    ----------
+    segments : list of list of ActionContainer
+        The segments from the `MainWindow`, including any rearrangement
+        segments that have been inserted.
+    steps : list of dict
+        The steps from the `MainWindow`.
+    card_settings : dict
+        The card settings from the `MainWindow`. The 'active_channels' and
+        'number_of_segments' keys are used.
+    rrs : list of RearrangementHandler
+        The rearrangement handlers. Enabled handlers add the time and host
+        memory needed to precalculate their moves to the estimate. The
+        default is [].
+    memory_samples : int or None
+        The total sample memory of the card, as returned by
+        `AWG.get_memory_samples`. If None (or 0), `default_memory_samples` is
+        used. The default is None.
+    compute_rate_Sps : float
+        The number of single tone samples that can be calculated per second.
+        The default is `default_compute_rate_Sps`.
+    dma_rate_Bps : float
+        The rate data is transferred to the card in bytes per second. The
+        default is `default_dma_rate_Bps`.
+    spare_segments : int
+        The number of extra segments to reserve on top of those needed by
+        the `segments`. The default is 0.
+
+    Returns
+    -------
+    plan : dict
+        The plan, with the keys
+        'segment_samples' : the samples per channel of each segment,
+        'longest_segment_samples' : the length of the longest segment,
+        'segment_bytes' : the bytes transferred for each segment,
+        'total_bytes' : the bytes needed to transfer every segment,
+        'upload_bytes' : the bytes of segments that need to be transferred,
+        'estimated_compute_s' : the estimated time to calculate the segments
+        and rearrangement moves that need calculating (actions shared 
+        between segments, e.g. by `calculate_segments`, are counted once),
+        'estimated_upload_s' : the estimated time to transfer 'upload_bytes',
+        'rearr_host_bytes' : the host memory needed for precalculated
+        rearrangement moves,
+        'number_of_segments' : the smallest valid SPC_SEQMODE_MAXSEGMENTS, or
+        None if there is no valid partition,
+        'segment_capacity_samples' : the largest segment that can be stored
+        with this partition,
+        'current_number_of_segments_valid' : whether the partition currently
+        in `card_settings` is valid,
+        'errors' : a list of the problems that would prevent the segments and
+        steps being loaded.
+
+    """
+    if not memory_samples:
+        memory_samples = default_memory_samples
+    active_channels = int(card_settings['active_channels'])
+    bytes_per_sample = 2
+    errors = []
+
+    segment_samples = []
+    upload_bytes = 0
+    compute_tone_samples = 0
+    counted_actions = set() # actions shared by deduplicated segments are only calculated once
+    for segment in segments:
+        num_samples = max([action.time.size - 1 for action in segment])
+        segment_samples.append(num_samples)
+        if (any([action.needs_to_transfer for action in segment]) |
+            any([action.rearr for action in segment])):
+            upload_bytes += num_samples*active_channels*bytes_per_sample
+        for action in segment:
+            if action.needs_to_calculate and (id(action) not in counted_actions):
+                counted_actions.add(id(action))
+                compute_tone_samples += num_samples*len(action.freq_params['start_freq_MHz'])
+    segment_bytes = [num_samples*active_channels*bytes_per_sample for num_samples in segment_samples]
+    longest_segment_samples = max(segment_samples,default=0)
+
+    rearr_host_bytes = 0
+    for rr in rrs:
+        if not rr.enabled:
+            continue
+        try:
+            num_moves = len(rr.rearr_unique_movements)
+        except AttributeError:
+            num_moves = len(rr.start_freq_MHz)*len(rr.target_freq_MHz)
+        move_samples = segment_samples[rr.starting_segment+rr.segment] if rr.starting_segment+rr.segment < len(segments) else 0
+        rearr_host_bytes += num_moves*move_samples*active_channels*bytes_per_sample
+        compute_tone_samples += num_moves*move_samples
+
+    number_of_segments = None
+    required_segments = len(segments) + spare_segments
+    partition = 2
+    while partition <= max_card_segments:
+        if (partition >= required_segments and
+            longest_segment_samples <= get_segment_capacity_samples(memory_samples,partition,active_channels)):
+            number_of_segments = partition
+            break
+        partition *= 2
+    if number_of_segments is None:
+        errors.append('No SPC_SEQMODE_MAXSEGMENTS partition can store {} segments '
+                      'with the longest having {} samples per channel in {} '
+                      'samples of card memory.'.format(required_segments,longest_segment_samples,memory_samples))
+        segment_capacity_samples = 0
+    else:
+        segment_capacity_samples = get_segment_capacity_samples(memory_samples,number_of_segments,active_channels)
+
+    current_number_of_segments = int(card_settings.get('number_of_segments',0))
+    current_number_of_segments_valid = ((current_number_of_segments >= required_segments) and
+                                        (longest_segment_samples <= get_segment_capacity_samples(memory_samples,max(current_number_of_segments,1),active_channels)))
+    if not current_number_of_segments_valid:
+        errors.append('The current number_of_segments ({}) cannot store {} segments '
+                      'with the longest having {} samples per channel.'.format(current_number_of_segments,
+                                                                              required_segments,longest_segment_samples))
+
+    if len(steps) > max_card_steps:
+        errors.append('{} steps are defined but the card can only store {}.'.format(len(steps),max_card_steps))
+    for step_index,step in enumerate(steps):
+        if (step['segment'] < 0) or (step['segment'] >= len(segments)):
+            errors.append('Step {} uses segment {} which does not exist.'.format(step_index,step['segment']))
+
+    plan = {'segment_samples' : segment_samples,
+            'longest_segment_samples' : longest_segment_samples,
+            'segment_bytes' : segment_bytes,
+            'total_bytes' : sum(segment_bytes),
+            'upload_bytes' : upload_bytes,
+            'estimated_compute_s' : compute_tone_samples/compute_rate_Sps,
+            'estimated_upload_s' : upload_bytes/dma_rate_Bps,
+            'rearr_host_bytes' : rearr_host_bytes,
+            'number_of_segments' : number_of_segments,
+            'segment_capacity_samples' : segment_capacity_samples,
+            'current_number_of_segments_valid' : current_number_of_segments_valid,
+            'errors' : errors}
+    return plan
+
+def log_memory_plan(plan):
+    """Logs a summary of a plan returned by `plan_card_memory`.
+
+    Parameters
+    ----------
+    plan : dict
+        The plan to summarise.
+
+    Returns
+    -------
+    str
+        The plan formatted as a JSON string (without the per-segment lists)
+        that can be sent over TCP.
+
+    """
+    logging.info('Card memory plan: {} segments, longest {} samples per channel. '
+                 'Smallest valid number_of_segments = {} (capacity {} samples per '
+                 'segment). {:.1f} MB to upload (~{:.3f} s), ~{:.3f} s to '
+                 'calculate.'.format(len(plan['segment_samples']),plan['longest_segment_samples'],
+                                     plan['number_of_segments'],plan['segment_capacity_samples'],
+                                     plan['upload_bytes']/1e6,plan['estimated_upload_s'],
+                                     plan['estimated_compute_s']))
+    for error in plan['errors']:
+        logging.error('Card memory plan: '+error)
+    summary = {key:value for key,value in plan.items() if key not in ['segment_samples','segment_bytes']}
+    return json.dumps(summary)
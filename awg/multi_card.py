@@ -0,0 +1,186 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .awg_class import AWG
+from actions import calculate_segments
+
+class MultiCardController():
+    """Controls several AWG cards from a single process.
+
+    Each card is wrapped in its own `AWG` object and given its own upload
+    worker thread, so that data can be transferred to the different cards at
+    the same time (the driver releases the GIL during DMA). Calls to the same
+    card are always run in the order they were submitted.
+
+    Because all cards are controlled from one process, the calibration
+    (`amp_adjuster.calibration_cache`) and phase
+    (`phase_minimiser.phase_cache`) caches are shared between the cards.
+    Waveforms are shared by passing the same `ActionContainer` objects to
+    more than one card: `calculate_segments` calculates the segments of each
+    card in order with `actions.calculate_segments` (so the phases are
+    continuous and identical segments are deduplicated, as for a single
+    card), an action shared with a card that has already been calculated is
+    not calculated again and each data hash is only computed once.
+
+    Attributes
+    ----------
+    awgs : dict of int : AWG
+        The AWG objects, keyed by card index.
+    workers : dict of int : concurrent.futures.ThreadPoolExecutor
+        The single-thread upload worker for each card, keyed by card index.
+    load_timings : dict of int : dict
+        The time taken by each card in the last call of `load_all`, with the
+        keys 'start', 'end' and 'duration_s' (times from
+        `time.perf_counter`).
+
+    """
+
+    def __init__(self,card_settings_list):
+        """Opens the cards.
+
+        Parameters
+        ----------
+        card_settings_list : list of dict
+            The card settings for each card, as used for the kwargs of `AWG`.
+            If a dict does not contain 'card_index', its position in the
+            list is used as the card index.
+
+        """
+        self.awgs = {}
+        self.workers = {}
+        self.load_timings = {}
+        for list_index,card_settings in enumerate(card_settings_list):
+            card_settings = {'card_index':list_index,**card_settings}
+            card_index = int(card_settings['card_index'])
+            if card_index in self.awgs:
+                logging.error('Card index {} was requested more than once. '
+                              'Ignoring the duplicate.'.format(card_index))
+                continue
+            self.awgs[card_index] = AWG(**card_settings)
+            self.workers[card_index] = ThreadPoolExecutor(max_workers=1,thread_name_prefix='AWG{}'.format(card_index))
+        logging.info('Opened {} AWG cards.'.format(len(self.awgs)))
+
+    def submit(self,card_index,method,*args,**kwargs):
+        """Runs a method of a card's AWG object on that card's worker thread.
+
+        Parameters
+        ----------
+        card_index : int
+            The index of the card.
+        method : str
+            The name of the `AWG` method to call, e.g. 'load_all' or
+            'transfer_segment_data'.
+        *args, **kwargs
+            Passed through to the method.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future that will hold the return value of the method.
+
+        """
+        return self.workers[card_index].submit(getattr(self.awgs[card_index],method),*args,**kwargs)
+
+    def calculate_segments(self,segments_list):
+        """Calculates the segments of each card with 
+        `actions.calculate_segments`, which passes the end phase of each 
+        segment on to the next and only calculates actions that need to be 
+        calculated. Actions shared between cards are calculated (and 
+        hashed) for the first card that uses them and skipped for the 
+        others.
+
+        Parameters
+        ----------
+        segments_list : list of list of list of ActionContainer
+            The segments for each card.
+
+        Returns
+        -------
+        list of list of list of ActionContainer
+            The calculated segments for each card, with duplicate segments 
+            sharing the same ActionContainers (see 
+            `actions.calculate_segments`). These should be loaded instead of
+            the segments that were passed in.
+
+        """
+        compiled_list = []
+        hashed = set()
+        for segments in segments_list:
+            compiled = calculate_segments(segments) # actions already calculated for another card no longer need to calculate
+            for segment in compiled:
+                for action in segment:
+                    if id(action) not in hashed:
+                        action.get_data_hash()
+                        hashed.add(id(action))
+            compiled_list.append(compiled)
+        return compiled_list
+
+    def load_all(self,card_data,**kwargs):
+        """Loads segments and steps onto several cards at once. All actions
+        are calculated first, then each card uploads its data on its own
+        worker thread. This method blocks until every card has finished.
+
+        Parameters
+        ----------
+        card_data : dict of int : tuple
+            The (segments, steps) to load for each card, keyed by card index.
+            See `AWG.load_all`.
+        **kwargs
+            Passed through to `AWG.load_all`.
+
+        Returns
+        -------
+        None.
+
+        """
+        compiled_list = self.calculate_segments([segments for segments,steps in card_data.values()])
+
+        futures = {}
+        for (card_index,(_,steps)),segments in zip(card_data.items(),compiled_list):
+            futures[card_index] = self.workers[card_index].submit(self._timed_load_all,card_index,segments,steps,**kwargs)
+        for card_index,future in futures.items():
+            try:
+                future.result()
+            except Exception:
+                logging.exception('Failed to load data onto card {}.'.format(card_index))
+
+    def _timed_load_all(self,card_index,segments,steps,**kwargs):
+        """Calls `AWG.load_all` for one card and records the time taken."""
+        start = time.perf_counter()
+        self.awgs[card_index].load_all(segments,steps,**kwargs)
+        end = time.perf_counter()
+        self.load_timings[card_index] = {'start':start,'end':end,'duration_s':end-start}
+
+    def trigger(self,card_indices=None):
+        """Forces a software trigger of the cards.
+
+        Parameters
+        ----------
+        card_indices : list of int or None
+            The cards to trigger. If None, all cards are triggered. The
+            default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        if card_indices is None:
+            card_indices = self.awgs.keys()
+        for card_index in card_indices:
+            self.awgs[card_index].trigger()
+
+    def close(self):
+        """Waits for all submitted work to finish, then stops and closes all
+        of the cards.
+
+        Returns
+        -------
+        None.
+
+        """
+        for card_index,worker in self.workers.items():
+            worker.shutdown(wait=True)
+            self.awgs[card_index].stop()
+            self.awgs[card_index].close()
@@ -0,0 +1,172 @@
+"""Compiled sequence bundles: the int16 card data of a set of segments saved
+alongside the .awg parameter file it was calculated from.
+
+A bundle is two files next to the .awg file:
+
+    <name>.awgbundle      JSON manifest with the hash the bundle is valid
+                          for, the step table and, for each logical segment,
+                          its offset and length in the payload and its
+                          segment key (see `AWG.get_segment_key`).
+    <name>.awgbundle.npy  The multiplexed int16 payloads of the distinct
+                          segments, one after another.
+
+The hash covers the .awg file contents, the card settings that change the
+int16 data (channels, output range and sample rate) and the modification
+times of any calibration files named in the parameters. If any of these
+change the bundle is stale and `load_bundle` returns None so that the
+waveforms are recalculated. The payload is memory-mapped when loaded so that
+the data is read from disk as it is copied into the DMA staging buffers.
+
+"""
+import logging
+import os
+import json
+import hashlib
+import numpy as np
+
+bundle_version = 1 # increase if the bundle format or the quantisation changes
+bundle_suffix = '.awgbundle'
+
+def get_bundle_filenames(params_filename):
+    """Returns the manifest and payload filenames of the bundle for a .awg
+    parameter file."""
+    manifest_filename = os.path.splitext(params_filename)[0] + bundle_suffix
+    return manifest_filename, manifest_filename + '.npy'
+
+def get_bundle_hash(params_filename,awg):
+    """Returns the hash a bundle must have to be valid for a parameter file
+    and card.
+
+    Parameters
+    ----------
+    params_filename : str
+        The .awg parameter file.
+    awg : AWG
+        The card the bundle will be loaded onto.
+
+    Returns
+    -------
+    str
+        The hex digest.
+
+    """
+    with open(params_filename,'rb') as f:
+        params_bytes = f.read()
+    h = hashlib.blake2b(digest_size=16)
+    h.update(params_bytes)
+    h.update(json.dumps([bundle_version,awg.lNumChannels.value,awg.max_output_mV,
+                         awg.sample_rate_Hz]).encode())
+    params = json.loads(params_bytes)
+    calibration_filenames = [settings.get('filename') for settings in params.get('amp_adjuster_settings',[])]
+    for segment in params.get('segments',[]):
+        for value in segment.values():
+            if isinstance(value,dict):
+                calibration_filenames.append(value.get('amp_comp_filename'))
+    for filename in calibration_filenames:
+        try:
+            stat = os.stat(filename)
+            h.update('{}:{}:{}'.format(os.path.abspath(filename),stat.st_mtime_ns,stat.st_size).encode())
+        except (OSError,TypeError,ValueError):
+            h.update(repr(filename).encode())
+    return h.hexdigest()
+
+def save_bundle(params_filename,awg,segments,steps):
+    """Quantises calculated segments and saves them as a bundle for a
+    parameter file. Identical segments are only stored once.
+
+    Parameters
+    ----------
+    params_filename : str
+        The .awg parameter file the segments were calculated from.
+    awg : AWG
+        The card the data is for.
+    segments : list of list of ActionContainer
+        The calculated segments, as sent to `AWG.load_all`.
+    steps : list of dict
+        The steps, as sent to `AWG.load_all`.
+
+    Returns
+    -------
+    bool
+        Whether the bundle was saved.
+
+    """
+    manifest_filename, payload_filename = get_bundle_filenames(params_filename)
+    segment_keys = [awg.get_segment_key(segment) for segment in segments]
+    if any(key is None for key in segment_keys):
+        logging.debug('Not saving a bundle for {} because it contains rearrangement '
+                      'segments.'.format(params_filename))
+        return False
+
+    offsets = {}
+    segment_entries = []
+    total_samples = 0
+    for segment,key in zip(segments,segment_keys):
+        num_samples = sum(action.data.size for action in segment)
+        if key not in offsets:
+            offsets[key] = total_samples
+            total_samples += num_samples
+        segment_entries.append({'offset' : offsets[key],
+                                'samples' : num_samples,
+                                'key' : list(key)})
+    try:
+        payload = np.lib.format.open_memmap(payload_filename,mode='w+',dtype=np.int16,shape=(max(total_samples,1),))
+        written = set()
+        for segment,key,entry in zip(segments,segment_keys,segment_entries):
+            if key in written:
+                continue
+            out = payload[entry['offset']:entry['offset']+entry['samples']]
+            awg.quantise_segment_data([action.data for action in segment],out=out,overrange='rescale')
+            written.add(key)
+        payload.flush()
+        del payload
+
+        manifest = {'version' : bundle_version,
+                    'hash' : get_bundle_hash(params_filename,awg),
+                    'segments' : segment_entries,
+                    'steps' : steps}
+        with open(manifest_filename,'w',encoding='utf-8') as f:
+            json.dump(manifest,f)
+    except OSError as e:
+        logging.warning('Could not save the compiled bundle for {}: {}'.format(params_filename,e))
+        return False
+    logging.info('Saved compiled bundle {} ({:.1f} MB).'.format(manifest_filename,total_samples*2/1e6))
+    return True
+
+def load_bundle(params_filename,awg):
+    """Loads the bundle for a parameter file if it is valid.
+
+    Parameters
+    ----------
+    params_filename : str
+        The .awg parameter file.
+    awg : AWG
+        The card the bundle will be loaded onto.
+
+    Returns
+    -------
+    tuple or None
+        (segment_data, segment_keys, steps) to pass to `AWG.load_compiled`,
+        where segment_data are memory-mapped views of the payload. None if
+        there is no bundle or it is stale.
+
+    """
+    manifest_filename, payload_filename = get_bundle_filenames(params_filename)
+    try:
+        with open(manifest_filename,'r') as f:
+            manifest = json.load(f)
+    except (OSError,json.decoder.JSONDecodeError):
+        logging.debug('No compiled bundle found for {}.'.format(params_filename))
+        return None
+    if (manifest.get('version') != bundle_version) or (manifest.get('hash') != get_bundle_hash(params_filename,awg)):
+        logging.info('The compiled bundle {} is stale and will not be used.'.format(manifest_filename))
+        return None
+    try:
+        payload = np.load(payload_filename,mmap_mode='r')
+    except (OSError,ValueError) as e:
+        logging.warning('Could not read the compiled bundle payload {}: {}'.format(payload_filename,e))
+        return None
+    segment_data = [payload[entry['offset']:entry['offset']+entry['samples']] for entry in manifest['segments']]
+    segment_keys = [tuple(entry['key']) for entry in manifest['segments']]
+    logging.info('Loaded compiled bundle {}.'.format(manifest_filename))
+    return segment_data, segment_keys, manifest['steps']
@@ -0,0 +1,414 @@
+"""Simulated replacement for the `pyspcm` driver wrapper.
+
+The functions in this module have the same names and calling conventions as
+those in `pyspcm`, but act on a `SimulatedCard` object held in Python rather
+than on a real Spectrum card. This allows the `AWG` class to be run and
+benchmarked on a PC without an AWG card (or the Spectrum driver) installed.
+
+The simulated backend is used in place of the driver when the environment
+variable AWG_SIMULATE is set before the `awg` package is imported. If
+AWG_SIMULATE is a positive integer, this is the number of simulated cards that
+can be opened (/dev/spcm0, /dev/spcm1, ...), otherwise a single card is
+simulated. Leaving AWG_SIMULATE unset or empty, or setting it to 0, uses the
+`pyspcm` driver.
+
+Only the registers used by this program are modelled: sequence replay mode
+(segment memory, the step table and software triggers) and DMA transfers. DMA
+transfers take the time they would on the PCIe bus (see `dma_rate_Bps`) and
+the data is only copied out of the user buffer when the transfer completes,
+so code that overwrites a buffer whilst its DMA is in flight will upload
+corrupted data just like on the real card.
+
+FIFO replay mode (SPC_REP_FIFO_SINGLE) is also modelled. Once the card is
+started the data in the ring buffer is consumed at the output data rate
+(sample rate x active channels x 2 bytes). If the buffer runs empty the card
+reports an underrun with M2STAT_DATA_OVERRUN and WAITDMA returns
+ERR_FIFOHWOVERRUN. The card's onboard memory is not used as an extra buffer,
+so the simulation is stricter than the hardware.
+
+"""
+import logging
+import os
+import time
+import numpy as np
+from ctypes import *
+
+# load registers for easier access
+from .py_header.regs import *
+
+# load registers for easier access
+from .py_header.spcerr import *
+
+SPCM_DIR_PCTOCARD = 0
+SPCM_DIR_CARDTOPC = 1
+
+SPCM_BUF_DATA      = 1000 # main data buffer for acquired or generated samples
+SPCM_BUF_ABA       = 2000 # buffer for ABA data, holds the A-DATA (slow samples)
+SPCM_BUF_TIMESTAMP = 3000 # buffer for timestamps
+
+# define pointer aliases
+int8  = c_int8
+int16 = c_int16
+int32 = c_int32
+int64 = c_int64
+
+ptr8  = POINTER (int8)
+ptr16 = POINTER (int16)
+ptr32 = POINTER (int32)
+ptr64 = POINTER (int64)
+
+uint8  = c_uint8
+uint16 = c_uint16
+uint32 = c_uint32
+uint64 = c_uint64
+
+uptr8  = POINTER (uint8)
+uptr16 = POINTER (uint16)
+uptr32 = POINTER (uint32)
+uptr64 = POINTER (uint64)
+
+drv_handle = py_object
+
+simulated_card_settings = {'card_type' : TYP_M4I6622_X8,
+                           'serial_number' : 0,
+                           'memory_bytes' : 2**31, # shared between the segments and active channels
+                           'max_adc_value' : 32767,
+                           'bytes_per_sample' : 2,
+                           'dma_rate_Bps' : 2.8e9} # approximate sustained PCIe x8 Gen2 DMA rate
+
+try:
+    number_of_simulated_cards = int(os.environ.get('AWG_SIMULATE'))
+except (TypeError, ValueError):
+    number_of_simulated_cards = 1
+
+class SimulatedCard():
+    """A single simulated AWG card.
+
+    Attributes
+    ----------
+    device_name : str
+        The device name that the card was opened with, e.g. '/dev/spcm0'.
+    registers : dict
+        The last value written to each register. Registers that have not
+        been written read as 0 unless they are modelled explicitly in
+        `get_param`.
+    segments : dict of int : numpy.ndarray of int16
+        The (multiplexed) data that has been DMA'd to each segment.
+    segment_sizes : dict of int : int
+        The size (samples per channel) set with SPC_SEQMODE_SEGMENTSIZE for
+        each segment, which applies to the segment selected by
+        SPC_SEQMODE_WRITESEGMENT at the time it is written.
+    running : bool
+        Whether the card has been started and not yet stopped.
+    triggered : bool
+        Whether the card has recieved the trigger that starts replay since 
+        it was started.
+    current_step : int
+        The step that the sequence is currently replaying.
+    dma_log : list of dict
+        Record of every completed DMA with the keys 'segment', 'bytes',
+        'start' and 'end' (times from `time.perf_counter`).
+    fifo : dict or None
+        The state of the FIFO ring buffer when a DMA has been started in FIFO
+        mode, with the keys 'buffer_bytes', 'notify_bytes', 'filled' and
+        'consumed' (total bytes written by the user and replayed by the
+        card), 'start_time' and 'underrun'.
+
+    """
+    def __init__(self,device_name):
+        self.device_name = device_name
+        self.registers = {SPC_CHENABLE : CHANNEL0,
+                          SPC_SAMPLERATE : int(625e6),
+                          SPC_SEQMODE_MAXSEGMENTS : 1}
+        self.segments = {}
+        self.segment_sizes = {}
+        self.running = False
+        self.triggered = False
+        self.current_step = 0
+        self.transfer = None
+        self.pending_dma = None
+        self.dma_log = []
+        self.fifo = None
+
+    def get_num_channels(self):
+        return bin(self.registers[SPC_CHENABLE]).count('1')
+
+    def get_param(self,lReg):
+        if lReg == SPC_PCITYP:
+            return simulated_card_settings['card_type']
+        elif lReg == SPC_PCISERIALNO:
+            return simulated_card_settings['serial_number']
+        elif lReg == SPC_FNCTYPE:
+            return 2 # arbitrary function generator
+        elif lReg == SPC_CHCOUNT:
+            return self.get_num_channels()
+        elif lReg == SPC_MIINST_MAXADCVALUE:
+            return simulated_card_settings['max_adc_value']
+        elif lReg == SPC_MIINST_BYTESPERSAMPLE:
+            return simulated_card_settings['bytes_per_sample']
+        elif lReg == SPC_PCIMEMSIZE:
+            return simulated_card_settings['memory_bytes']
+        elif lReg == SPC_M2STATUS:
+            self.update_dma()
+            if self.running:
+                status = M2STAT_CARD_PRETRIGGER | M2STAT_CARD_TRIGGER
+            else:
+                status = M2STAT_CARD_PRETRIGGER | M2STAT_CARD_TRIGGER | M2STAT_CARD_READY
+            if (self.fifo is not None) and self.update_fifo():
+                status |= M2STAT_DATA_OVERRUN
+            return status
+        elif (lReg == SPC_DATA_AVAIL_USER_LEN) and (self.fifo is not None):
+            self.update_fifo()
+            return self.fifo['buffer_bytes'] - (self.fifo['filled'] - self.fifo['consumed'])
+        elif (lReg == SPC_DATA_AVAIL_USER_POS) and (self.fifo is not None):
+            return self.fifo['filled'] % self.fifo['buffer_bytes']
+        elif (lReg == SPC_FILLSIZEPROMILLE) and (self.fifo is not None):
+            self.update_fifo()
+            return int(1000*(self.fifo['filled'] - self.fifo['consumed'])/self.fifo['buffer_bytes'])
+        elif lReg == SPC_SEQMODE_STATUS:
+            return self.current_step
+        elif lReg == SPC_SEQMODE_SEGMENTSIZE:
+            return self.segment_sizes.get(self.registers.get(SPC_SEQMODE_WRITESEGMENT,0),0)
+        return self.registers.get(lReg,0)
+
+    def set_param(self,lReg,lValue):
+        if lReg == SPC_M2CMD:
+            return self.command(lValue)
+        if lReg == SPC_DATA_AVAIL_CARD_LEN:
+            return self.fifo_filled(lValue)
+        if (lReg == SPC_SEQMODE_MAXSEGMENTS) and self.running:
+            return ERR_RUNNING
+        if lReg == SPC_SEQMODE_SEGMENTSIZE:
+            self.segment_sizes[self.registers.get(SPC_SEQMODE_WRITESEGMENT,0)] = lValue
+            return ERR_OK
+        self.registers[lReg] = lValue
+        return ERR_OK
+
+    def command(self,lCommand):
+        """Processes a value written to the SPC_M2CMD register."""
+        if lCommand & M2CMD_CARD_STOP:
+            if self.fifo is not None:
+                self.update_fifo()
+                self.fifo['start_time'] = None
+            self.running = False
+        if lCommand & M2CMD_CARD_START:
+            self.running = True
+            self.triggered = False
+            self.current_step = self.registers.get(SPC_SEQMODE_STARTSTEP,0)
+            if self.fifo is not None:
+                self.fifo['start_time'] = time.perf_counter()
+        if lCommand & M2CMD_CARD_FORCETRIGGER:
+            self.trigger()
+        if lCommand & M2CMD_DATA_STOPDMA:
+            self.pending_dma = None
+            self.fifo = None
+        if lCommand & M2CMD_DATA_STARTDMA:
+            dwError = self.start_dma()
+            if dwError != ERR_OK:
+                return dwError
+        if lCommand & M2CMD_DATA_WAITDMA:
+            return self.wait_dma()
+        return ERR_OK
+
+    def trigger(self):
+        """The first trigger after the card is started begins replay at the 
+        start step. Later triggers advance the sequence past the current 
+        loop_until_trigger step, then follow the continue steps until the 
+        next loop_until_trigger step. Segments are treated as taking no time 
+        to replay."""
+        if not self.running:
+            return
+        if not self.triggered:
+            self.triggered = True
+            return
+        step_index = self.current_step
+        for _ in range(8192): # prevents sequences without any loop_until_trigger steps looping forever
+            step = self.registers.get(SPC_SEQMODE_STEPMEM0 + step_index,0)
+            step_index = (step & SPCSEQ_NEXTSTEPMASK) >> 16
+            next_step = self.registers.get(SPC_SEQMODE_STEPMEM0 + step_index,0)
+            if (next_step >> 32) & SPCSEQ_ENDLOOPONTRIG:
+                break
+        self.current_step = step_index
+
+    def define_transfer(self,dwBufType,dwDirection,dwNotifySize,pvDataBuffer,qwBrdOffs,qwTransferLen):
+        self.transfer = {'address' : pvDataBuffer,
+                         'bytes' : qwTransferLen,
+                         'notify_bytes' : dwNotifySize,
+                         'offset' : qwBrdOffs}
+        return ERR_OK
+
+    def is_fifo_mode(self):
+        return bool(self.registers.get(SPC_CARDMODE,0) & SPC_REP_FIFO_SINGLE)
+
+    def get_output_rate_Bps(self):
+        return self.registers[SPC_SAMPLERATE]*self.get_num_channels()*simulated_card_settings['bytes_per_sample']
+
+    def start_dma(self):
+        if self.transfer is None:
+            logging.error('{}: DMA started before a transfer was defined.'.format(self.device_name))
+            return ERR_SEQUENCE
+        if self.is_fifo_mode():
+            if self.fifo is None:
+                self.fifo = {'buffer_bytes' : self.transfer['bytes'],
+                             'notify_bytes' : self.transfer['notify_bytes'],
+                             'filled' : self.registers.pop(SPC_DATA_AVAIL_CARD_LEN,0),
+                             'consumed' : 0,
+                             'start_time' : None,
+                             'underrun' : False}
+            return ERR_OK
+        self.update_dma()
+        if self.pending_dma is not None:
+            logging.error('{}: DMA started whilst another DMA is in progress.'.format(self.device_name))
+            return ERR_SEQUENCE
+        start = time.perf_counter()
+        self.pending_dma = {'segment' : self.registers.get(SPC_SEQMODE_WRITESEGMENT,0),
+                            'segment_size' : self.segment_sizes.get(self.registers.get(SPC_SEQMODE_WRITESEGMENT,0),0),
+                            'start' : start,
+                            'end' : start + self.transfer['bytes']/simulated_card_settings['dma_rate_Bps'],
+                            **self.transfer}
+        return ERR_OK
+
+    def wait_dma(self):
+        if self.fifo is not None:
+            return self.wait_fifo()
+        if self.pending_dma is not None:
+            remaining = self.pending_dma['end'] - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            self.update_dma()
+        return ERR_OK
+
+    def update_dma(self):
+        """Completes the pending DMA if enough time has passed. The data is
+        only read from the user buffer at this point."""
+        dma = self.pending_dma
+        if (dma is None) or (time.perf_counter() < dma['end']):
+            return
+        num_samples = dma['bytes']//simulated_card_settings['bytes_per_sample']
+        data = np.ctypeslib.as_array(cast(dma['address'],ptr16),shape=(num_samples,)).copy()
+        expected_samples = dma['segment_size']*self.get_num_channels()
+        if expected_samples != num_samples:
+            logging.warning('{}: {} samples were transferred to segment {} but '
+                            'the segment size is {} samples.'.format(self.device_name,num_samples,
+                                                                     dma['segment'],expected_samples))
+        self.segments[dma['segment']] = data
+        self.dma_log.append({'segment' : dma['segment'], 'bytes' : dma['bytes'],
+                             'start' : dma['start'], 'end' : dma['end']})
+        self.pending_dma = None
+
+    def update_fifo(self):
+        """Advances the FIFO replay to the current time and returns whether 
+        the card has run out of data."""
+        fifo = self.fifo
+        if (fifo['start_time'] is not None) and (not fifo['underrun']):
+            now = time.perf_counter()
+            consumed = fifo['consumed'] + (now - fifo['start_time'])*self.get_output_rate_Bps()
+            fifo['start_time'] = now
+            if consumed > fifo['filled']:
+                fifo['underrun'] = True
+                consumed = fifo['filled']
+                logging.warning('{}: FIFO buffer underrun after {} bytes.'.format(self.device_name,fifo['filled']))
+            fifo['consumed'] = int(consumed)
+        return fifo['underrun']
+
+    def fifo_filled(self,num_bytes):
+        """The user has written num_bytes more bytes to the ring buffer."""
+        if self.fifo is None:
+            self.registers[SPC_DATA_AVAIL_CARD_LEN] = num_bytes
+            return ERR_OK
+        self.update_fifo()
+        free_bytes = self.fifo['buffer_bytes'] - (self.fifo['filled'] - self.fifo['consumed'])
+        if num_bytes > free_bytes:
+            logging.error('{}: {} bytes were marked as filled but only {} '
+                          'bytes of the buffer are free.'.format(self.device_name,num_bytes,free_bytes))
+            return ERR_FIFOSETUP
+        self.fifo['filled'] += num_bytes
+        return ERR_OK
+
+    def wait_fifo(self):
+        """Waits until at least notify_bytes of the ring buffer are free."""
+        fifo = self.fifo
+        if self.update_fifo():
+            return ERR_FIFOHWOVERRUN
+        notify_bytes = max(fifo['notify_bytes'],1)
+        free_bytes = fifo['buffer_bytes'] - (fifo['filled'] - fifo['consumed'])
+        if free_bytes < notify_bytes:
+            if fifo['start_time'] is None:
+                return ERR_OK # the card is not replaying yet, so the buffer will not empty
+            time.sleep((notify_bytes - free_bytes)/self.get_output_rate_Bps())
+            if self.update_fifo():
+                return ERR_FIFOHWOVERRUN
+        return ERR_OK
+
+def _get_address(pvBuffer):
+    try:
+        return pvBuffer.value
+    except AttributeError:
+        return addressof(pvBuffer)
+
+def _get_value(value):
+    try:
+        return value.value
+    except AttributeError:
+        return int(value)
+
+def _set_ref(ref,value):
+    ref._obj.value = value # byref() objects keep a reference to the object they point to
+
+def spcm_hOpen(szDeviceName):
+    try:
+        device_name = szDeviceName.value.decode()
+    except AttributeError:
+        device_name = str(szDeviceName)
+    try:
+        index = int(device_name.rsplit('spcm',1)[1])
+    except (IndexError, ValueError):
+        return None
+    if index >= number_of_simulated_cards:
+        return None
+    logging.info('Opened simulated AWG card {}.'.format(device_name))
+    return SimulatedCard(device_name)
+
+def spcm_vClose(hDrv):
+    if hDrv is not None:
+        hDrv.wait_dma()
+        hDrv.running = False
+
+def spcm_dwGetErrorInfo_i32(hDrv, pdwErrorReg, plErrorValue, szErrorText):
+    return ERR_OK
+
+def spcm_dwGetParam_i32(hDrv, lReg, plValue):
+    if hDrv is None:
+        return ERR_INVALIDHANDLE
+    _set_ref(plValue,hDrv.get_param(lReg))
+    return ERR_OK
+
+def spcm_dwGetParam_i64(hDrv, lReg, pllValue):
+    return spcm_dwGetParam_i32(hDrv, lReg, pllValue)
+
+def spcm_dwSetParam_i32(hDrv, lReg, lValue):
+    if hDrv is None:
+        return ERR_INVALIDHANDLE
+    return hDrv.set_param(lReg,_get_value(lValue))
+
+def spcm_dwSetParam_i64(hDrv, lReg, llValue):
+    return spcm_dwSetParam_i32(hDrv, lReg, llValue)
+
+def spcm_dwSetParam_i64m(hDrv, lReg, lValueHigh, lValueLow):
+    return spcm_dwSetParam_i32(hDrv, lReg, (_get_value(lValueHigh) << 32) | _get_value(lValueLow))
+
+def spcm_dwDefTransfer_i64(hDrv, dwBufType, dwDirection, dwNotifySize, pvDataBuffer, qwBrdOffs, qwTransferLen):
+    if hDrv is None:
+        return ERR_INVALIDHANDLE
+    return hDrv.define_transfer(dwBufType,_get_value(dwDirection),_get_value(dwNotifySize),
+                                _get_address(pvDataBuffer),_get_value(qwBrdOffs),_get_value(qwTransferLen))
+
+def spcm_dwInvalidateBuf(hDrv, dwBufType):
+    if hDrv is None:
+        return ERR_INVALIDHANDLE
+    hDrv.transfer = None
+    return ERR_OK
+
+def spcm_dwGetContBuf_i64(hDrv, dwBufType, ppvDataBuffer, pqwContBufLen):
+    _set_ref(pqwContBufLen,0) # the simulated driver has no continuous buffer reserved
+    return ERR_OK
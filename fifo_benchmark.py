@@ -0,0 +1,26 @@
+"""Measures the sustained rate that static tones can be generated and streamed
+to the card in FIFO mode. Runs against the simulated card unless
+AWG_SIMULATE is set to 0 in the environment before running."""
+import os
+os.environ.setdefault('AWG_SIMULATE','1')
+
+import numpy as np
+from awg import AWG, FIFOStreamer, ToneChunkGenerator
+
+duration_s = 0.5
+buffer_bytes = 2**24
+notify_bytes = 2**18
+
+for num_tones in [1,5,20]:
+    for sample_rate_Hz in [int(25e6),int(100e6),int(625e6)]:
+        awg = AWG(active_channels=1,sample_rate_Hz=sample_rate_Hz,max_output_mV=100)
+        freqs_MHz = [np.linspace(1,10,num_tones)]
+        amps_mV = [np.full(num_tones,80/num_tones)]
+        generator = ToneChunkGenerator(freqs_MHz,amps_mV,awg.sample_rate_Hz,awg.max_output_mV)
+        streamer = FIFOStreamer(awg,generator,buffer_bytes,notify_bytes)
+        stats = streamer.stream(duration_s)
+        print('{:>3} tones at {:>4.0f} MS/s: streamed {:6.1f} MS/s, generator '
+              '{:6.1f} MS/s per core, minimum fill {:>4} promille, {} underruns'.format(
+              num_tones,sample_rate_Hz/1e6,stats['throughput_MSps'],stats['generate_MSps'],
+              stats['min_fill_promille'],stats['underruns']))
+        awg.close()
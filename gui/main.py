@@ -34,9 +34,9 @@ if __name__ == '__main__':
 
 main_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-from actions import ActionContainer, AmpAdjuster2D, shared_segment_params
-from rearrangement import RearrangementHandler
-from awg import AWG
+from actions import ActionContainer, AmpAdjuster2D, shared_segment_params, compress_looped_segments, calculate_segments
+from rearrangement import RearrangementHandler, get_rearrangement_handler_class
+from awg import AWG, plan_card_memory, log_memory_plan, save_bundle, load_bundle
 from networking.networker import Networker
 
 num_plot_points = 10
@@ -44,7 +44,7 @@ num_plot_points = 10
 dicts_to_save = ['card_settings','amp_adjuster_settings']
 datagen_settings_to_save = ['button_couple_steps_segments','button_prevent_freq_jumps',
                             'button_prevent_amp_jumps','button_freq_adjust_looped_segments',
-                            'button_prevent_phase_jumps','button_sync']
+                            'button_prevent_phase_jumps','button_sync','button_compress_looped_segments']
 
 class MainWindow(QMainWindow):
     """Acts as controller for the AWG program.
@@ -237,6 +237,9 @@ class MainWindow(QMainWindow):
         self.button_freq_adjust_looped_segments.clicked.connect(self.segment_list_update)
         layout_prevent_jumps.addWidget(self.button_freq_adjust_looped_segments,1,1,1,1)
         
+        self.button_compress_looped_segments = QCheckBox("Compress static segments into loops")
+        layout_prevent_jumps.addWidget(self.button_compress_looped_segments,2,1,1,1)
+        
         self.button_prevent_phase_jumps = QCheckBox("Enforce phase continuity between segments")
         self.button_prevent_phase_jumps.setEnabled(False)
         # layout_prevent_jumps.addWidget(self.button_prevent_phase_jumps,2,1,1,1)
@@ -420,6 +423,10 @@ class MainWindow(QMainWindow):
         self.button_calculate_csv.clicked.connect(self.export_segments_to_csv_dialogue)
         layout.addWidget(self.button_calculate_csv)
 
+        self.button_plan_card_memory = QPushButton('Check card memory plan (dry run)')
+        self.button_plan_card_memory.clicked.connect(self.plan_card_memory)
+        layout.addWidget(self.button_plan_card_memory)
+
         self.layout.addWidget(QHLine())
         self.layout.addLayout(layout)
     
@@ -557,6 +564,10 @@ class MainWindow(QMainWindow):
 
         for [rr_index, rr, params] in rrs_and_params:
             logging.debug(f'Loading rearrangement handler {rr_index} with params {params}')
+            handler_class = get_rearrangement_handler_class(params)
+            if type(rr) is not handler_class: # e.g. 2D parameters are being loaded into a 1D handler
+                rr = handler_class(self)
+                self.rrs[rr_index] = rr
             rr.load_params(params)
             self.rearr_toggle(rearr_index=rr_index) # toggle one at a time to ensure the right segments are on
 
@@ -667,22 +678,37 @@ class MainWindow(QMainWindow):
         self.button_autoplot.blockSignals(False)
         self.plot_autoplot_graphs()
     
-    def calculate_all_segments(self):
+    def calculate_all_segments(self,segments=None):
+        """Calculates the segments, passing the end phases of each segment 
+        through to the next. Segments that are identical to an earlier 
+        segment are only calculated once (see `calculate_segments`).
+
+        Parameters
+        ----------
+        segments : list of list of ActionContainer or None
+            The segments to calculate, e.g. the output of 
+            `compress_looped_segments`. If None, `segments` is used. The 
+            default is None.
+
+        Returns
+        -------
+        list of list of ActionContainer
+            The calculated segments, with duplicate segments sharing the 
+            same ActionContainers. These should be sent to the card instead 
+            of `segments`.
+
+        """
         logging.debug('Calculating all segments.')
-        for segment_index, segment in enumerate(self.segments):
-            for action_index, action in enumerate(segment):
-                if action.needs_to_calculate:
-                    logging.info('Calculating segment {}, channel {}.'.format(segment_index,action_index))
-                    if segment_index == 0:
-                        action.set_start_phase(None)
-                    else:
-                        end_phase = self.segments[segment_index-1][action_index].end_phase
-                        action.set_start_phase(end_phase)
-                    action.calculate()
+        if segments is None:
+            segments = self.segments
+        rearr_base_segments = self.get_rearr_base_segments()
+        exclude_segments = [i for i,segment in enumerate(segments) if segment in rearr_base_segments]
+        segments = calculate_segments(segments,exclude_segments)
         for rr in self.rrs:
             if rr.enabled:
                 rr.calculate_rearr_segment_data()
         # self.segment_list_update()
+        return segments
 
     def update_label_awg(self):
         self.label_awg.setText('<h2>{}</h2>'.format(self.name))
@@ -1159,7 +1185,9 @@ class MainWindow(QMainWindow):
             containing only the characters '0' (unoccupied) and '1' (occupied) 
             where traps are indexed in the same order as the `start_freq_MHz` 
             attribute. If more than one rearrangement handler is being used
-            then append RH followed by the index to pass the string to.
+            then append RH followed by the index to pass the string to. For
+            a 2D handler the string is the occupation matrix in row-major 
+            order (see `RearrangementHandler2D.get_loaded_traps`).
             
         Returns
         -------
@@ -1179,7 +1207,8 @@ class MainWindow(QMainWindow):
         segment_data = rr.accept_string(string) # segments data is returned as a list in case simultaneous rearrangements needed
         logging.debug(f'Recieved {len(segment_data)} segments, uploading to segments {rr.starting_segment + rr.segment} - {rr.starting_segment + rr.segment+len(segment_data)-1}.')
         for data_i, data in enumerate(segment_data):
-            self.awg.transfer_segment_data(rr.starting_segment+rr.segment+data_i,data)
+            self.awg.transfer_segment_data(self.awg.get_physical_segment(rr.starting_segment+rr.segment+data_i),data)
+        rr.fill_hot_pattern_cache() # prepare common patterns now, between shots
             
     def data_recieve(self,data_list):
         """Accepts data recieved from PyDex over TCP from the Networker to 
@@ -2066,8 +2095,8 @@ class MainWindow(QMainWindow):
             
     def export_segments_to_csv(self,export_directory):
         logging.debug('Saving all segments to csv.')
-        self.calculate_all_segments()
-        for seg_num,segment in enumerate(self.segments):
+        segments = self.calculate_all_segments()
+        for seg_num,segment in enumerate(segments):
             for channel in range(self.card_settings['active_channels']):
                 data = segment[channel].data
                 logging.debug('Saving segment {}, channel {} to csv.'.format(seg_num,channel))
@@ -2075,13 +2104,87 @@ class MainWindow(QMainWindow):
                 np.savetxt(filename, data, delimiter=",")
         logging.debug('Saving all segments to csv complete.')
                 
-    def calculate_send(self):
-        """Sends the data to the AWG card."""
-        self.calculate_all_segments()
+    def calculate_send(self,bundle_filename=None):
+        """Sends the data to the AWG card.
+        
+        If the option to compress static segments is checked, long static 
+        segments are replaced by a short looped segment before they are 
+        calculated (see `compress_looped_segments`). The segments shown in 
+        the GUI are not changed.
+        
+        Parameters
+        ----------
+        bundle_filename : str or None
+            If not None, the .awg file that the segments were loaded from. 
+            The calculated data is saved as a compiled bundle alongside it 
+            (see `awg.sequence_bundle`) so that the next `load_send` of the 
+            same file does not need to recalculate. The default is None.
+        
+        """
+        if self.button_compress_looped_segments.isChecked():
+            rearr_base_segments = self.get_rearr_base_segments()
+            exclude_segments = [i for i,segment in enumerate(self.segments) if segment in rearr_base_segments]
+            segments, steps, _ = compress_looped_segments(self.segments,self.steps,self.card_settings,exclude_segments)
+        else:
+            segments, steps = self.segments, self.steps
+        segments = self.calculate_all_segments(segments)
         if not self.testing:
-            self.awg.load_all(self.segments, self.steps)
+            self.awg.load_all(segments, steps)
+            if bundle_filename is not None:
+                save_bundle(bundle_filename,self.awg,segments,steps)
         self.segment_list_update()
     
+    def load_send(self,filename):
+        """Loads the params from a .awg file and sends them to the AWG card.
+        
+        If a compiled bundle saved alongside the file is still valid for 
+        the file, card and calibrations, its data is uploaded directly 
+        without being recalculated. Otherwise the segments are calculated 
+        and the bundle is saved for next time. Bundles are not used whilst 
+        rearrangement is enabled because the rearrangement segments are 
+        calculated by the `RearrangementHandler`.
+        
+        Parameters
+        ----------
+        filename : str
+            The .awg file to load.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        self.load_params(filename)
+        if self.testing or any(rr.enabled for rr in self.rrs):
+            self.calculate_send()
+            return
+        bundle = load_bundle(filename,self.awg)
+        if bundle is None:
+            self.calculate_send(bundle_filename=filename)
+        else:
+            segment_data, segment_keys, steps = bundle
+            self.awg.load_compiled(segment_data,segment_keys,steps)
+            self.segment_list_update()
+    
+    def plan_card_memory(self):
+        """Checks whether the current segments and steps fit in the card 
+        memory and estimates the time needed to calculate and transfer them. 
+        No data is calculated or sent to the card. The plan is logged.
+        
+        Returns
+        -------
+        str
+            A JSON summary of the plan that can be returned over TCP.
+        
+        """
+        try:
+            memory_samples = self.awg.get_memory_samples()
+        except Exception:
+            logging.debug('Could not read the card memory size so assuming the default.')
+            memory_samples = None
+        plan = plan_card_memory(self.segments,self.steps,self.card_settings,self.rrs,memory_samples=memory_samples)
+        return log_memory_plan(plan)
+    
     def awg_trigger(self):
         """Forces the AWG to trigger with a software trigger. This is 
         wrapped in a seperate function so that this method can be 
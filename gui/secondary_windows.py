@@ -30,7 +30,7 @@ class CardSettingsWindow(QWidget):
         for key in list(self.card_settings.keys()):
             if key == 'active_channels':
                 widget = QComboBox()
-                widget.addItems(['1','2'])
+                widget.addItems(['1','2','4'])
                 widget.setCurrentText(str(self.card_settings[key]))
             elif key == 'number_of_segments':
                 widget = QComboBox()
@@ -453,10 +453,14 @@ class RearrSettingsWindow(QWidget):
             for row in range(rr_widget.layout_rearr_settings.rowCount()):
                 key = rr_widget.layout_rearr_settings.itemAt(row,0).widget().text()
                 widget = rr_widget.layout_rearr_settings.itemAt(row,1).widget()
-                if key == 'channel':
+                if key in ['channel','channel_y']:
                     value = int(widget.currentText())
-                elif key == 'mode':
+                elif key in ['mode','overflow']:
                     value = widget.currentText()
+                elif key == 'full_library':
+                    value = widget.currentText() == 'True'
+                elif key == 'max_jerk_MHz_per_ms3':
+                    value = float(widget.text())
                 elif 'freq' in key:
                     try:
                         value = convert_str_to_list(widget.text())
@@ -490,12 +494,14 @@ class RearrHandlerWidget(QWidget):
         layout.addWidget(QLabel(f'Rearrangement Handler {self.index}'))
 
         settings = ['start_freq_MHz','target_freq_MHz','channel','segment',
-                    'mode','starting_segment']
+                    'mode','overflow','full_library','max_jerk_MHz_per_ms3','starting_segment']
+        if 'channel_y' in self.rr.params_to_save: # 2D handler
+            settings += ['channel_y','start_freq_y_MHz','target_freq_y_MHz']
 
         self.layout_rearr_settings = QFormLayout()
         for key in settings:
             value = getattr(self.rr,key)
-            if key == 'channel':
+            if key in ['channel','channel_y']:
                 widget = QComboBox()
                 widget.addItems([str(x) for x in list(range(self.mainWindow.card_settings['active_channels']))])
                 widget.setCurrentText(str(value))
@@ -503,6 +509,14 @@ class RearrHandlerWidget(QWidget):
                 widget = QComboBox()
                 widget.addItems(['simultaneous','sequential'])
                 widget.setCurrentText(str(value))
+            elif key == 'overflow':
+                widget = QComboBox()
+                widget.addItems(['clip','rescale'])
+                widget.setCurrentText(str(value))
+            elif key == 'full_library':
+                widget = QComboBox()
+                widget.addItems(['False','True'])
+                widget.setCurrentText(str(value))
             else:
                 widget = QLineEdit()
                 widget.setText(str(value))
@@ -70,7 +70,9 @@ class Networker():
         -----------------------------------------------------------
         *load* = filename
             Loads the AWGparams file located in the path defined by filename 
-            (str) into the interface. It then sends this data to the card.
+            (str) into the interface. It then sends this data to the card, 
+            using the compiled bundle saved alongside the file if it is 
+            still valid.
         *save* = filename
             Saves the AWGparams loaded into the interface to the path defined 
             by filename (str). Note that the parameters in the interface are 
@@ -78,6 +80,10 @@ class Networker():
             might not be the settings currently on the card!
         *trigger* = None
             Forces a trigger on the AWG card.
+        *plan* = None
+            Checks whether the segments and steps loaded into the interface 
+            fit in the card memory without sending any data to the card. A 
+            JSON summary of the plan is sent back to PyDex.
         *rearrange* = rearrange_occupancy (e.g. 001001)
             Triggers the segment of the rearrangement step to be updated based 
             on the rearrange_occupancy (binary string)
@@ -148,9 +154,8 @@ class Networker():
             self.server.priority_messages([[1,'go'*1000]])
         elif 'load' in command:
             filename_stripped = arg.rsplit('.',1)[0]
-            self.main_window.load_params(filename_stripped+'.awg')
             # self.main_window.load_rearr_params(filename_stripped+'.awgrr')
-            self.main_window.calculate_send()
+            self.main_window.load_send(filename_stripped+'.awg')
         elif 'save' in command:
             filename_stripped = arg.rsplit('.',1)[0]
             self.main_window.save_params(filename_stripped+'.awg')
@@ -158,6 +163,10 @@ class Networker():
         elif 'trigger' in command:
             logging.info('Triggering AWG as requested by TCP command.')
             self.main_window.awg.trigger()
+        elif 'plan' in command:
+            logging.info('Planning card memory as requested by TCP command.')
+            summary = self.main_window.plan_card_memory()
+            self.server.priority_messages([[1,summary]])
         elif 'rearrange' in command:
             if all(x in '01' for x in arg):
                 logging.info("Rearrangement string '{}' recieved.".format(arg))
@@ -1 +1,2 @@
-from .rearrangement_handler import RearrangementHandler
\ No newline at end of file
+from .rearrangement_handler import RearrangementHandler
+from .rearrangement_handler_2d import RearrangementHandler2D, get_rearrangement_handler_class
@@ -1,24 +1,44 @@
 import logging
 logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
 
+import os
 import sys
 import inspect
 import numpy as np
 import re
 import json
+import hashlib
 
 import itertools
+from collections import Counter
+import math
 import time
+import tempfile
 from copy import copy
 
 from os import path, makedirs
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
-from actions import ActionContainer, shared_segment_params
+from actions import ActionContainer, shared_segment_params, can_batch_move_tones, calculate_move_tones
 
 params_to_save = ['start_freq_MHz','target_freq_MHz','channel','segment',
-                  'mode','starting_segment','enabled']
+                  'mode','overflow','full_library','max_jerk_MHz_per_ms3','starting_segment','enabled']
 
 max_tone_num = 100
+max_cached_movements = 2**16 # occupation strings whose movements are remembered by accept_string
+hot_pattern_cache_size = 8 # number of fully prepared segments of common occupation patterns kept, see fill_hot_pattern_cache
+hot_pattern_min_count = 3 # occurrences before a pattern's segment is cached
+hot_pattern_interval = 10 # shots between checks for new patterns to cache
+summation_chunk_samples = 2**16 # samples of the move tones summed at a time so the scratch buffers stay in cache
+move_tone_workers = 4 # threads used to calculate the movement tones, see actions.calculate_move_tones
+phase_seed = 817 # seed for the random start phases of the movement tones
+library_version = 4 # increase if the format or calculation of the movement libraries changes
+library_directory = path.join(path.dirname(path.abspath(__file__)),'library')
+
+def get_library_filenames(library_hash):
+    """Returns the data and index filenames of the movement library with 
+    the hash `library_hash` (see `RearrangementHandler.get_library_hash`)."""
+    library_filename = path.join(library_directory,library_hash+'.npy')
+    return library_filename, path.join(library_directory,library_hash+'.json')
 
 class RearrangementHandler():
     """Handler for rearrangement functionality. Takes strings from 
@@ -54,19 +74,59 @@ class RearrangementHandler():
     base_segments : list of lists of `ActionContainers`
         The ActionContainers containing the base rearrangement data to 
         send to the card with all other segments.
-    rearr_segments : list of lists of `ActionContainers`
-        The ActionContainers containing the segment data to be sent 
-        to the card during runtime.
+    rearr_movements : dict
+        The random start phase (in degrees) of the tone of each movement, 
+        keyed by the (start_freq_MHz, end_freq_MHz) tuple.
+    empty_actions : list of `ActionContainers`
+        The actions of the empty segment used to pad out the rearrangement
+        segments in 'sequential' mode.
+    overflow : {'clip','rescale'}
+        What to do in 'simultaneous' mode if the sum of the move tones is 
+        larger than the int16 range of the card. 'clip' saturates the 
+        samples that are over range whereas 'rescale' scales the whole 
+        rearrangement channel so that the peak is at full scale.
+    overflow_samples : int
+        The number of samples of the last rearrangement segment prepared by
+        `accept_string` that were over range.
+    full_library : bool
+        If True, the tone of every (start trap, target trap) movement is 
+        precalculated rather than only the movements used by `get_movements`
+        so that the tones for any assignment of loaded traps to target 
+        traps are available at runtime.
+    max_jerk_MHz_per_ms3 : float
+        If non-zero, each movement only lasts as long as is needed to keep 
+        the jerk of a minimum jerk trajectory below this value (see 
+        `get_move_samples`), up to the duration of the base rearrangement 
+        segment. Sequential segments are then only as long as their 
+        movement and simultaneous segments end when the longest movement 
+        has finished. The other channels play the end of their base segment
+        data in shorter segments, so that they finish with the phases that
+        the following segments continue from. If 0, every movement has the 
+        duration of the base segment.
+    rearr_library : numpy.memmap of int16 or None
+        The precalculated int16 data, saved in `library_directory`. There is
+        one row with the rearrangement channel data of each movement, and 
+        one row per channel for the empty segment and for the other 
+        channels (which are the same for every movement). Rows are paged in
+        from disk as they are used so the library does not have to fit in 
+        memory.
+    library_index : dict
+        The row of `rearr_library` holding each movement, keyed by the 
+        (start_freq_MHz, end_freq_MHz) tuple.
     """
     
-    def __init__(self,main_window,filename):
+    params_to_save = params_to_save
+
+    def __init__(self,main_window,filename=None):
         """Create the `RearrangementHandler` object and assign its attributes.        
 
         Parameters
         ----------
-        filename : str
+        filename : str or None
             The location of the filename to load the default 
-            rearrangement parameters from.
+            rearrangement parameters from. If None, the parameters must be 
+            loaded with `load_params` before the handler is used. The 
+            default is None.
 
         Returns
         -------
@@ -76,8 +136,15 @@ class RearrangementHandler():
         self.enabled = False
         self.starting_segment = 0 # index to place the rearr handler at when enabled
         self.mode = 'simultaneous' # specified here to maintain compatability with older .awgrr files.
+        self.overflow = 'clip'
+        self.overflow_samples = 0
+        self.full_library = False
+        self.max_jerk_MHz_per_ms3 = 0
+        self.rearr_library = None
+        self.library_index = {}
         self.main_window = main_window
-        self.load_params_from_file(filename)
+        if filename is not None:
+            self.load_params_from_file(filename)
         
     def create_actions(self,segment_params_list=None):
         """Creates the `ActionContainer` objects that contains the 
@@ -117,103 +184,76 @@ class RearrangementHandler():
                     segment.append(action)
                 self.base_segments.append(segment)
         
-        for segment_index, segment in enumerate(self.base_segments):
-            for channel, action in enumerate(segment):
-                if channel == self.channel:
-                    if segment_index < self.segment:
-                        action.update_param('freq','start_freq_MHz',self.start_freq_MHz)
-                        action.update_param('freq','end_freq_MHz',self.target_freq_MHz)
-                    elif segment_index == self.segment:
-                        action.update_param('freq','start_freq_MHz',self.start_freq_MHz)
-                        action.update_param('freq','end_freq_MHz',self.target_freq_MHz)
-                    else:
-                        action.update_param('freq','start_freq_MHz',self.target_freq_MHz)
-                        action.update_param('freq','end_freq_MHz',self.target_freq_MHz)
-
+        self.update_base_freqs(self.channel,self.start_freq_MHz,self.target_freq_MHz)
         self.create_rearr_actions()
 
-    def create_rearr_actions(self):
-        """Creates a list of movements for the different rearrangement
-        segments and assigns these to a rearrangement keys. During runtime 
-        the correct tones are picked from the dictionary and summed.
-        """
-        np.random.seed(817)
-        base_segment = self.base_segments[self.segment]
-
-        occupation_start_freqs = self.get_occupation_freqs()
-        
-        self.rearr_movements = []
-
-        for start_freqs_MHz,occupation in zip(occupation_start_freqs,self.occupations):
-            num_occupied_traps = occupation.count('1')
-            rr_start_freqs_MHz = start_freqs_MHz[:num_occupied_traps]
-            rr_target_freqs_MHz = self.target_freq_MHz[:num_occupied_traps]
+    def update_base_freqs(self,channel,start_freq_MHz,target_freq_MHz):
+        """Sets the frequencies of the actions of a channel in the base 
+        segments: up to and including the rearrangement segment the tones 
+        start at the start traps and after it they are at the target traps.
 
-            # Need to know whether frequency moves left or right
-            direction = self.start_freq_MHz[1] - self.start_freq_MHz[0]
-
-            freq_pairs = list(zip(rr_start_freqs_MHz,rr_target_freqs_MHz))
-            freq_movements = []
-
-            for freq_pair in freq_pairs:
-                diff = (freq_pair[1]-freq_pair[0]) * direction
-                if diff <= 0:
-                    freq_movements.append(freq_pair)
+        Parameters
+        ----------
+        channel : int
+            The channel to update.
+        start_freq_MHz : list of float
+            The frequencies of the start traps.
+        target_freq_MHz : list of float
+            The frequencies of the target traps.
 
-            for freq_pair in reversed(freq_pairs):
-                diff = (freq_pair[1]-freq_pair[0]) * direction
-                if diff > 0:
-                    freq_movements.append(freq_pair)
+        Returns
+        -------
+        None.
 
-            self.rearr_movements.append(freq_movements)
+        """
+        for segment_index, segment in enumerate(self.base_segments):
+            action = segment[channel]
+            if segment_index < self.segment:
+                action.update_param('freq','start_freq_MHz',start_freq_MHz)
+                action.update_param('freq','end_freq_MHz',target_freq_MHz)
+            elif segment_index == self.segment:
+                action.update_param('freq','start_freq_MHz',start_freq_MHz)
+                action.update_param('freq','end_freq_MHz',target_freq_MHz)
+            else:
+                action.update_param('freq','start_freq_MHz',target_freq_MHz)
+                action.update_param('freq','end_freq_MHz',target_freq_MHz)
 
+    def create_rearr_actions(self):
+        """Creates the list of movements for the different rearrangement
+        segments and assigns each a random start phase. The data of each 
+        movement is calculated by `calculate_rearr_segment_data`. During 
+        runtime the correct tones are picked from the dictionary and summed.
         
-        self.rearr_unique_movements = set(itertools.chain.from_iterable(self.rearr_movements))
+        Only the actions for the empty segment are created here. The 
+        actions for a movement can be created with `create_move_actions`.
+        """
+        self.movement_cache = {}
+
+        # The n-th loaded trap is moved to the n-th target trap, so the start
+        # trap i can only be moved to target traps j <= i unless every 
+        # movement has been requested.
+        self.rearr_unique_movements = set()
+        for target_index, target_freq_MHz in enumerate(self.target_freq_MHz):
+            if self.full_library:
+                start_freqs_MHz = self.start_freq_MHz
+            else:
+                start_freqs_MHz = self.start_freq_MHz[target_index:]
+            for start_freq_MHz in start_freqs_MHz:
+                self.rearr_unique_movements.add((start_freq_MHz,target_freq_MHz))
 
-        logging.debug('Calculated rearrangement movements {}'.format(self.rearr_movements))
         logging.debug('Unique rearrangement movements are {}'.format(self.rearr_unique_movements))
 
-        self.rearr_segments = {}
-        for start_freq_MHz,end_freq_MHz in self.rearr_unique_movements:
-            try:
-                start_freq_dict = self.rearr_segments[start_freq_MHz]
-            except KeyError: # key does not exist yet so make the dict and store it
-                self.rearr_segments[start_freq_MHz] = {}
-                start_freq_dict = self.rearr_segments[start_freq_MHz]
-            actions = [] # store the action for all channels
-            for channel in range(self.main_window.card_settings['active_channels']):
-                if channel == self.channel:
-                    rearr_action_params = base_segment[channel].get_action_params()
-                    freq_params = rearr_action_params['freq']
-                    amp_params = rearr_action_params['amp']                   
-
-                    for key,value in freq_params.items():
-                        if key == 'start_freq_MHz':
-                            freq_params[key] = [start_freq_MHz]
-                        elif key == 'end_freq_MHz':
-                            freq_params[key] = [end_freq_MHz]
-                        elif key == 'function':
-                            pass
-                        else:
-                            freq_params[key] = [freq_params[key][0]] # only want one tone so only keep the first entry in the list
-                    for key,value in amp_params.items():
-                        if key == 'function':
-                            pass
-                        else:
-                            amp_params[key] = [amp_params[key][0]]
-
-                    action = ActionContainer(rearr_action_params,self.main_window.card_settings,self.main_window.amp_adjusters[channel])
-                    action.rearr = True
-                    action.update_param(param='phase_behaviour',value=['manual'])
-                    action.set_start_phase([np.random.random()*360]) # sets phase to random in degrees
-                    actions.append(action)
-                else:
-                    actions.append(base_segment[channel])
-            start_freq_dict[end_freq_MHz] = actions
+        # the phases are drawn from a local generator so that a library saved to disk can be reproduced 
+        # (see get_library_hash) without making the global numpy random state deterministic
+        rng = np.random.default_rng(phase_seed)
+        self.rearr_movements = {}
+        for start_freq_MHz,end_freq_MHz in sorted(self.rearr_unique_movements):
+            self.rearr_movements[(start_freq_MHz,end_freq_MHz)] = rng.random()*360 # random start phase in degrees
 
         # make an empty action that can be used to pad out extra segments if not needed in sequential rearrangement mode
         # just use the last defined start_freq_MHz,end_freq_MHz because the freq doesn't matter
-        actions = [] # store the action for all channels
+        base_segment = self.base_segments[self.segment]
+        self.empty_actions = [] # store the action for all channels
         for channel in range(self.main_window.card_settings['active_channels']):
 
             # just make the same empty segment for all channels
@@ -235,9 +275,65 @@ class RearrangementHandler():
             action.rearr = True
             action.update_param(param='phase_behaviour',value=['manual'])
             action.set_start_phase([np.random.random()*360]) # sets phase to random in degrees
-            actions.append(action)
-        self.rearr_segments['empty'] = {}
-        self.rearr_segments['empty']['empty'] = actions # still make dict 2 levels deep so that the rest of the code works
+            self.empty_actions.append(action)
+
+    def create_move_actions(self,start_freq_MHz,end_freq_MHz,start_phase,duration_ms=None):
+        """Creates the actions of a single movement. The rearrangement 
+        channel has a single tone moving from `start_freq_MHz` to 
+        `end_freq_MHz` and the other channels use the actions of the base 
+        rearrangement segment.
+
+        Parameters
+        ----------
+        start_freq_MHz : float
+            The frequency of the start trap.
+        end_freq_MHz : float
+            The frequency of the target trap.
+        start_phase : float
+            The start phase of the tone in degrees.
+        duration_ms : float or None
+            The duration of the movement. If None, the duration of the base 
+            rearrangement segment is used. The default is None.
+
+        Returns
+        -------
+        list of ActionContainer
+            The action for each channel.
+
+        """
+        base_segment = self.base_segments[self.segment]
+        actions = [] # store the action for all channels
+        for channel in range(self.main_window.card_settings['active_channels']):
+            if channel == self.channel:
+                rearr_action_params = base_segment[channel].get_action_params()
+                if duration_ms is not None:
+                    rearr_action_params['duration_ms'] = duration_ms
+                freq_params = rearr_action_params['freq']
+                amp_params = rearr_action_params['amp']                   
+
+                for key,value in freq_params.items():
+                    if key == 'start_freq_MHz':
+                        freq_params[key] = [start_freq_MHz]
+                    elif key == 'end_freq_MHz':
+                        freq_params[key] = [end_freq_MHz]
+                    elif key == 'function':
+                        pass
+                    else:
+                        freq_params[key] = [freq_params[key][0]] # only want one tone so only keep the first entry in the list
+                for key,value in amp_params.items():
+                    if key == 'function':
+                        pass
+                    else:
+                        amp_params[key] = [amp_params[key][0]]
+
+                action = ActionContainer(rearr_action_params,self.main_window.card_settings,self.main_window.amp_adjusters[channel])
+                action.rearr = True
+                action.update_param(param='phase_behaviour',value=['manual'])
+                action.set_start_phase([start_phase])
+                actions.append(action)
+            else:
+                actions.append(base_segment[channel])
+        return actions
 
     def get_number_rearrangement_segments_needed(self):
         """Returns the number of rearrangement segments that the need to be
@@ -256,101 +352,396 @@ class RearrangementHandler():
         return range(self.starting_segment,self.starting_segment+len(self.base_segments))
 
     def calculate_rearr_segment_data(self):
-        """Takes the data from the ActionContainers for the rearrangement 
-        segments and precalculates the int16 data to be sent to the card at 
-        runtime. Each tone corresponding to the movement from one trap to 
-        another is calculated. These tones will then be summed at runtime so 
-        that the transfer is performed as quickly as possible whilst minimising
-        the number of initial calculations needed.
+        """Precalculates the int16 data to be sent to the card at runtime. 
+        Each tone corresponding to the movement from one trap to another is 
+        calculated. These tones will then be summed at runtime so that the 
+        transfer is performed as quickly as possible whilst minimising the 
+        number of initial calculations needed.
+        
+        If the frequency profile of the movements allows it (see 
+        `actions.can_batch_move_tones`) all of the movement tones are 
+        calculated together, otherwise the actions of each movement are 
+        created and calculated one at a time. The data of the other channels
+        is the same for every movement so is only calculated once.
+        
+        The int16 data is stored in a movement library on disk which is 
+        memory-mapped into `rearr_library`. Only the rearrangement channel 
+        is stored for each movement; the data of the other channels and of 
+        the empty segment is stored once and multiplexed in at runtime. 
+        Libraries are named by `get_library_hash` so if the same handler 
+        parameters have been calculated before (in any process) the library
+        is loaded instead of being recalculated.
         
         Returns
         -------
         None.
         """
-        self.rearr_segments_data = {}
+        library_hash = self.get_library_hash()
+        if self.load_library(library_hash):
+            return
 
-        i_seg = 1
-        for start_freq_MHz in self.rearr_segments:
-            try:
-                start_freq_dict = self.rearr_segments_data[start_freq_MHz]
-            except KeyError: # key does not exist yet so make the dict and store it
-                self.rearr_segments_data[start_freq_MHz] = {}
-                start_freq_dict = self.rearr_segments_data[start_freq_MHz]
-            for end_freq_MHz in self.rearr_segments[start_freq_MHz]:
-                segment = self.rearr_segments[start_freq_MHz][end_freq_MHz]
-                segment_data = []
-                for action_index, action in enumerate(segment):
-                    if action.needs_to_calculate:
-                        logging.info(f'Calculating rearrangement movement {start_freq_MHz} MHz -> {end_freq_MHz} MHz '
-                                     f'({i_seg}/{len(self.rearr_unique_movements)}) data, channel {action_index}.')
-                        # action.set_start_phase(None)
-                        action.calculate()
-                    segment_data.append(np.int16(action.data*(2**15/self.main_window.awg.max_output_mV))) # convert to int16 here to save time later
-                # can't multiplex here because we need to sum the rearrangement channel first
-                if self.mode == 'sequential': # if mode is sequential, we can multiplex here to save time later.
-                    if self.main_window.card_settings['active_channels'] > 1: # note we've assumed max 2 active channels
-                        segment_data_multiplexed = np.empty((segment_data[0].size + segment_data[0].size,), dtype=segment_data[0].dtype)
-                        segment_data_multiplexed[0::2] = segment_data[0]
-                        segment_data_multiplexed[1::2] = segment_data[1]
-                        segment_data = segment_data_multiplexed
-                    else:
-                        segment_data = segment_data[0] # remove from list because we have done the multiplexing (but only 1 channel)
-                i_seg += 1
-                self.rearr_segments_data[start_freq_MHz][end_freq_MHz] = segment_data
-    
-    def generate_segment_ids(self):
-        """Generates the potential segment ids to index segments.
-        
-        Uses the itertools Cartesian product method then selects the correct 
-        strings after all permuations have been generated. This was ~ 4 orders 
-        of magnitude faster than generating different permutations of strings 
-        due to lack of repition, which failed when scaling up to higher trap
-        numbers.
+        conversion = 2**15/self.main_window.awg.max_output_mV
+        num_channels = len(self.empty_actions)
+        num_samples = self.empty_actions[0].time.size-1
+        base_segment = self.base_segments[self.segment]
+        batched = can_batch_move_tones(base_segment[self.channel])
+        if self.max_jerk_MHz_per_ms3 and not batched:
+            logging.warning(f"Distance dependent move durations are not supported for the '{base_segment[self.channel].freq_function_name}' "
+                            'frequency function so all movements will use the duration of the base segment.')
         
-        Ids are ordered to prioritise the earlier traps in the `start_freq_MHz`
-        attribute.
+        # movements are sorted by length so that movements with the same duration are calculated together
+        movements = [(start_freq_MHz,end_freq_MHz,start_phase) for (start_freq_MHz,end_freq_MHz),start_phase in self.rearr_movements.items()]
+        self.move_samples = {(start_freq_MHz,end_freq_MHz) : self.get_move_samples(start_freq_MHz,end_freq_MHz,num_samples) if batched else num_samples 
+                             for (start_freq_MHz,end_freq_MHz,_) in movements}
+        movements.sort(key=lambda movement: self.move_samples[movement[:2]])
+        self.library_index = {(start_freq_MHz,end_freq_MHz) : row for row,(start_freq_MHz,end_freq_MHz,_) in enumerate(movements)}
+        self.empty_rows = [len(movements)+channel for channel in range(num_channels)]
+        self.empty_samples = min(num_samples,self.main_window.card_settings['segment_min_samples']) if self.max_jerk_MHz_per_ms3 else num_samples
+        self.static_rows = [len(movements)+num_channels+channel for channel in range(num_channels)]
+        self.static_rows[self.channel] = None # the rearrangement channel has no static data
+
+        # the float data is freed after conversion to int16 so only the library is kept
+        self.create_library(library_hash,(len(movements)+2*num_channels,num_samples))
+        for channel,action in enumerate(self.empty_actions):
+            action.calculate()
+            np.copyto(self.rearr_library[self.empty_rows[channel]],action.data*conversion,casting='unsafe') # convert to int16 here to save time later
+            action.data = None
+            action.needs_to_calculate = True
         
+        for channel in range(num_channels):
+            if channel != self.channel: # these channels are the same for every movement so are only stored once
+                base_segment[channel].calculate()
+                np.copyto(self.rearr_library[self.static_rows[channel]],base_segment[channel].data*conversion,casting='unsafe')
+
+        rearr_rows = self.rearr_library[:len(movements)]
+        if len(movements) == 0:
+            pass
+        elif batched:
+            logging.info(f'Calculating {len(movements)} rearrangement movements.')
+            first_row = 0
+            for move_samples, group in itertools.groupby(movements,key=lambda movement: self.move_samples[movement[:2]]):
+                group = list(group)
+                duration_ms = move_samples/self.main_window.card_settings['sample_rate_Hz']*1e3
+                template_action = self.create_move_actions(*group[0],duration_ms=duration_ms)[self.channel]
+                calculate_move_tones(template_action,group,rearr_rows[first_row:first_row+len(group)],conversion,workers=move_tone_workers)
+                first_row += len(group)
+        else:
+            for row,movement in enumerate(movements):
+                logging.info(f'Calculating rearrangement movement {movement[0]} MHz -> {movement[1]} MHz '
+                             f'({row+1}/{len(movements)}) data, channel {self.channel}.')
+                action = self.create_move_actions(*movement)[self.channel]
+                action.calculate()
+                np.copyto(rearr_rows[row],action.data*conversion,casting='unsafe')
+        self.rearr_library.flush()
+
+        if self.library_tmp_filename is None: # the library could not be saved so use the temporary file
+            self.set_library(self.rearr_library,self.library_index,self.move_samples,
+                             self.empty_rows,self.empty_samples,self.static_rows)
+            return
+        library_filename, index_filename = get_library_filenames(library_hash)
+        self.rearr_library = None # the memmap must be closed before the file can be renamed
+        try:
+            os.replace(self.library_tmp_filename,library_filename)
+            index_tmp_filename = '{}.{}.tmp'.format(index_filename,os.getpid())
+            with open(index_tmp_filename,'w') as f:
+                json.dump({'version' : library_version,
+                           'rows' : [[start,end,row,self.move_samples[(start,end)]] for (start,end),row in self.library_index.items()],
+                           'empty_rows' : self.empty_rows,
+                           'empty_samples' : self.empty_samples,
+                           'static_rows' : self.static_rows},f)
+            os.replace(index_tmp_filename,index_filename)
+        except OSError as e:
+            logging.warning(f'Could not save rearrangement library {library_filename}: {e}')
+        if not self.load_library(library_hash):
+            raise RuntimeError(f'Failed to reload rearrangement library {library_filename}.')
+        logging.info(f'Saved rearrangement library {library_filename}.')
+
+    def get_move_samples(self,start_freq_MHz,end_freq_MHz,max_samples):
+        """Returns the number of samples (per channel) that a movement 
+        takes. If `max_jerk_MHz_per_ms3` is set, this is the shortest 
+        duration for which a minimum jerk trajectory between the traps 
+        (which has peak jerk 60*distance/duration**3) does not exceed the 
+        maximum jerk, so short movements finish sooner. The number of 
+        samples is rounded up to a valid segment size.
+
+        Parameters
+        ----------
+        start_freq_MHz : float
+            The frequency of the start trap.
+        end_freq_MHz : float
+            The frequency of the target trap.
+        max_samples : int
+            The number of samples of the base rearrangement segment, which
+            no movement will be longer than.
+
         Returns
         -------
-        None. Generated occupations are stored as the attribute `occupations`.
-        
+        int
+            The number of samples.
+
         """
+        if not self.max_jerk_MHz_per_ms3:
+            return max_samples
+        card_settings = self.main_window.card_settings
+        duration_ms = (60*abs(end_freq_MHz-start_freq_MHz)/self.max_jerk_MHz_per_ms3)**(1/3)
+        step_samples = card_settings['segment_step_samples']
+        num_samples = math.ceil(duration_ms*1e-3*card_settings['sample_rate_Hz']/step_samples)*step_samples
+        return int(min(max(num_samples,card_settings['segment_min_samples']),max_samples))
+
+    def create_library(self,library_hash,shape):
+        """Creates the memory-mapped array that the movement library is 
+        calculated into, in a temporary file in `library_directory` which 
+        is renamed once the library is complete. If this cannot be created, 
+        an anonymous temporary file is used instead and the library will not
+        be saved.
+
+        Parameters
+        ----------
+        library_hash : str
+            The hash of the library being calculated.
+        shape : tuple of int
+            The shape of the library, (number of rows, ...row shape).
+
+        Returns
+        -------
+        None.
+
+        """
+        library_filename, _ = get_library_filenames(library_hash)
+        self.library_tmp_filename = '{}.{}.tmp'.format(library_filename,os.getpid())
+        try:
+            makedirs(library_directory,exist_ok=True)
+            self.rearr_library = np.lib.format.open_memmap(self.library_tmp_filename,mode='w+',
+                                                           dtype=np.int16,shape=shape)
+        except OSError as e:
+            logging.warning(f'Could not create rearrangement library {library_filename}: {e}. '
+                            'The library will not be saved.')
+            self.library_tmp_filename = None
+            self.library_file = tempfile.TemporaryFile() # removed when the file is closed
+            self.rearr_library = np.memmap(self.library_file,dtype=np.int16,mode='w+',shape=shape)
+        logging.info('Created rearrangement library for {} movements ({:.1f} MB).'.format(
+                     shape[0],self.rearr_library.nbytes/1e6))
+
+    def get_library_hash(self):
+        """Returns the hash of everything that changes the precalculated 
+        rearrangement data: the handler parameters (including the base 
+        segments), the card settings that change the int16 data, the 
+        settings of the amp adjusters and the modification times of their 
+        calibration files and the seed of the random movement phases.
+
+        Returns
+        -------
+        str
+            The hex digest that names the library.
+
+        """
+        params = self.get_params()
+        for param in ['enabled','starting_segment','overflow']: # do not change the data
+            params.pop(param)
+        adjuster_settings = [amp_adjuster.get_settings() for amp_adjuster in self.main_window.amp_adjusters]
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps([library_version,phase_seed,params,adjuster_settings,
+                             self.main_window.card_settings['active_channels'],
+                             self.main_window.awg.sample_rate_Hz,
+                             self.main_window.awg.max_output_mV],sort_keys=True).encode())
+        calibration_filenames = [settings.get('filename') for settings in adjuster_settings]
+        for segment in params['base_segments']:
+            for value in segment.values():
+                if isinstance(value,dict):
+                    calibration_filenames.append(value.get('amp_comp_filename'))
+        for filename in calibration_filenames:
+            try:
+                stat = os.stat(filename)
+                h.update('{}:{}:{}'.format(path.abspath(filename),stat.st_mtime_ns,stat.st_size).encode())
+            except (OSError,TypeError,ValueError):
+                h.update(repr(filename).encode())
+        return h.hexdigest()
+
+    def load_library(self,library_hash):
+        """Memory-maps a previously saved movement library and uses it as 
+        the rearrangement data.
+
+        Parameters
+        ----------
+        library_hash : str
+            The hash of the library, see `get_library_hash`.
+
+        Returns
+        -------
+        bool
+            Whether the library was found and loaded.
+
+        """
+        library_filename, index_filename = get_library_filenames(library_hash)
+        try:
+            with open(index_filename,'r') as f:
+                index = json.load(f)
+            library = np.load(library_filename,mmap_mode='r')
+        except (OSError,ValueError):
+            logging.debug(f'No rearrangement library found for hash {library_hash}.')
+            return False
+        if index.get('version') != library_version:
+            return False
+        self.set_library(library,{(start,end) : row for start,end,row,_ in index['rows']},
+                         {(start,end) : samples for start,end,_,samples in index['rows']},
+                         index['empty_rows'],index['empty_samples'],index['static_rows'])
+        logging.info(f'Loaded rearrangement library {library_filename}.')
+        return True
+
+    def set_library(self,library,library_index,move_samples,empty_rows,empty_samples,static_rows):
+        """Uses the rows of a movement library as the rearrangement data and
+        preallocates the buffers used to prepare the segment data at 
+        runtime (see `accept_string`).
+
+        Parameters
+        ----------
+        library : numpy.memmap of int16
+            The library. Each row is the int16 data of one channel.
+        library_index : dict
+            The row of the rearrangement channel data of each 
+            (start_freq_MHz, end_freq_MHz) movement.
+        move_samples : dict
+            The number of samples (per channel) each movement takes, keyed 
+            in the same way as `library_index`. The rows are the length of 
+            the longest possible movement; the data of shorter movements 
+            holds the tone at the target frequency after it has finished.
+        empty_rows : list of int
+            The row of the empty segment data of each channel.
+        empty_samples : int
+            The number of samples (per channel) of the empty segment.
+        static_rows : list of int or None
+            The row of the data of each channel other than the rearrangement
+            channel, which is the same for every movement. The entry for the
+            rearrangement channel is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.rearr_library = library
+        self.library_index = library_index
+        self.move_samples = move_samples
+        self.empty_rows = empty_rows
+        self.empty_samples = empty_samples
+        self.static_rows = static_rows
+        self.rearr_segments_data = {}
+        for (start_freq_MHz,end_freq_MHz),row in library_index.items():
+            self.rearr_segments_data.setdefault(start_freq_MHz,{})[end_freq_MHz] = library[row]
+        self.static_data = [None if row is None else library[row] for row in static_rows]
+        empty_data = [library[row] for row in empty_rows]
+        if len(empty_data) > 1:
+            self.empty_segment_data = self.main_window.awg.multiplex(empty_data)
+        else:
+            self.empty_segment_data = empty_data[0]
+
+        if self.mode == 'simultaneous':
+            scratch_samples = min(summation_chunk_samples,library.shape[-1])
+        else:
+            scratch_samples = 0
+        self.tone_sum_scratch = np.empty(scratch_samples,dtype=np.int32)
+        self.tone_scale_scratch = np.empty(self.tone_sum_scratch.size,dtype=np.float64)
+        
+        # the cached segments were made from the old library
+        self.pattern_counts = Counter()
+        self.hot_segments = {} # (segment data, overflow samples) of each cached pattern
+        self.hot_pattern_slots = {}
+        self.hot_pattern_hits = 0
+        self.hot_pattern_misses = 0
+        self.hot_pattern_checked_shots = 0
+
+    def check_target_freqs(self):
+        """Discards any target traps beyond the number of start traps, 
+        because these could never be filled."""
         if len(self.target_freq_MHz) > len(self.start_freq_MHz):
             logging.warning('target_freq_MHz was longer than start_freq_MHz. Discarding '
                             'extra target traps.')
             self.target_freq_MHz = self.target_freq_MHz[:len(self.start_freq_MHz)]
 
-        # occupations = [list(i) for i in itertools.product([1, 0], repeat=len(self.start_freq_MHz))]
-        # occupations = [(''.join(str(x) for x in y)) for y in occupations if sum(y) == len(self.target_freq_MHz)]
-        final_occupations = []
-        for occupation in reversed(range(2**(len(self.start_freq_MHz)))):
-            occupation = '{:0{}b}'.format(occupation, len(self.start_freq_MHz))
-            if 0 < occupation.count('1') <= len(self.target_freq_MHz):
-                last_1_index = occupation.rindex('1')
-                cut_final_occupations = [x[:last_1_index] for x in final_occupations]
-                if occupation[:last_1_index] not in cut_final_occupations:
-                    final_occupations.append(occupation)
-        self.occupations = final_occupations
-        self.num_segments = len(self.occupations)
+    def get_loaded_traps(self,string):
+        """Parses an occupation string and corrects it to the traps that 
+        will be moved to the target traps.
+        
+        If there are too many occupied traps, only the first 
+        len(`target_freq_MHz`) occupied traps are used. If there are too 
+        few, the traps after the last occupied trap are used as well (as 
+        though they were occupied) until there are enough traps, so that 
+        the rearrangement segment always contains the same number of moves
+        where possible.
+        
+        Parameters
+        ----------
+        string : str
+            Occupation string containing '0' (unoccupied) and '1' 
+            (occupied). Extra characters are discarded and missing 
+            characters are treated as unoccupied.
+            
+        Returns
+        -------
+        numpy.ndarray of int
+            The indices of the traps in `start_freq_MHz` to move, in 
+            ascending order.
+        
+        """
+        num_traps = len(self.start_freq_MHz)
+        num_targets = len(self.target_freq_MHz)
+        occupied = np.frombuffer(string[:num_traps].encode('ascii'),dtype=np.uint8) == ord('1')
+        loaded_traps = np.flatnonzero(occupied)
+        if loaded_traps.size >= num_targets:
+            return loaded_traps[:num_targets]
+        first_extra_trap = loaded_traps[-1]+1 if loaded_traps.size else 0
+        extra_traps = np.arange(first_extra_trap,min(num_traps,first_extra_trap+num_targets-loaded_traps.size))
+        return np.concatenate([loaded_traps,extra_traps])
+
+    def get_movements(self,loaded_traps):
+        """Returns the movements needed to rearrange the loaded traps.
+        
+        The movements are computed directly from the positions of the loaded
+        traps: the n-th loaded trap is moved to the n-th target trap. Moves 
+        towards the start of the array are listed first (in order), followed
+        by moves towards the end of the array (in reverse order), so that 
+        the order that the moves are summed in is fixed.
+        
+        Parameters
+        ----------
+        loaded_traps : numpy.ndarray of int
+            The indices of the traps to move, as returned by 
+            `get_loaded_traps`.
+            
+        Returns
+        -------
+        list of tuple
+            The (start_freq_MHz, end_freq_MHz) pairs of the movements. 
+            These are keys of the `rearr_segments_data` dicts.
+        
+        """
+        start_freqs_MHz = np.asarray(self.start_freq_MHz,dtype=float)[loaded_traps]
+        end_freqs_MHz = np.asarray(self.target_freq_MHz,dtype=float)[:loaded_traps.size]
+
+        # Need to know whether frequency moves left or right
+        direction = self.start_freq_MHz[1] - self.start_freq_MHz[0]
+        moves_forward = (end_freqs_MHz-start_freqs_MHz)*direction > 0
+        order = np.concatenate([np.flatnonzero(~moves_forward),np.flatnonzero(moves_forward)[::-1]])
+        return list(zip(start_freqs_MHz[order].tolist(),end_freqs_MHz[order].tolist()))
         
     def accept_string(self,string):
-        """Takes the string recieved from Pydex and converts it to a matching 
-        id string.
+        """Takes the string recieved from Pydex and prepares the 
+        rearrangement segment data for the occupation.
         
-        If there are too few occupied traps, the correct id is generated by 
-        successively switching bits from the right hand side to occupied until 
-        the correct number of traps register as occupied.
+        The string is corrected to the traps to move (see 
+        `get_loaded_traps`) and the movements are found directly from the 
+        positions of these traps (see `get_movements`), so no table of 
+        occupations is needed. The movements of recently seen strings are 
+        kept in the dict `movement_cache`.
         
-        If there are too many occupied traps, the correct id is generated by 
-        successively switching bits from the right hand side to unoccupied 
-        until the correct number of traps register as occupied.
+        In 'simultaneous' mode the number of times each set of movements 
+        occurs is counted in `pattern_counts`. If the segment of the 
+        movements has already been prepared by `fill_hot_pattern_cache` it 
+        is returned straight away, otherwise it is prepared by 
+        `prepare_simultaneous_segment`.
 
         Checks are minimal here to make runtime as quick as possible.
         
-        This means that the minimum number of segment combinations need to be 
-        precalculated, however this gain is minimal now that the segments are
-        summed at runtime.
-        
         Parameters
         ----------
         string : str
@@ -367,66 +758,225 @@ class RearrangementHandler():
     
         """
 
-        # discard any extra bits and add missing bits
-        string = string[:len(self.start_freq_MHz)]+'0'*(len(self.start_freq_MHz)-len(string))
-        
-        final_string = ''
-        for trap in string:
-            if final_string.count('1') == len(self.target_freq_MHz):
-                final_string += '0'
-            elif final_string.count('1') >= string.count('1'):
-                final_string += '1'
-            else:
-                final_string += trap
-
-        # get occupation index then retrieve the movements to make based on this index
-        rearr_segment_index = self.occupations.index(final_string)
-        movements = self.rearr_movements[rearr_segment_index]
+        try:
+            movements = self.movement_cache[string]
+        except KeyError:
+            if len(self.movement_cache) >= max_cached_movements:
+                self.movement_cache.clear()
+            movements = tuple(self.get_movements(self.get_loaded_traps(string))) # tuple so that the movements can be used as a key of hot_segments
+            self.movement_cache[string] = movements
 
         logging.debug(f'Preparing rearrangement movements: {movements}.')
 
-        # prepare data to be sent to the AWG
-        rearr_channel_data = []
-        segment_data = []
-        for (start_freq_MHz, end_freq_MHz) in movements:
-            if self.mode == 'simultaneous': # data has not yet been multiplexed so need to only get the correct channels data
-                rearr_channel_data.append(self.rearr_segments_data[start_freq_MHz][end_freq_MHz][self.channel])
-            else: # data has already been multiplexed so don't need to pick based on channel
-                segment_data.append(self.rearr_segments_data[start_freq_MHz][end_freq_MHz])
-
-        if self.mode == 'simultaneous': # all data should be in 1 segment so needs to be summed. It will also not have yet been multiplexed
-            rearr_channel_data = np.add.reduce(rearr_channel_data, dtype=np.int16, axis=0) # faster than np.sum
-
-            if self.main_window.card_settings['active_channels'] > 1:
-                other_channel_data = self.rearr_segments_data[start_freq_MHz][end_freq_MHz][int(not self.channel)] # note here we expect only maximum of 2 channels
-                segment_data = np.empty((rearr_channel_data.size + other_channel_data.size,), dtype=rearr_channel_data.dtype)
-                segment_data[self.channel::2] = rearr_channel_data
-                segment_data[int(not(self.channel))::2] = other_channel_data
-            else:
-                segment_data = rearr_channel_data
+        # prepare data to be sent to the AWG. The library only contains the rearrangement 
+        # channel of each movement so the other channels are multiplexed in here, directly 
+        # into the (interleaved) DMA staging buffers so that no copies are made before the transfer
+        # Each segment is only as long as its movements need (see get_move_samples).
+        num_channels = len(self.static_data)
+        if self.mode == 'simultaneous': # all data should be in 1 segment so needs to be summed
+            if len(self.pattern_counts) >= max_cached_movements: # only keep the most common half
+                self.pattern_counts = Counter(dict(self.pattern_counts.most_common(max_cached_movements//2)))
+            self.pattern_counts[movements] += 1
+            try:
+                segment_data, self.overflow_samples = self.hot_segments[movements]
+                self.hot_pattern_hits += 1
+            except KeyError:
+                self.hot_pattern_misses += 1
+                segment_data, self.overflow_samples = self.prepare_simultaneous_segment(movements)
+            if self.overflow_samples:
+                logging.warning(f'{self.overflow_samples} rearrangement samples were over range '
+                                f'and have been {"clipped" if self.overflow == "clip" else "rescaled"}.')
             return [segment_data] # returns as a list containing a single value
 
-        else: # mode is sequential so return a list of segments to be sent to the AWG. Data will have already been mutliplexed when calculated.
+        else: # mode is sequential so return a list of segments to be sent to the AWG, one for each move
+            segment_data = []
+            for slot, movement in enumerate(movements):
+                num_samples = self.move_samples[movement]
+                tone_data = self.rearr_segments_data[movement[0]][movement[1]][:num_samples]
+                if num_channels == 1:
+                    segment_data.append(tone_data)
+                    continue
+                data = self.main_window.awg.get_staging_buffer(num_samples*num_channels,slot=slot) # a slot for each segment so they are not overwritten before transfer
+                for channel,channel_view in enumerate(self.main_window.awg.get_channel_views(data,num_channels)):
+                    if channel == self.channel:
+                        np.copyto(channel_view,tone_data)
+                    else:
+                        np.copyto(channel_view,self.static_data[channel][-num_samples:]) # the end of the data so the end phases match the following segments
+                segment_data.append(data)
+            empty_segment_data = self.empty_segment_data[:self.empty_samples*num_channels]
             while len(segment_data) < self.get_number_rearrangement_segments_needed():
-                segment_data.append(self.rearr_segments_data['empty']['empty'])
+                segment_data.append(empty_segment_data)
             return segment_data
     
-    def get_occupation_freqs(self):
-        """Returns the same information as the occupation array but instead 
-        of binary strings saying whether to use a trap, returns the actual 
-        trap positions
+    def prepare_simultaneous_segment(self,movements,slot=0):
+        """Sums the tones of the movements into the rearrangement channel 
+        of a DMA staging buffer and copies the other channels in, ready to 
+        be transferred to the card.
+
+        Parameters
+        ----------
+        movements : tuple of tuple
+            The (start_freq_MHz, end_freq_MHz) of each movement, as returned
+            by `get_movements`.
+        slot : int or tuple
+            The staging buffer slot to prepare the segment in, see 
+            `AWG.get_staging_buffer`. The default is 0.
+
+        Returns
+        -------
+        segment_data : numpy.ndarray of int16
+            The multiplexed segment data.
+        overflow_samples : int
+            The number of samples of the rearrangement channel that were 
+            over range (see `sum_tones`).
+
+        """
+        num_channels = len(self.static_data)
+        rearr_channel_data = [self.rearr_segments_data[start_freq_MHz][end_freq_MHz] for (start_freq_MHz, end_freq_MHz) in movements]
+        num_samples = max([self.move_samples[movement] for movement in movements],default=self.empty_samples) # the segment ends when the longest movement has finished
+        segment_data = self.main_window.awg.get_staging_buffer(num_samples*num_channels,slot=slot)
+        channel_views = self.main_window.awg.get_channel_views(segment_data,num_channels)
+
+        overflow_samples = self.sum_tones(rearr_channel_data,channel_views[self.channel])
+
+        for channel,channel_view in enumerate(channel_views):
+            if channel != self.channel:
+                np.copyto(channel_view,self.static_data[channel][-num_samples:]) # the end of the data so the end phases match the following segments
+        return segment_data, overflow_samples
+
+    def fill_hot_pattern_cache(self):
+        """Prepares the segment of the most common occupation pattern that 
+        is not yet in `hot_segments`, so that when the pattern next occurs 
+        `accept_string` can return it without any arithmetic. The number of
+        over range samples is stored with the segment and only reported 
+        (in `overflow_samples`) when the pattern is played. If the cache 
+        is full, the least common cached pattern is replaced if it is less
+        common than the new one.
         
+        This is intended to be called between shots, after the 
+        rearrangement segment has been transferred. At most one segment is
+        prepared per call, and nothing is done unless `hot_pattern_interval`
+        shots have been seen since the cache was last checked.
+
         Returns
         -------
-        list of lists of floats
-            The `occupation` attribute converted into the loaded trap 
-            frequencies.
+        bool
+            Whether a segment was added to the cache.
+
+        """
+        if (self.mode != 'simultaneous') or (hot_pattern_cache_size == 0):
+            return False
+        shots = self.hot_pattern_hits + self.hot_pattern_misses
+        if shots - self.hot_pattern_checked_shots < hot_pattern_interval:
+            return False
+        self.hot_pattern_checked_shots = shots
         
+        for movements, count in self.pattern_counts.most_common(hot_pattern_cache_size):
+            if movements in self.hot_segments:
+                continue
+            if count < hot_pattern_min_count:
+                return False
+            if len(self.hot_segments) < hot_pattern_cache_size:
+                slot = ('hot_pattern',id(self),len(self.hot_segments))
+            else:
+                coldest = min(self.hot_segments,key=lambda cached: self.pattern_counts[cached])
+                if self.pattern_counts[coldest] >= count:
+                    return False
+                del self.hot_segments[coldest]
+                slot = self.hot_pattern_slots.pop(coldest)
+            self.hot_segments[movements] = self.prepare_simultaneous_segment(movements,slot=slot)
+            self.hot_pattern_slots[movements] = slot
+            logging.debug('Cached the rearrangement segment of a pattern seen {} times '
+                          '(hit rate {:.1%}).'.format(count,self.get_hot_pattern_stats()['hit_rate']))
+            return True
+        return False
+
+    def get_hot_pattern_stats(self):
+        """Returns statistics of the hot pattern cache (see 
+        `fill_hot_pattern_cache`) since the rearrangement data was last 
+        calculated.
+
+        Returns
+        -------
+        dict
+            Dictionary with the keys
+            'hits' : the number of shots whose segment was cached,
+            'misses' : the number of shots whose segment had to be prepared,
+            'hit_rate' : the fraction of shots that were hits (0 if there 
+            have been no shots),
+            'cached_patterns' : the number of patterns in the cache.
+
         """
-        indicies = [list(i.start() for i in re.finditer('1', x)) for x in self.occupations]
-        freqs = [[self.start_freq_MHz[i] for i in x] for x in indicies]
-        return freqs
+        shots = self.hot_pattern_hits + self.hot_pattern_misses
+        return {'hits' : self.hot_pattern_hits,
+                'misses' : self.hot_pattern_misses,
+                'hit_rate' : self.hot_pattern_hits/shots if shots else 0,
+                'cached_patterns' : len(self.hot_segments)}
+
+    def sum_tones(self,tone_data,out):
+        """Sums the int16 move tones into `out` (which may be a strided 
+        channel view of a DMA staging buffer), saturating to the int16 range.
+        
+        The tones are summed one chunk at a time into the preallocated 
+        int32 scratch buffer made by `calculate_rearr_segment_data`, so no 
+        arrays are allocated and the sum cannot wrap around. Over range 
+        samples are treated according to `overflow`. If these are rescaled a
+        second pass is needed, because the peak of the whole segment must be
+        known before it can be rescaled.
+
+        Parameters
+        ----------
+        tone_data : list of numpy.ndarray of int16
+            The data of each move tone, e.g. rows of `rearr_library`. These 
+            must be at least as long as `out`; only the first `out.size` 
+            samples of each are summed.
+        out : numpy.ndarray of int16
+            The array to write the summed data into.
+
+        Returns
+        -------
+        int
+            The number of samples that were outside of the int16 range.
 
+        """
+        if len(tone_data) == 0:
+            out[:] = 0
+            return 0
+        
+        full_scale = 2**15
+        peak = 0
+        overflow_samples = 0
+        for chunk_start in range(0,out.size,summation_chunk_samples):
+            chunk_stop = min(chunk_start+summation_chunk_samples,out.size)
+            chunk_sum = self._sum_tone_chunk(tone_data,chunk_start,chunk_stop)
+            chunk_max = chunk_sum.max()
+            chunk_min = chunk_sum.min()
+            peak = max(peak,chunk_max,-chunk_min)
+            if (chunk_max > full_scale-1) or (chunk_min < -full_scale):
+                overflow_samples += int(np.count_nonzero((chunk_sum > full_scale-1) | (chunk_sum < -full_scale)))
+            np.clip(chunk_sum,-full_scale,full_scale-1,out=chunk_sum)
+            np.copyto(out[chunk_start:chunk_stop],chunk_sum,casting='unsafe')
+        
+        if overflow_samples and (self.overflow == 'rescale'):
+            scale = (full_scale-1)/peak
+            for chunk_start in range(0,out.size,summation_chunk_samples):
+                chunk_stop = min(chunk_start+summation_chunk_samples,out.size)
+                chunk_sum = self._sum_tone_chunk(tone_data,chunk_start,chunk_stop)
+                scaled = self.tone_scale_scratch[:chunk_sum.size]
+                np.multiply(chunk_sum,scale,out=scaled)
+                np.copyto(out[chunk_start:chunk_stop],scaled,casting='unsafe') # truncates towards zero like np.int16()
+        return overflow_samples
+    
+    def _sum_tone_chunk(self,tone_data,chunk_start,chunk_stop):
+        """Sums the samples `chunk_start`:`chunk_stop` of the move tones 
+        into the int32 scratch buffer and returns the view of the buffer 
+        that holds the sum."""
+        chunk_sum = self.tone_sum_scratch[:chunk_stop-chunk_start]
+        np.copyto(chunk_sum,tone_data[0][chunk_start:chunk_stop])
+        for data in tone_data[1:]:
+            np.add(chunk_sum,data[chunk_start:chunk_stop],out=chunk_sum)
+        return chunk_sum
+    
     def get_params(self):
         """Gets the parameters needed to recreate this object to be save to a
         .awgrr file by the main controller.
@@ -438,7 +988,7 @@ class RearrangementHandler():
               
         data = {}
 
-        for param in params_to_save:
+        for param in self.params_to_save:
             data[param] = getattr(self,param)
             
         segments_data = []
@@ -475,19 +1025,14 @@ class RearrangementHandler():
         None.
 
         """
-        for param in params_to_save:
+        for param in self.params_to_save:
             try:
                 print(param)
                 setattr(self,param,data[param])
             except KeyError: # allow older param files which didn't specify mode to skip this
                 pass
 
-        if len(self.target_freq_MHz) > len(self.start_freq_MHz):
-            logging.warning('target_freq_MHz was longer than start_freq_MHz. Discarding '
-                            'extra target traps.')
-            self.target_freq_MHz = self.target_freq_MHz[:len(self.start_freq_MHz)]
-        
-        self.generate_segment_ids()
+        self.check_target_freqs()
         self.create_actions(data['base_segments'])
 
     def update_params(self,params_dict,ignore_enabled=True):
@@ -510,7 +1055,7 @@ class RearrangementHandler():
                 continue
             setattr(self,key,value)
 
-        self.generate_segment_ids()
+        self.check_target_freqs()
         self.create_actions()
 
 
@@ -530,4 +1075,4 @@ if __name__ == '__main__':
     
     # rh = RearrangementHandler(rearr_settings,None)
     rr = RearrangementHandler(r"Z:\Tweezer\Code\Python 3.9\awg\rearrangement\default_rearr_params_AWG1.txt")
-    print(rr.occupations)
+    print(rr.get_movements(rr.get_loaded_traps('1'*len(rr.target_freq_MHz))))
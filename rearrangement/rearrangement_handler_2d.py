@@ -0,0 +1,192 @@
+import logging
+
+import numpy as np
+
+from .rearrangement_handler import RearrangementHandler, params_to_save, max_cached_movements
+
+params_to_save_2d = params_to_save + ['channel_y','start_freq_y_MHz','target_freq_y_MHz']
+
+class RearrangementHandler2D(RearrangementHandler):
+    """Handler for rearrangement of a 2D array made by crossed AODs. The x
+    channel (`channel`) makes the columns of the array and the y channel
+    (`channel_y`) makes the rows, so every atom in a column moves when the
+    x tone of that column moves.
+
+    Each shot, the rows with the most atoms are moved into the target rows
+    and then the columns with the most atoms within these rows are moved
+    into the target columns, with the tones of both channels moving in the
+    same segment. The movements of each axis are calculated and stored by
+    a 1D `RearrangementHandler` for that channel (see `axes`), and the
+    tones of both axes are summed into the two channels at runtime.
+
+    Only the 'simultaneous' mode is supported.
+
+    Attributes
+    ----------
+    start_freq_MHz, target_freq_MHz : list of floats
+        The frequencies of the start and target columns (x channel).
+    start_freq_y_MHz, target_freq_y_MHz : list of floats
+        The frequencies of the start and target rows (y channel).
+    channel : int
+        The x channel.
+    channel_y : int
+        The y channel.
+    axes : list of `RearrangementHandler`
+        The handlers that calculate the movements of the x and y channel.
+    """
+    params_to_save = params_to_save_2d
+
+    def __init__(self,main_window,filename=None):
+        self.channel_y = 1
+        super().__init__(main_window,filename)
+
+    def create_actions(self,segment_params_list=None):
+        """Creates the `ActionContainer` objects of the base segments (see
+        `RearrangementHandler.create_actions`) and sets the frequencies of
+        both channels.
+        """
+        if self.mode != 'simultaneous':
+            logging.warning('2D rearrangement only supports simultaneous mode. '
+                            'Using simultaneous mode.')
+            self.mode = 'simultaneous'
+        if segment_params_list != None:
+            super().create_actions(segment_params_list) # also creates the rearr actions but these need the y freqs first
+        self.update_base_freqs(self.channel,self.start_freq_MHz,self.target_freq_MHz)
+        self.update_base_freqs(self.channel_y,self.start_freq_y_MHz,self.target_freq_y_MHz)
+        self.create_rearr_actions()
+
+    def create_rearr_actions(self):
+        """Creates the 1D handler of each axis, which share the base segments
+        of this handler, and their movements."""
+        self.movement_cache = {}
+        self.axes = []
+        for channel,start_freq_MHz,target_freq_MHz in [(self.channel,self.start_freq_MHz,self.target_freq_MHz),
+                                                       (self.channel_y,self.start_freq_y_MHz,self.target_freq_y_MHz)]:
+            axis = RearrangementHandler(self.main_window)
+            for param in ['segment','mode','overflow','full_library','max_jerk_MHz_per_ms3',
+                          'starting_segment','enabled','base_segments']:
+                setattr(axis,param,getattr(self,param))
+            axis.channel = channel
+            axis.start_freq_MHz = start_freq_MHz
+            axis.target_freq_MHz = target_freq_MHz
+            axis.create_rearr_actions()
+            self.axes.append(axis)
+
+    def calculate_rearr_segment_data(self):
+        """Precalculates (or loads) the movement library of each axis, see
+        `RearrangementHandler.calculate_rearr_segment_data`."""
+        for axis in self.axes:
+            axis.calculate_rearr_segment_data()
+
+    def get_number_rearrangement_segments_needed(self):
+        return 1
+
+    def fill_hot_pattern_cache(self):
+        """The hot pattern cache is not used for 2D rearrangement."""
+        return False
+
+    def check_target_freqs(self):
+        """Discards any target rows or columns beyond the number of start
+        rows or columns, because these could never be filled."""
+        super().check_target_freqs()
+        if len(self.target_freq_y_MHz) > len(self.start_freq_y_MHz):
+            logging.warning('target_freq_y_MHz was longer than start_freq_y_MHz. Discarding '
+                            'extra target traps.')
+            self.target_freq_y_MHz = self.target_freq_y_MHz[:len(self.start_freq_y_MHz)]
+
+    def get_loaded_traps(self,string):
+        """Parses a 2D occupation string and chooses the rows and columns
+        to move to the target rows and columns.
+
+        The rows with the most atoms are used (ties are broken by taking the
+        first row), then the columns with the most atoms within these rows.
+
+        Parameters
+        ----------
+        string : str
+            Occupation string containing '0' (unoccupied) and '1'
+            (occupied) for each trap in row-major order, i.e. the trap in row
+            i (`start_freq_y_MHz[i]`) and column j (`start_freq_MHz[j]`) is
+            character i*len(start_freq_MHz)+j. Extra characters are
+            discarded and missing characters are treated as unoccupied.
+
+        Returns
+        -------
+        columns : numpy.ndarray of int
+            The indices of the columns in `start_freq_MHz` to move, in
+            ascending order.
+        rows : numpy.ndarray of int
+            The indices of the rows in `start_freq_y_MHz` to move, in
+            ascending order.
+
+        """
+        num_columns = len(self.start_freq_MHz)
+        num_rows = len(self.start_freq_y_MHz)
+        occupied = np.zeros(num_rows*num_columns,dtype=bool)
+        string = string[:occupied.size]
+        occupied[:len(string)] = np.frombuffer(string.encode('ascii'),dtype=np.uint8) == ord('1')
+        occupied = occupied.reshape(num_rows,num_columns)
+
+        rows = np.sort(np.argsort(-occupied.sum(axis=1),kind='stable')[:len(self.target_freq_y_MHz)])
+        columns = np.sort(np.argsort(-occupied[rows].sum(axis=0),kind='stable')[:len(self.target_freq_MHz)])
+        return columns, rows
+
+    def accept_string(self,string):
+        """Takes the 2D occupation string recieved from Pydex and prepares
+        the rearrangement segment data for it.
+
+        The rows and columns to move are chosen by `get_loaded_traps` and
+        the movements of each axis are found by the `get_movements` method
+        of its handler. The tones of each axis are summed straight into its
+        channel of the DMA staging buffer, as in 1D simultaneous mode. The
+        segment ends when the longest movement of either axis has finished.
+
+        Parameters
+        ----------
+        string : str
+            Occupation string from Pydex in row-major order, see
+            `get_loaded_traps`.
+
+        Returns
+        -------
+        list of numpy.ndarray of int16
+            The rearrangement segment data prepared for immediate upload to
+            the AWG card.
+
+        """
+        try:
+            axes_movements = self.movement_cache[string]
+        except KeyError:
+            if len(self.movement_cache) >= max_cached_movements:
+                self.movement_cache.clear()
+            axes_movements = [axis.get_movements(loaded_traps) for axis,loaded_traps in zip(self.axes,self.get_loaded_traps(string))]
+            self.movement_cache[string] = axes_movements
+
+        logging.debug(f'Preparing 2D rearrangement movements: {axes_movements}.')
+
+        static_data = self.axes[0].static_data
+        num_channels = len(static_data)
+        num_samples = max([axis.move_samples[movement] for axis,movements in zip(self.axes,axes_movements) for movement in movements],
+                          default=self.axes[0].empty_samples) # the segment ends when the longest movement has finished
+        segment_data = self.main_window.awg.get_staging_buffer(num_samples*num_channels)
+        channel_views = self.main_window.awg.get_channel_views(segment_data,num_channels)
+
+        self.overflow_samples = 0
+        for axis,movements in zip(self.axes,axes_movements):
+            tone_data = [axis.rearr_segments_data[start_freq_MHz][end_freq_MHz] for (start_freq_MHz, end_freq_MHz) in movements]
+            self.overflow_samples += axis.sum_tones(tone_data,channel_views[axis.channel])
+        if self.overflow_samples:
+            logging.warning(f'{self.overflow_samples} rearrangement samples were over range '
+                            f'and have been {"clipped" if self.overflow == "clip" else "rescaled"}.')
+
+        for channel,channel_view in enumerate(channel_views):
+            if channel not in [self.channel,self.channel_y]:
+                np.copyto(channel_view,static_data[channel][-num_samples:]) # the end of the data so the end phases match the following segments
+        return [segment_data] # returns as a list containing a single value
+
+def get_rearrangement_handler_class(params):
+    """Returns the handler class that the rearrangement parameters `params`
+    (as saved by `get_params`) are for."""
+    if 'start_freq_y_MHz' in params:
+        return RearrangementHandler2D
+    return RearrangementHandler
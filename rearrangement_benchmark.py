@@ -0,0 +1,76 @@
+"""Measures the time taken by the RearrangementHandler to turn an occupation
+string into the rearrangement segment data for arrays of different sizes.
+Runs against the simulated card unless AWG_SIMULATE is set to 0 in the
+environment before running."""
+import os
+os.environ.setdefault('AWG_SIMULATE','1')
+
+import logging
+import time
+import json
+from copy import deepcopy
+from types import SimpleNamespace
+import numpy as np
+from awg import AWG
+from actions import AmpAdjuster2D
+from rearrangement.rearrangement_handler import RearrangementHandler
+
+logging.disable(logging.WARNING) # the over range warnings of every shot would be timed too
+
+params_filename = 'rearrangement/default_rearr_params_AWG1.awgrr'
+moving_duration_ms = 0.01 # short moves so that the 100 trap library fits in memory
+num_shots = 1000
+loading_probability = 0.5
+
+awg = AWG(active_channels=1,max_output_mV=282)
+card_settings = {'active_channels' : 1,
+                 'sample_rate_Hz' : awg.sample_rate_Hz,
+                 'max_output_mV' : awg.max_output_mV,
+                 'number_of_segments' : awg.number_of_segments,
+                 'segment_min_samples' : 192,
+                 'segment_step_samples' : 32}
+amp_adjuster = AmpAdjuster2D({'enabled' : False, 'filename' : 'no_calibration.awgde', # missing file so no calibration is loaded
+                              'freq_limit_1_MHz' : 100, 'freq_limit_2_MHz' : 200,
+                              'amp_limit_1' : 0, 'amp_limit_2' : 1,
+                              'non_adjusted_amp_mV' : 100})
+main_window = SimpleNamespace(card_settings=card_settings,amp_adjusters=[amp_adjuster],awg=awg)
+
+with open(params_filename,'r') as f:
+    params = json.load(f)
+params['base_segments'][params['segment']]['duration_ms'] = moving_duration_ms
+
+rng = np.random.default_rng(817)
+for num_traps in [8,32,100]:
+    params['start_freq_MHz'] = list(np.linspace(170,130,num_traps))
+    params['target_freq_MHz'] = list(np.linspace(160,140,num_traps//2))
+    rr = RearrangementHandler.__new__(RearrangementHandler)
+    rr.enabled = False
+    rr.starting_segment = 0
+    rr.mode = 'simultaneous'
+    rr.overflow = 'clip'
+    rr.overflow_samples = 0
+    rr.full_library = False
+    rr.max_jerk_MHz_per_ms3 = 0
+    rr.main_window = main_window
+    rr.load_params(deepcopy(params)) # the ActionContainers modify the base segment params
+    start = time.perf_counter()
+    rr.calculate_rearr_segment_data()
+    setup_s = time.perf_counter()-start
+
+    strings = [''.join(np.where(rng.random(num_traps) < loading_probability,'1','0')) for _ in range(num_shots)]
+    start = time.perf_counter()
+    for string in strings:
+        rr.get_movements(rr.get_loaded_traps(string))
+    parse_us = (time.perf_counter()-start)/num_shots*1e6
+    start = time.perf_counter()
+    for string in strings:
+        rr.accept_string(string)
+    accept_us = (time.perf_counter()-start)/num_shots*1e6
+    start = time.perf_counter()
+    for string in strings:
+        rr.accept_string(string)
+    cached_us = (time.perf_counter()-start)/num_shots*1e6
+    print('{:>3} traps ({:>4} moves, setup {:5.1f} s): parse {:6.1f} us, accept_string '
+          '{:7.1f} us ({:7.1f} us with cached moves)'.format(num_traps,len(rr.rearr_unique_movements),
+          setup_s,parse_us,accept_us,cached_us))
+awg.close()